@@ -0,0 +1,47 @@
+##############################################################################
+#
+# This script provides functions for the uncompressed Arrow IPC cache of
+# the outcome extracts.
+#
+# Each index date is written once as an uncompressed Arrow IPC (Feather
+# V2) file, and only rewritten when its extract is newer. read_outcomes()
+# in custom_functions.R memory-maps the file as an Arrow Table
+# (read_feather(mmap = TRUE, as_data_frame = FALSE)) and selects the
+# columns its caller uses before converting them to a data frame, so only
+# those columns' pages are read, nothing is decompressed, and actions
+# running at the same time share the same pages of the OS page cache.
+#
+##############################################################################
+
+
+import os
+from pathlib import Path
+
+import pyarrow.feather as feather
+
+
+CACHE_DIR = Path("output", "outcomes_cache")
+
+
+def cache_file(index_date, cache_dir=CACHE_DIR, study="outcomes"):
+    return Path(cache_dir) / f"{study}_{index_date}.arrow"
+
+
+def write_cache(table, path):
+    """
+    Write `table` uncompressed, via a temporary file renamed into place so
+    concurrent readers never see a partial file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    feather.write_feather(table, tmp, compression="uncompressed")
+    os.replace(tmp, path)
+
+
+def is_stale(path, source):
+    """
+    True when the cache file is missing or older than its source
+    """
+    path, source = Path(path), Path(source)
+    return not path.exists() or path.stat().st_mtime < source.stat().st_mtime
@@ -0,0 +1,169 @@
+##############################################################################
+#
+# This script provides functions for data-driven bandwidth selection for
+# the sharp RD over age cells.
+#
+# The MSE-optimal bandwidth uses the Imbens-Kalyanaraman (2012) procedure
+# for a local linear fit with a triangular kernel, and the CER-optimal
+# bandwidth scales it by n^(-1/20) (the rule used by rdrobust for p = 1).
+# Every step is a least-squares fit on the same cells, so the pilot
+# estimates for many outcomes (columns of Y) are solved together. Cells
+# are weighted by the people in them, as in the sharp RD fits
+# (lm(..., weights = n)); cells without anyone are left out.
+#
+# Selections are cached on disk, keyed by a hash of the cells, so
+# repeated runs of bandwidth_selection.py and placebo_inference.py
+# (--bandwidth mse|cer) reuse them. The selections are used by
+# placebo_inference.py and written to bw_selected.csv; the R sensitivity
+# scripts (*_sens_2.R) do not read them, as their models use fixed 1-4
+# year bandwidths and rdbwselect is only printed alongside for reference.
+#
+##############################################################################
+
+
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+
+
+# Constant for the triangular kernel, local linear fit
+C_TRIANGULAR = 3.4375
+
+CACHE_DIR = Path("output", "cache", "bandwidth")
+
+
+def lstsq(X, Y, rows, w):
+    """
+    Weighted least-squares coefficients [k x outcomes] using the rows in
+    `rows`
+    """
+    root = np.sqrt(w[rows])[:, None]
+    coef, *_ = np.linalg.lstsq(X[rows] * root, Y[rows] * root, rcond=None)
+    return coef
+
+
+def side_variance(Y, rows, w):
+    if rows.sum() <= 1:
+        return np.full(Y.shape[1], np.nan)
+    return np.cov(Y[rows], rowvar=False, aweights=w[rows]).reshape(-1, Y.shape[1]).diagonal()
+
+
+def mse_bandwidth(x, Y, cutoff=0.0, restrict=True, weights=None):
+    """
+    MSE-optimal bandwidth for each column of Y (cells x outcomes), with
+    running variable `x` and cells weighted by `weights` (default equal).
+    With `restrict`, bandwidths are capped at the range of x either side
+    of the cutoff (as rdbwselect(bwrestrict = TRUE))
+    """
+    x = np.asarray(x, dtype="float64") - cutoff
+    Y = np.asarray(Y, dtype="float64").reshape(len(x), -1)
+    n = len(x)
+    # Weights relative to the average cell, so n is still the number of cells
+    w = np.ones(n) if weights is None else np.asarray(weights, dtype="float64")
+    w = w / w.mean()
+    left, right = x < 0, x >= 0
+    # The pilot quadratics either side need at least three cells each
+    for side, rows in (("below", left), ("at or above", right)):
+        if rows.sum() < 3:
+            raise ValueError(
+                f"Bandwidth selection needs at least 3 cells either side of the cutoff; "
+                f"{rows.sum()} {side} it"
+            )
+
+    # Step 1: density and conditional variances with a pilot bandwidth
+    h1 = 1.84 * np.sqrt(np.cov(x, aweights=w)) * n ** (-1 / 5)
+    near = np.abs(x) <= h1
+    f0 = w[near].sum() / (2 * n * h1)
+    var_left = side_variance(Y, left & near, w)
+    var_right = side_variance(Y, right & near, w)
+
+    # Step 2: third derivative from a global cubic with a jump at the cutoff,
+    # then second derivatives from quadratics either side
+    X3 = np.column_stack([np.ones(n), right, x, x**2, x**3])
+    m3 = 6 * lstsq(X3, Y, np.ones(n, dtype=bool), w)[4]
+    X2 = np.column_stack([np.ones(n), x, x**2])
+
+    m2 = {}
+    regularisation = 0.0
+    for side, rows, var in (("left", left, var_left), ("right", right, var_right)):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            h2 = 3.56 * (var / (f0 * m3**2)) ** (1 / 7) * rows.sum() ** (-1 / 7)
+        h2 = np.where(np.isfinite(h2), h2, np.abs(x[rows]).max())
+        # At least three cells for the quadratic (checked above)
+        h2 = np.maximum(h2, np.sort(np.abs(x[rows]))[2])
+        # Quadratics for every outcome within its own pilot bandwidth, as
+        # one stacked solve of the normal equations
+        within = rows[:, None] & (np.abs(x)[:, None] <= h2[None, :])
+        weight = within * w[:, None]
+        XtX = np.einsum("cj,ck,cl->jkl", weight, X2, X2)
+        XtY = np.einsum("cj,ck,cj->jk", weight, X2, Y)
+        coef = np.linalg.solve(XtX, XtY[..., None])[:, 2, 0]
+        n2 = weight.sum(axis=0)
+        m2[side] = 2 * coef
+        regularisation = regularisation + 2160 * var / (n2 * h2**4)
+
+    # Step 3: optimal bandwidth
+    with np.errstate(divide="ignore", invalid="ignore"):
+        h = C_TRIANGULAR * (
+            (var_left + var_right)
+            / (f0 * ((m2["right"] - m2["left"]) ** 2 + regularisation))
+        ) ** (1 / 5) * n ** (-1 / 5)
+
+    if restrict:
+        h = np.minimum(h, max(-x.min(), x.max()))
+    return h
+
+
+def cer_bandwidth(h_mse, n):
+    """
+    CER-optimal bandwidth from the MSE-optimal one (local linear)
+    """
+    return np.asarray(h_mse) * n ** (-1 / 20)
+
+
+def cells_hash(x, Y, w, **params):
+    """
+    Content hash of the cells and selection settings
+    """
+    digest = hashlib.sha256()
+    for array in (x, Y, w):
+        array = np.ascontiguousarray(array, dtype="float64")
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def select_bandwidths(x, Y, weights=None, cutoff=0.0, restrict=True, cache_dir=CACHE_DIR):
+    """
+    MSE- and CER-optimal bandwidths for each column of Y, with cells
+    weighted by `weights` (e.g. people in each cell), from the cache when
+    these cells have been seen before. Cells with zero weight are left
+    out, and selections that are not finite are not cached.
+    Returns {"h_mse": [...], "h_cer": [...]}
+    """
+    x = np.asarray(x, dtype="float64")
+    Y = np.asarray(Y, dtype="float64").reshape(len(x), -1)
+    w = np.ones(len(x)) if weights is None else np.asarray(weights, dtype="float64")
+    keep = w > 0
+    x, Y, w = x[keep], Y[keep], w[keep]
+    key = cells_hash(x, Y, w, cutoff=cutoff, restrict=restrict, method="ik-triangular-p1-weighted")
+
+    path = Path(cache_dir, f"{key}.json") if cache_dir else None
+    if path and path.exists():
+        return json.loads(path.read_text())
+
+    h_mse = mse_bandwidth(x, Y, cutoff, restrict, w)
+    result = {
+        "h_mse": h_mse.tolist(),
+        "h_cer": cer_bandwidth(h_mse, len(x)).tolist(),
+    }
+    if path and np.isfinite(h_mse).all():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so readers never see a partial file
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(result))
+        tmp.replace(path)
+    return result
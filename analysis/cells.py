@@ -0,0 +1,68 @@
+##############################################################################
+#
+# This script provides functions to aggregate the outcome panel into age
+# cells (people, boosters and outcome events by age_3mos) for each start
+# date, as the R analysis scripts do before fitting models.
+#
+##############################################################################
+
+
+import numpy as np
+import pandas as pd
+
+from custom_functions import age_in_months
+from outcome_panel import WEIGHT_COLUMN, on_date
+
+
+# Age range analysed, in 3-month age groups (45-54 years), and the cutoff
+AGE_3MOS = (180, 220)
+CUTOFF = 200
+
+
+def age_cells(panel, index_dates, start_date, outcomes, age_3mos=AGE_3MOS,
+              weights=None):
+    """
+    Counts by age_3mos at `start_date` for people in the extracted population
+    who were alive at the start date:
+      n       people (or the sum of `weights`)
+      boost   people boosted before the start date
+      <name>  people with each outcome
+    Sample runs are weighted by their sampling weights unless `weights`
+    is given. Cells without anyone are dropped: their outcome rates are
+    undefined (and lm drops them as missing).
+    """
+    start = pd.Timestamp(start_date)
+    in_population = on_date(panel["in_population"].to_numpy(), index_dates, start)
+    alive = (panel["dod"].isna() | (panel["dod"] >= start)).to_numpy()
+
+    age = age_in_months(panel["dob"], start, mid_month=True).to_numpy() // 3
+    keep = in_population & alive & (age >= age_3mos[0]) & (age < age_3mos[1])
+
+    if weights is None:
+        weights = panel[WEIGHT_COLUMN] if WEIGHT_COLUMN in panel else np.ones(len(panel))
+    weights = np.asarray(weights, dtype="float64")[keep]
+    cell = (age[keep] - age_3mos[0]).astype(np.int64)
+    n_cells = age_3mos[1] - age_3mos[0]
+
+    def total(flag=None):
+        w = weights if flag is None else weights * flag
+        return np.bincount(cell, weights=w, minlength=n_cells)
+
+    boost = (panel["boost_date"] < start).to_numpy()[keep]
+    cells = {"age_3mos": np.arange(*age_3mos), "n": total(), "boost": total(boost)}
+    for name in outcomes:
+        cells[name] = total(on_date(panel[name].to_numpy()[keep], index_dates, start))
+    cells = pd.DataFrame(cells)
+    return cells[cells["n"] > 0].reset_index(drop=True)
+
+
+def cell_rates(cells, outcomes):
+    """
+    Running variable (centred on the cutoff), outcome rates per 100,000
+    and people for each cell with anyone in it
+    """
+    cells = cells[cells["n"] > 0]
+    x = cells["age_3mos"].to_numpy() - CUTOFF
+    n = cells["n"].to_numpy()
+    Y = cells[list(outcomes)].to_numpy() / n[:, None] * 100000
+    return x, Y, n
@@ -0,0 +1,151 @@
+##############################################################################
+#
+# This script provides functions for the descriptive count cube.
+#
+# The cube holds counts of people by reference date x age in months x
+# exclusion status x (variable, category), for every attribute at once,
+# built in one pass over the patient-level baseline data. Only non-empty
+# cells are stored (a sparse cube in long format), so the descriptive
+# scripts can slice and re-aggregate counts (e.g. to age_3mos, age_yrs or
+# over50) without re-reading patient-level data.
+#
+##############################################################################
+
+
+import numpy as np
+import pandas as pd
+
+from custom_functions import months_between
+
+
+# Attributes taken directly from the baseline data
+ATTRIBUTES = [
+    "sex", "region", "imd", "ethnicity",
+    "covid_vax2", "covid_vax3", "booster",
+    "carehome", "immunosuppressed", "chronic_kidney_disease",
+    "chronic_resp_disease", "asthma", "diabetes", "asplenia",
+    "chronic_liver_disease", "chronic_neuro_disease", "chronic_heart_disease",
+    "sev_mental", "sev_obesity", "cv", "hscworker", "endoflife", "housebound",
+    "covid_vax4_early", "covid_vax3_early", "covid_vax_recent",
+]
+
+
+def uptake(df, date):
+    """
+    Receipt of flu vaccine and/or COVID booster before `date`
+    """
+    flu, boost = df["flu_vax_date"] < date, df["boost_date"] < date
+    labels = np.select([flu & boost, flu & ~boost, ~flu & boost],
+                       ["Both", "Flu vax only", "COVID booster only"], "Neither")
+    return pd.Series(labels, index=flu.index, dtype=object)
+
+
+# Attributes that depend on the reference date
+DATED_ATTRIBUTES = {
+    "flu_vax": lambda df, date: df["flu_vax_date"] < date,
+    "boost": lambda df, date: df["boost_date"] < date,
+    "uptake": uptake,
+}
+
+CUBE_COLUMNS = ["reference_date", "age_mos", "excluded", "variable", "category", "n"]
+
+
+def as_category(values):
+    """
+    Category labels as strings: logicals as "1"/"0", whole numbers
+    without decimals, missing values left missing
+    """
+    values = pd.Series(values)
+    if values.dtype == bool:
+        return values.astype(int).astype(str)
+    if values.dtype == object:
+        values = values.replace({"TRUE": 1, "FALSE": 0, True: 1, False: 0})
+    numeric = pd.to_numeric(values, errors="coerce")
+    if numeric.notna().sum() == values.notna().sum():
+        is_whole = (numeric.dropna() % 1 == 0).all()
+        labels = numeric.map(lambda v: f"{v:.0f}" if is_whole else f"{v:g}")
+        return labels.where(numeric.notna())
+    return values.astype("string").astype(object).where(values.notna())
+
+
+def count_cells(age_mos, excluded, category, variable):
+    """
+    Counts by (age_mos, excluded, category) for one variable, using a
+    single bincount over a combined integer key
+    """
+    codes, levels = pd.factorize(category, use_na_sentinel=True)
+    # Missing categories get their own code after the real levels
+    codes = np.where(codes < 0, len(levels), codes)
+    levels = list(levels) + [None]
+
+    age_codes, ages = pd.factorize(age_mos, sort=True)
+    key = (age_codes * 2 + excluded) * len(levels) + codes
+    counts = np.bincount(key, minlength=len(ages) * 2 * len(levels))
+    cells = np.flatnonzero(counts)
+
+    level = cells % len(levels)
+    rest = cells // len(levels)
+    return pd.DataFrame({
+        "age_mos": ages[rest // 2],
+        "excluded": rest % 2,
+        "variable": variable,
+        "category": [levels[i] for i in level],
+        "n": counts[cells],
+    })
+
+
+def build_cube(df, reference_dates, attributes=ATTRIBUTES,
+               dated_attributes=DATED_ATTRIBUTES):
+    """
+    Build the cube from patient-level data with (mid-month) `dob`, `dod`,
+    `any_exclusion` and the attribute columns. People who died before a
+    reference date are not counted at that date.
+    """
+    dob = pd.to_datetime(df["dob"])
+    dod = pd.to_datetime(df["dod"])
+    dates = {name: pd.to_datetime(df[name]) for name in ("flu_vax_date", "boost_date")
+             if name in df}
+    # Missing exclusion flags are treated as excluded, as in subset(any_exclusion == 0)
+    excluded = as_category(df["any_exclusion"]).fillna("1").astype(int).to_numpy()
+
+    categories = {name: as_category(df[name]) for name in attributes if name in df}
+
+    cubes = []
+    for reference_date in reference_dates:
+        date = pd.Timestamp(reference_date)
+        keep = ((dod.isna() | (dod >= date)) & dob.notna()).to_numpy()
+        age_mos = months_between(dob[keep], date).astype(int).to_numpy()
+        excl = excluded[keep]
+
+        cells = [count_cells(age_mos, excl, np.full(len(age_mos), "All", dtype=object), "total")]
+        for name, values in categories.items():
+            cells.append(count_cells(age_mos, excl, values[keep].to_numpy(dtype=object), name))
+        for name, derive in dated_attributes.items():
+            values = as_category(derive(dates, date).fillna(False) if dates else None)
+            cells.append(count_cells(age_mos, excl, values[keep].to_numpy(dtype=object), name))
+
+        cube = pd.concat(cells, ignore_index=True)
+        cube.insert(0, "reference_date", str(reference_date))
+        cubes.append(cube)
+
+    return pd.concat(cubes, ignore_index=True)[CUBE_COLUMNS]
+
+
+def slice_cube(cube, variable, reference_date, age_mos=None, excluded=0,
+               age_group=lambda age_mos: age_mos // 3):
+    """
+    Counts for one variable at one reference date, re-aggregated to
+    `age_group` (default age_3mos) with the age group total. `age_mos`
+    is an optional [start, end) band; excluded=None keeps everyone.
+    """
+    rows = cube[(cube["variable"] == variable)
+                & (cube["reference_date"] == str(reference_date))]
+    if excluded is not None:
+        rows = rows[rows["excluded"] == excluded]
+    if age_mos is not None:
+        rows = rows[(rows["age_mos"] >= age_mos[0]) & (rows["age_mos"] < age_mos[1])]
+
+    rows = rows.assign(age_group=age_group(rows["age_mos"]))
+    counts = rows.groupby(["age_group", "category"], dropna=False)["n"].sum().reset_index()
+    counts["total"] = counts.groupby("age_group")["n"].transform("sum")
+    return counts
@@ -0,0 +1,52 @@
+#######################################
+#
+# Functions used by the Python scripts
+# (counterparts of analysis/custom_functions.R)
+#
+#######################################
+
+
+import numpy as np
+import pandas as pd
+
+
+## Redaction
+def redact(values):
+    values = pd.Series(values, dtype="float64")
+    return values.where(values > 7)
+
+
+## Rounding
+def rounding(values):
+    return np.round(np.asarray(values, dtype="float64") / 5) * 5
+
+
+## Mid 6 rounding
+def roundmid_any(x, to=6):
+    # like round_any, but centers on (integer) midpoint of the rounding points
+    x = np.asarray(x, dtype="float64")
+    return np.ceil(x / to) * to - (np.floor(to / 2) * (x != 0))
+
+
+## Age
+def months_between(start, end):
+    """
+    Whole months from `start` to `end`, as lubridate's
+    (start %--% end) %/% months(1). `start` is a Series of dates, `end` a
+    single date; missing starts give NaN.
+    """
+    start = pd.to_datetime(pd.Series(start))
+    end = pd.Timestamp(end)
+    months = (end.year - start.dt.year) * 12 + (end.month - start.dt.month)
+    return months - (end.day < start.dt.day)
+
+
+def age_in_months(dob, index_date, mid_month=False):
+    """
+    Age in whole months at `index_date`. Set `mid_month` when `dob` is the
+    first of the month as extracted (the R scripts set DOB to mid-month)
+    """
+    dob = pd.to_datetime(pd.Series(dob))
+    if mid_month:
+        dob = dob + pd.Timedelta(days=14)
+    return months_between(dob, index_date)
@@ -0,0 +1,51 @@
+###################################################################
+# This script:
+# - Builds the descriptive count cube (see analysis/cube.py) from
+#    one read of the baseline data (before exclusions)
+# - Counts are by age in months at each reference date, so the
+#    descriptive scripts can slice them by age_yrs or age_3mos
+#
+# Dependency = data_process_baseline
+###################################################################
+
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from cube import ATTRIBUTES, build_cube  # noqa: E402
+
+
+# Start of campaign and end of flu vaccine follow-up
+REFERENCE_DATES = ["2022-09-03", "2022-11-26"]
+
+DATE_COLUMNS = ["dob", "dod", "flu_vax_date", "boost_date"]
+
+OUTPUT_DIR = Path("output", "cube")
+
+
+def main():
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    columns = set(pd.read_csv(Path("output", "cohort", "baseline.csv"), nrows=0).columns)
+    usecols = [c for c in DATE_COLUMNS + ["any_exclusion"] + ATTRIBUTES if c in columns]
+
+    baseline = pd.read_csv(
+        Path("output", "cohort", "baseline.csv"),
+        usecols=usecols,
+        parse_dates=[c for c in DATE_COLUMNS if c in columns],
+        dtype={"region": str, "ethnicity": str, "sex": str},
+        keep_default_na=False,
+        na_values=["", "NA"],
+    )
+
+    cube = build_cube(baseline, REFERENCE_DATES)
+    cube.to_csv(OUTPUT_DIR / "descriptive_cube.csv", index=False)
+    print(f"Cube cells: {len(cube)} from {len(baseline)} people")
+
+
+if __name__ == "__main__":
+    main()
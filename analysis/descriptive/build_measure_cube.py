@@ -0,0 +1,57 @@
+###################################################################
+# This script:
+# - Builds the weekly measure cube (see analysis/measure_cube.py):
+#    every measure by population, age_3mos and over50 at every
+#    index date, from one read of each week's measures extract
+# - Writes one tidy file instead of one measure_*.csv per measure;
+#    counts are unredacted, so the cube is highly sensitive and
+#    plot_outcomes_by_week.R releases rounded counts from it
+#
+# Dependency = outcomes_by_week
+###################################################################
+
+
+import argparse
+import re
+import sys
+from pathlib import Path
+
+import pyarrow.feather as feather
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from measure_cube import build_measure_cube, input_columns  # noqa: E402
+from outcome_panel import WEIGHT_COLUMN  # noqa: E402
+
+
+OUTPUT_DIR = Path("output", "cube")
+
+DATE = re.compile(r"input_measures_(\d{4}-\d{2}-\d{2})\.feather$")
+
+
+def read_weeks(input_dir):
+    """
+    (index date, data) of each week's extract, read when needed
+    """
+    paths = sorted(p for p in Path(input_dir).glob("input_measures_*.feather") if DATE.search(p.name))
+    if not paths:
+        raise FileNotFoundError(f"No input_measures_*.feather files in {input_dir}")
+    for path in paths:
+        names = feather.read_table(path, columns=[]).schema.names
+        columns = [c for c in input_columns() + [WEIGHT_COLUMN] if c in names]
+        yield DATE.search(path.name).group(1), feather.read_feather(path, columns=columns)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-dir", default="output")
+    args = parser.parse_args()
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    cube = build_measure_cube(read_weeks(args.input_dir), weight_column=WEIGHT_COLUMN)
+    cube.to_csv(OUTPUT_DIR / "measure_cube.csv", index=False)
+    print(f"Cube cells: {len(cube)} over {cube['date'].nunique()} weeks")
+
+
+if __name__ == "__main__":
+    main()
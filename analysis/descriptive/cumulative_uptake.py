@@ -0,0 +1,92 @@
+################################################################
+# This script:
+# - Calculates cumulative uptake of booster dose/second booster
+#    COVID-19 vaccine by age, from one read of the final cohort:
+#    - by day and age in years (and 3-month age groups) at Sep 3
+#    - by age in 3-month groups at Nov 26
+# - Plots are made by booster_uptake.R
+#
+# Dependency = data_process_baseline
+################################################################
+
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from custom_functions import months_between, redact, rounding  # noqa: E402
+from uptake import cumulative_uptake  # noqa: E402
+
+
+start_date = pd.Timestamp("2022-09-03")
+end_date = pd.Timestamp("2023-01-31")
+nov26 = pd.Timestamp("2022-11-26")
+
+OUTPUT_DIR = Path("output", "cumulative_rates")
+
+
+def alive_with_age(booster, date):
+    alive = booster[booster["dod"].isna() | (booster["dod"] >= date)]
+    return alive.assign(age_mos=months_between(alive["dob"], date))
+
+
+def daily_curves(booster, cell, name):
+    """
+    Cumulative % vaccinated each day from Sep 3 to the end date, among
+    people who had not died before that day (numerator and denominator)
+    """
+    curves = cumulative_uptake(
+        booster[cell], booster["boost_date"], booster["dod"],
+        pd.date_range(start_date, end_date, freq="D"),
+    )
+    curves = curves.rename(columns={"cell": name, "date": "boost_date", "n_at_risk": "boost_sum"})
+    curves["boost_sum"] = rounding(redact(curves["boost_sum"]))
+    curves["total"] = rounding(curves["total"])
+    curves["at_risk"] = rounding(curves["at_risk"])
+    curves["rate"] = curves["boost_sum"] / curves["at_risk"] * 100
+    curves["boost_date"] = curves["boost_date"].dt.date
+
+    # Save from the start of the campaign
+    curves = curves[curves["boost_date"] >= pd.Timestamp("2022-09-06").date()]
+    return curves[[name, "total", "boost_date", "boost_sum", "rate", "at_risk"]]
+
+
+def main():
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    booster = pd.read_csv(
+        Path("output", "cohort", "cohort_final_sep.csv"),
+        usecols=["patient_id", "dob", "dod", "boost_date"],
+        parse_dates=["dob", "dod", "boost_date"],
+    )
+
+    ### Cumulative vaccine uptake by age at Sep 03 (baseline), by day
+    baseline = alive_with_age(booster, start_date)
+    baseline = baseline[(baseline["age_mos"] >= 540) & (baseline["age_mos"] < 660)]
+    baseline = baseline.assign(age_yrs=baseline["age_mos"] // 12,
+                               age_3mos=baseline["age_mos"] // 3)
+
+    daily_curves(baseline, "age_yrs", "age_yrs").to_csv(
+        OUTPUT_DIR / "final_dose4_cum_byage1.csv", index=False)
+    daily_curves(baseline, "age_3mos", "age_3mos").to_csv(
+        OUTPUT_DIR / "final_dose4_cum_byage3mos.csv", index=False)
+
+    ### % vaccinated by age in 3 month intervals at Nov 26
+    at_nov26 = alive_with_age(booster, nov26)
+    at_nov26 = at_nov26.assign(age_3mos=at_nov26["age_mos"] // 3)
+    booster_nov26 = cumulative_uptake(
+        at_nov26["age_3mos"], at_nov26["boost_date"], at_nov26["dod"], [nov26]
+    ).rename(columns={"cell": "age_3mos", "n": "n_boost"})
+    booster_nov26["n_boost"] = rounding(redact(booster_nov26["n_boost"]))
+    booster_nov26["total"] = rounding(booster_nov26["total"])
+    booster_nov26["pcent_boost"] = booster_nov26["n_boost"] / booster_nov26["total"] * 100
+
+    booster_nov26[["age_3mos", "total", "n_boost", "pcent_boost"]].to_csv(
+        OUTPUT_DIR / "final_vax4_age_3months.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+##############################################################################
+#
+# Local backend: columnar patient tables and the operations the study
+# definitions need (codelist matching, event set algebra, population
+# bitmaps, registration/address intervals, emergency care diagnoses),
+# for running extractions against local (e.g. dummy) data (engine.py, with
+# resumable checkpoints in checkpoints.py).
+#
+##############################################################################
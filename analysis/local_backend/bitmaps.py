@@ -0,0 +1,136 @@
+##############################################################################
+#
+# This script provides patient bitmaps for the local backend.
+#
+# Patients are numbered 0..n-1 by a PatientIndex (sorted patient_ids) and
+# a set of patients is a packed bitmap with one bit per patient, so
+# population terms combine with bitwise AND/OR/NOT over n/8 bytes. A
+# population can be saved as a bitmap (for reuse by later definitions) or
+# as a patient_id CSV (for patients.which_exist_in_file()).
+#
+##############################################################################
+
+
+import os
+from pathlib import Path
+
+import numpy as np
+
+
+# Set-bit counts for every byte value
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class PatientIndex:
+    """
+    Dense positions 0..n-1 for a set of patient_ids
+    """
+
+    def __init__(self, patient_ids):
+        self.patient_ids = np.unique(np.asarray(patient_ids, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.patient_ids)
+
+    def positions(self, patient_ids):
+        """
+        Position of each patient_id; raises if any are not in the index
+        """
+        patient_ids = np.asarray(patient_ids, dtype=np.int64)
+        position = np.searchsorted(self.patient_ids, patient_ids)
+        inside = position < len(self.patient_ids)
+        if not (inside.all() and (self.patient_ids[position] == patient_ids).all()):
+            raise KeyError("patient_ids not in the index")
+        return position
+
+
+class Bitmap:
+    def __init__(self, bits, size):
+        self.bits = bits
+        self.size = size
+
+    @classmethod
+    def empty(cls, size):
+        return cls(np.zeros((size + 7) // 8, dtype=np.uint8), size)
+
+    @classmethod
+    def full(cls, size):
+        return ~cls.empty(size)
+
+    @classmethod
+    def from_mask(cls, mask):
+        mask = np.asarray(mask, dtype=bool)
+        return cls(np.packbits(mask, bitorder="little"), len(mask))
+
+    @classmethod
+    def from_positions(cls, positions, size):
+        mask = np.zeros(size, dtype=bool)
+        mask[positions] = True
+        return cls.from_mask(mask)
+
+    def mask(self):
+        return np.unpackbits(self.bits, count=self.size, bitorder="little").astype(bool)
+
+    def positions(self):
+        return np.flatnonzero(self.mask())
+
+    def __len__(self):
+        return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+    def __bool__(self):
+        return bool(self.bits.any())
+
+    def __and__(self, other):
+        return Bitmap(self.bits & other.bits, self.size)
+
+    def __or__(self, other):
+        return Bitmap(self.bits | other.bits, self.size)
+
+    def __sub__(self, other):
+        return Bitmap(self.bits & ~other.bits, self.size)
+
+    def __invert__(self):
+        bits = ~self.bits
+        # Clear the padding bits after the last patient
+        spare = len(bits) * 8 - self.size
+        if spare:
+            bits[-1] &= np.uint8(0xFF >> spare)
+        return Bitmap(bits, self.size)
+
+    def __eq__(self, other):
+        return self.size == other.size and np.array_equal(self.bits, other.bits)
+
+
+#######################################
+# Persisting populations
+#######################################
+
+def save_bitmap(path, bitmap, index):
+    """
+    Save a population bitmap with its patient index (.npz)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.stem}.{os.getpid()}.tmp.npz")
+    np.savez(tmp, patient_ids=index.patient_ids, bits=bitmap.bits, size=bitmap.size)
+    os.replace(tmp, path)
+
+
+def load_bitmap(path):
+    """
+    Returns (Bitmap, PatientIndex)
+    """
+    with np.load(path) as saved:
+        index = PatientIndex(saved["patient_ids"])
+        return Bitmap(saved["bits"], int(saved["size"])), index
+
+
+def write_patient_ids(path, bitmap, index):
+    """
+    Write the population as a patient_id CSV, the format read by
+    patients.which_exist_in_file()
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.savetxt(path, index.patient_ids[bitmap.positions()], fmt="%d",
+               header="patient_id", comments="")
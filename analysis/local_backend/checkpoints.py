@@ -0,0 +1,158 @@
+##############################################################################
+#
+# This script checkpoints local extractions (see engine.py) so that an
+# interrupted extraction can be resumed.
+#
+# Patients are split into chunks (ranges of patient positions) and each
+# chunk's variables into groups: a non-hidden variable and the hidden
+# variables cohortextractor placed before it. A checkpoint directory holds
+#
+#   manifest.json                   what is being extracted (key) and the
+#                                   chunks' patient_id ranges
+#   chunk_00003/group_012/*.npy     the columns of a completed group
+#   chunk_00003/group_012/DONE      written once all its columns are saved
+#   chunk_00003.arrow               the chunk's output rows, once complete
+#
+# Every file is written to a temporary name and renamed, so an interruption
+# leaves either a complete file or none. On resume, chunks with an output
+# file are skipped and other chunks restart from their last DONE group;
+# the checkpoint is only used if its key (study definition, index date,
+# backend files, chunk size) matches.
+#
+##############################################################################
+
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pyarrow as pa
+
+from .tables import fingerprint, load_columns, save_columns
+
+
+MANIFEST = "manifest.json"
+
+
+def checkpoint_key(definitions, index_date, backend_path, chunk_size):
+    digest = hashlib.sha256()
+    for part in (repr(sorted(definitions.items(), key=lambda item: item[0])), index_date,
+                 fingerprint(backend_path), chunk_size):
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+def variable_groups(definitions):
+    """
+    [[name, ...]] with each non-hidden variable last in its group
+    """
+    groups, group = [], []
+    for name, (_, kwargs) in definitions.items():
+        group.append(name)
+        if not kwargs.get("hidden"):
+            groups.append(group)
+            group = []
+    if group:
+        groups.append(group)
+    return groups
+
+
+def write_atomic(path, write):
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+
+class Checkpoint:
+    """
+    Checkpoint directory of one extraction
+    """
+
+    def __init__(self, directory, key, chunks):
+        self.directory = Path(directory)
+        self.key = key
+        # [(start, stop)] patient positions of each chunk
+        self.chunks = chunks
+
+    @classmethod
+    def open(cls, directory, key, patient_id, chunk_size, resume=False):
+        """
+        Resume the checkpoint in `directory` if `resume` and its key
+        matches, otherwise start a new one
+        """
+        directory = Path(directory)
+        manifest_path = directory / MANIFEST
+        if resume and manifest_path.exists():
+            manifest = json.loads(manifest_path.read_text())
+            if manifest["key"] == key:
+                return cls(directory, key, [tuple(chunk) for chunk in manifest["chunks"]])
+            print(f"Checkpoint in {directory} is for a different extraction, starting again")
+
+        if directory.exists():
+            shutil.rmtree(directory)
+        directory.mkdir(parents=True)
+        chunks = [(start, min(start + chunk_size, len(patient_id)))
+                  for start in range(0, len(patient_id), chunk_size)]
+        manifest = {
+            "key": key,
+            "chunks": chunks,
+            "patient_ids": [[int(patient_id[start]), int(patient_id[stop - 1])]
+                            for start, stop in chunks],
+        }
+        write_atomic(manifest_path, lambda tmp: tmp.write_text(json.dumps(manifest, indent=1)))
+        return cls(directory, key, chunks)
+
+    def chunk_dir(self, chunk):
+        return self.directory / f"chunk_{chunk:05d}"
+
+    def part_path(self, chunk):
+        return self.directory / f"chunk_{chunk:05d}.arrow"
+
+    def chunk_done(self, chunk):
+        return self.part_path(chunk).exists()
+
+    def completed_groups(self, chunk, groups):
+        """
+        Columns of the chunk's groups up to the first one not completed
+        """
+        columns, done = {}, 0
+        for number, group in enumerate(groups):
+            group_dir = self.chunk_dir(chunk) / f"group_{number:03d}"
+            if not (group_dir / "DONE").exists():
+                break
+            saved = load_columns(group_dir, mmap=False)
+            columns.update({name: restore(saved[name]) for name in group})
+            done = number + 1
+        return columns, done
+
+    def save_group(self, chunk, number, columns):
+        group_dir = self.chunk_dir(chunk) / f"group_{number:03d}"
+        if group_dir.exists():
+            shutil.rmtree(group_dir)
+        save_columns(group_dir, columns)
+        write_atomic(group_dir / "DONE", lambda tmp: tmp.write_text(""))
+
+    def save_part(self, chunk, table):
+        def write(tmp):
+            with pa.OSFile(str(tmp), "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        write_atomic(self.part_path(chunk), write)
+        # The groups are no longer needed once the chunk's rows are saved
+        shutil.rmtree(self.chunk_dir(chunk), ignore_errors=True)
+
+    def load_part(self, chunk):
+        return pa.ipc.open_file(pa.memory_map(str(self.part_path(chunk)), "r")).read_all()
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def restore(values):
+    """
+    Saved string columns (numpy unicode) back as object arrays
+    """
+    return values.astype(object) if values.dtype.kind == "U" else values
@@ -0,0 +1,198 @@
+##############################################################################
+#
+# This script provides compact, integer-encoded codelists.
+#
+# SNOMED CT and dm+d codes are stored as sorted int64 arrays and CTV3 and
+# ICD-10 codes as sorted fixed-width byte arrays. Categorised codelists
+# (e.g. ethnicity) keep a parallel int8 array of category numbers, with
+# the category labels kept once. Membership and category lookups for any
+# number of event codes are a single searchsorted, with no Python string
+# hashing.
+#
+##############################################################################
+
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+# Systems whose codes are integers
+INTEGER_SYSTEMS = {"snomed", "snomedct", "dmd"}
+
+# Category number for codes that are not in the codelist
+NO_CATEGORY = -1
+
+
+def encode_codes(codes, system):
+    """
+    Codes as an int64 array (SNOMED CT, dm+d) or fixed-width bytes array
+    (other systems). Already-encoded arrays are returned unchanged.
+    """
+    codes = np.asarray(codes)
+    if system in INTEGER_SYSTEMS:
+        if codes.dtype.kind in "iu":
+            return codes.astype(np.int64, copy=False)
+        return np.char.strip(codes.astype(str)).astype(np.int64)
+    if codes.dtype.kind == "S":
+        return codes
+    return np.char.strip(codes.astype(str)).astype(np.bytes_)
+
+
+@dataclass
+class EncodedCodelist:
+    system: str
+    codes: np.ndarray
+    categories: np.ndarray = None
+    labels: list = field(default_factory=list)
+
+    @classmethod
+    def from_codelist(cls, codelist, system=None):
+        """
+        Encode a cohortextractor codelist (or a list of codes, or of
+        (code, category) pairs)
+        """
+        system = system or getattr(codelist, "system", None)
+        items = list(codelist)
+        has_categories = bool(items) and isinstance(items[0], tuple)
+
+        codes = encode_codes([item[0] if has_categories else item for item in items], system)
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        # Drop duplicate codes (combined codelists can repeat them)
+        first = np.ones(len(codes), dtype=bool)
+        first[1:] = codes[1:] != codes[:-1]
+
+        if not has_categories:
+            return cls(system=system, codes=codes[first])
+
+        labels = sorted({str(item[1]) for item in items})
+        if len(labels) > np.iinfo(np.int8).max:
+            raise ValueError(f"Too many categories for an int8 array: {len(labels)}")
+        numbers = {label: i for i, label in enumerate(labels)}
+        categories = np.array([numbers[str(item[1])] for item in items], dtype=np.int8)[order]
+        return cls(system=system, codes=codes[first], categories=categories[first], labels=labels)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def positions(self, values):
+        """
+        Index of each value in the codelist, or -1 if it is not in it
+        """
+        values = encode_codes(values, self.system)
+        if not len(self.codes):
+            return np.full(len(values), -1, dtype=np.int64)
+        position = np.searchsorted(self.codes, values)
+        position = np.minimum(position, len(self.codes) - 1)
+        return np.where(self.codes[position] == values, position, -1)
+
+    def isin(self, values):
+        return self.positions(values) >= 0
+
+    def category(self, values):
+        """
+        Category number (int8) for each value, NO_CATEGORY if not in the
+        codelist; the label for number i is labels[i]
+        """
+        if self.categories is None:
+            raise ValueError("Codelist has no categories")
+        position = self.positions(values)
+        return np.where(position >= 0, self.categories[np.maximum(position, 0)], NO_CATEGORY).astype(np.int8)
+
+    def category_labels(self, values, missing=""):
+        labels = np.array(self.labels + [missing], dtype=object)
+        return labels[self.category(values)]
+
+    def startswith(self, values):
+        """
+        Does each value start with any code in the codelist (prefix
+        matching, as used for ICD-10 diagnoses in hospital admissions)
+        """
+        if self.codes.dtype.kind != "S":
+            raise ValueError(f"Prefix matching needs string codes, not {self.system}")
+        values = encode_codes(values, self.system)
+        lengths = np.char.str_len(self.codes)
+        matched = np.zeros(len(values), dtype=bool)
+        # One exact match per distinct code length, on truncated values
+        for length in np.unique(lengths):
+            prefixes = self.codes[lengths == length]
+            truncated = values.astype(f"S{length}")
+            position = np.minimum(np.searchsorted(prefixes, truncated), len(prefixes) - 1)
+            matched |= prefixes[position] == truncated
+        return matched
+
+
+def encode_module(module):
+    """
+    {name: EncodedCodelist} for every codelist defined in `module` (e.g.
+    analysis/codelists.py)
+    """
+    # Imported here: importing cohortextractor takes over a second, which
+    # extractions restored from a snapshot (see snapshots.py) avoid
+    from cohortextractor.codelistlib import Codelist
+
+    return {
+        name: EncodedCodelist.from_codelist(value)
+        for name, value in vars(module).items()
+        if isinstance(value, Codelist)
+    }
+
+
+#######################################
+# Set algebra
+#######################################
+
+def union(first, *others):
+    """
+    Codes in any of the codelists (as combine_codelists). Codes in more
+    than one categorised codelist must have the same category.
+    """
+    codelists = (first,) + others
+    for other in others:
+        if other.system != first.system:
+            raise ValueError(f"Cannot combine codelists from {first.system} and {other.system}")
+        if (other.categories is None) != (first.categories is None):
+            raise ValueError("Cannot combine categorised and uncategorised codelists")
+
+    codes = np.concatenate([c.codes for c in codelists])
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    first_of_code = np.ones(len(codes), dtype=bool)
+    first_of_code[1:] = codes[1:] != codes[:-1]
+    if first.categories is None:
+        return EncodedCodelist(system=first.system, codes=codes[first_of_code])
+
+    labels = sorted(set().union(*(c.labels for c in codelists)))
+    categories = np.concatenate([
+        np.searchsorted(labels, np.array(c.labels, dtype=object)[c.categories]) for c in codelists
+    ]).astype(np.int8)[order]
+    # Every copy of a code must agree with the first copy
+    code_start = np.flatnonzero(first_of_code)[np.cumsum(first_of_code) - 1]
+    if (categories != categories[code_start]).any():
+        raise ValueError("Inconsistent categorisation between codelists")
+    return EncodedCodelist(system=first.system, codes=codes[first_of_code],
+                           categories=categories[first_of_code], labels=labels)
+
+
+def intersection(first, second):
+    """
+    Codes in both codelists (categories are taken from `first`)
+    """
+    return subset(first, second.isin(first.codes))
+
+
+def difference(first, second):
+    """
+    Codes in `first` that are not in `second`
+    """
+    return subset(first, ~second.isin(first.codes))
+
+
+def subset(codelist, keep):
+    return EncodedCodelist(
+        system=codelist.system,
+        codes=codelist.codes[keep],
+        categories=None if codelist.categories is None else codelist.categories[keep],
+        labels=codelist.labels,
+    )
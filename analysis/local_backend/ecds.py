@@ -0,0 +1,114 @@
+##############################################################################
+#
+# This script provides emergency care (ECDS) attendances for the local
+# backend, as used by patients.attended_emergency_care(
+# with_these_diagnoses=...). Hospital admissions (APCS), with ICD-10
+# diagnoses, use the same layout (system="icd10").
+#
+# Each attendance has a variable number of SNOMED CT diagnosis codes. These
+# are held flattened in one int64 array with per-attendance offsets (CSR
+# layout): the diagnoses of attendance i are codes[offsets[i]:offsets[i+1]].
+# Matching a codelist is then one searchsorted over all diagnoses (or one
+# per code length for ICD-10 prefix matching) followed by a bincount back
+# to attendances, and the matching attendances are an
+# event stream (see events.py), so windows for every index date are
+# searchsorted over the sorted (patient, day) keys.
+#
+##############################################################################
+
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .codelists import encode_codes
+from .events import Events, count_in_windows
+
+
+@dataclass
+class Attendances:
+    patient_id: np.ndarray
+    day: np.ndarray
+    offsets: np.ndarray
+    codes: np.ndarray
+    system: str = "snomed"
+    # Other per-attendance columns, e.g. admission_method
+    values: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.patient_id = np.asarray(self.patient_id, dtype=np.int64)
+        self.day = np.asarray(self.day, dtype=np.int32)
+        self.offsets = np.asarray(self.offsets, dtype=np.int64)
+        self.codes = encode_codes(self.codes, self.system)
+        self.values = {name: np.asarray(value) for name, value in self.values.items()}
+        if len(self.offsets) != len(self.patient_id) + 1:
+            raise ValueError("Need one offset per attendance plus the end offset")
+
+        # Sort attendances by (patient, day), moving their diagnoses with them
+        events = Events(self.patient_id, self.day, np.arange(len(self.patient_id)))
+        order = events.code
+        if (order != np.arange(len(order))).any():
+            lengths = np.diff(self.offsets)[order]
+            offsets = np.concatenate([[0], np.cumsum(lengths)])
+            # Old position of each diagnosis in the new order
+            within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+            self.codes = self.codes[np.repeat(self.offsets[:-1][order], lengths) + within]
+            self.offsets = offsets
+            self.patient_id = events.patient_id
+            self.day = events.day
+            self.values = {name: value[order] for name, value in self.values.items()}
+        self.events = Events(self.patient_id, self.day, np.arange(len(self.patient_id)))
+
+    @classmethod
+    def from_lists(cls, patient_id, day, diagnoses, system="snomed", values=None):
+        """
+        Build from one list (or array) of diagnosis codes per attendance
+        """
+        lengths = np.array([len(codes) for codes in diagnoses], dtype=np.int64)
+        codes = [encode_codes(codes, system) for codes in diagnoses if len(codes)]
+        codes = np.concatenate(codes) if codes else encode_codes([], system)
+        return cls(patient_id, day, np.concatenate([[0], np.cumsum(lengths)]), codes,
+                   system=system, values=values or {})
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    def attendance_of_code(self):
+        """
+        Attendance number of each flattened diagnosis
+        """
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def with_diagnoses(self, codelist):
+        """
+        Does each attendance have any diagnosis in `codelist` (an
+        EncodedCodelist); ICD-10 codes match by prefix
+        """
+        if self.codes.dtype.kind == "S":
+            matched = codelist.startswith(self.codes)
+        else:
+            matched = codelist.isin(self.codes)
+        return np.bincount(self.attendance_of_code()[matched], minlength=len(self)) > 0
+
+    def matching(self, codelist=None, keep=None):
+        """
+        Attendances (as events, with the attendance number as code) with a
+        diagnosis in `codelist`, or all attendances, and optionally only
+        those flagged in `keep`
+        """
+        if keep is None:
+            keep = np.ones(len(self), dtype=bool)
+        if codelist is not None:
+            keep = keep & self.with_diagnoses(codelist)
+        return self.events.take(keep)
+
+    def attended_between(self, patient_id, start, end, codelist=None):
+        """
+        Binary flag: any (matching) attendance with start <= day <= end.
+        Patient and day arrays broadcast, e.g. patient_id[:, None] against
+        one start and end day per index date.
+        """
+        patient_id, start, end = np.broadcast_arrays(patient_id, start, end)
+        counts = count_in_windows(self.matching(codelist), patient_id.ravel(),
+                                  start.ravel(), end.ravel())
+        return (counts > 0).reshape(patient_id.shape)
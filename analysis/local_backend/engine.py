@@ -0,0 +1,620 @@
+##############################################################################
+#
+# This script evaluates study definition variables against the local
+# backend (see tables.py).
+#
+# Variables are taken from StudyDefinition.covariate_definitions, where
+# cohortextractor has already flattened nested variables (hidden) ahead of
+# the variables that use them and evaluated date expressions for the index
+# date. Each variable is computed for a set of patients (positions in the
+# backend's patient table) as one numpy array:
+#
+#   date   int32 days (see events.py), NO_DAY when missing
+#   bool   bool
+#   int    int64 (0 when missing)
+#   float  float64 (0 when missing)
+#   str    object array of str ("" when missing)
+#
+# Dates in `between` may refer to other variables, e.g.
+# "covid_vax_1_date + 1 days"; those bounds are per patient.
+#
+# A variable that an expression or date bound needs before it has been
+# evaluated is evaluated then, only for the patients asked for (see
+# Extraction.partial). With compiled expressions this is how each term of
+# the population is only evaluated for the patients still in question.
+#
+##############################################################################
+
+
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .bitmaps import Bitmap
+from .codelists import EncodedCodelist
+from .events import MAX_DAY, NO_DAY, count_in_windows, first_in_windows, from_day, last_in_windows, \
+    sorted_isin, to_day
+from .expressions import Evaluator, evaluate_reference, names, parse
+from .scans import SharedScans
+from .tables import clinical_table
+
+
+DATE_REFERENCE = re.compile(r"^\s*([A-Za-z_]\w*)\s*(?:([+-])\s*(\d+)\s*days?)?\s*$")
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# Values of unmatched patients, by column type
+MISSING = {"date": NO_DAY, "bool": False, "int": 0, "float": 0.0, "str": ""}
+
+DTYPES = {"date": np.int32, "bool": bool, "int": np.int64, "float": np.float64, "str": object}
+
+
+def empty_column(column_type, size):
+    return np.full(size, MISSING[column_type], dtype=DTYPES[column_type])
+
+
+def year_month_day(days):
+    dates = from_day(days).astype("datetime64[D]")
+    years = dates.astype("datetime64[Y]").astype(np.int64) + 1970
+    months = dates.astype("datetime64[M]").astype(np.int64) % 12 + 1
+    day = (dates - dates.astype("datetime64[M]")).astype(np.int64) + 1
+    return years, months, day
+
+
+def apply_date_format(days, date_format):
+    """
+    Dates truncated to the month (YYYY-MM) or year (YYYY), as returned by
+    cohortextractor
+    """
+    if date_format in (None, "YYYY-MM-DD"):
+        return days
+    unit = {"YYYY-MM": "M", "YYYY": "Y"}[date_format]
+    truncated = to_day(from_day(days).astype(f"datetime64[{unit}]").astype("datetime64[D]"))
+    return np.where(days == NO_DAY, NO_DAY, truncated).astype(np.int32)
+
+
+#######################################
+# Extraction
+#######################################
+
+class Extraction:
+    """
+    Variables of one study definition for the patients at `positions` in
+    `backend` (default all patients)
+    """
+
+    def __init__(self, backend, definitions, positions=None, shared=None, compiled=True):
+        self.backend = backend
+        self.definitions = definitions
+        self.positions = np.arange(len(backend)) if positions is None else np.asarray(positions)
+        self.patient_id = backend.patient_id[self.positions]
+        self.columns = {}
+        # Encoded codelists, files and the records matching each codelist,
+        # which extractions of other chunks and index dates can share (see
+        # scans.py)
+        self.shared = SharedScans() if shared is None else shared
+        # Expressions as compiled bitmap evaluation (expressions.Evaluator),
+        # or evaluated term by term for everyone (the reference)
+        self.compiled = compiled
+        # {name: (values, evaluated)} of variables evaluated for some
+        # patients only, with one lock per variable (see partial)
+        self.partials = {}
+        self.partial_locks = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def evaluate(self, name):
+        query_type, kwargs = self.definitions[name]
+        kwargs = {key: value for key, value in kwargs.items()
+                  if key not in ("hidden", "return_expectations")}
+        column_type = kwargs.pop("column_type")
+        query = getattr(self, f"query_{query_type}", None)
+        if query is None:
+            raise ValueError(f"{query_type} is not supported by the local backend ({name})")
+        values = query(column_type=column_type, **kwargs)
+        if column_type == "date":
+            values = apply_date_format(values, kwargs.get("date_format"))
+        self.columns[name] = values
+        return values
+
+    def evaluate_all(self, names=None):
+        for name in names or self.definitions:
+            self.evaluate(name)
+        return self.columns
+
+    def members(self, keep):
+        """
+        Extraction of the patients where `keep` (a mask or positions)
+        selects, with the variables evaluated so far for all of them (see
+        expand)
+        """
+        members = Extraction(self.backend, self.definitions, self.positions[keep],
+                             shared=self.shared, compiled=self.compiled)
+        members.columns = {name: values[keep] for name, values in self.columns.items()}
+        for name, (values, evaluated) in list(self.partials.items()):
+            if name not in members.columns and evaluated[keep].all():
+                members.columns[name] = values[keep]
+        return members
+
+    def expand(self, members, keep, name):
+        """
+        Take variable `name` from `members` (see members), missing for the
+        other patients
+        """
+        values = empty_column(self.definitions[name][1]["column_type"], len(self))
+        values[keep] = members.columns[name]
+        self.columns[name] = values
+        return values
+
+    def partial(self, name, positions):
+        """
+        Variable `name` for the patients at `positions`, evaluated (with
+        the variables it refers to) only for those it has not been
+        evaluated for yet
+        """
+        if name not in self.definitions:
+            raise ValueError(f"Unknown variable: {name}")
+        lock = self.partial_locks.setdefault(name, threading.Lock())
+        with lock:
+            if name not in self.partials:
+                column_type = self.definitions[name][1]["column_type"]
+                self.partials[name] = (empty_column(column_type, len(self)), np.zeros(len(self), dtype=bool))
+            values, evaluated = self.partials[name]
+            todo = positions[~evaluated[positions]]
+            if len(todo):
+                values[todo] = self.members(todo).evaluate(name)
+                evaluated[todo] = True
+            return values[positions]
+
+    def column(self, name):
+        """
+        Variable `name` for every patient, evaluated now if it has not been
+        """
+        if name in self.columns:
+            return self.columns[name]
+        return self.partial(name, np.arange(len(self)))
+
+    #######################################
+    # Helpers
+    #######################################
+
+    def encoded(self, codelist):
+        return self.shared.get("codelists", id(codelist),
+                               lambda: (codelist, EncodedCodelist.from_codelist(codelist)))[1]
+
+    def matched(self, key, match):
+        """
+        Records returned by `match()`, computed once per key
+        """
+        return self.shared.get("matches", key, match)
+
+    def day(self, value, default):
+        """
+        A date bound as days: a scalar for fixed dates (or `default` for
+        None), or one day per patient for dates that refer to a variable
+        """
+        if value is None:
+            return default
+        if ISO_DATE.match(str(value)):
+            return int(to_day([value])[0])
+        match = DATE_REFERENCE.match(str(value))
+        if not match or match.group(1) not in self.definitions:
+            raise ValueError(f"Unsupported date expression: {value}")
+        days = self.column(match.group(1)).astype(np.int64)
+        offset = int(match.group(3) or 0) * (-1 if match.group(2) == "-" else 1)
+        return np.where(days == NO_DAY, NO_DAY, days + offset)
+
+    def window(self, between=None, on_or_before=None, on_or_after=None):
+        between = between or (None, None)
+        start = self.day(on_or_after or between[0], 0)
+        end = self.day(on_or_before or between[1], MAX_DAY)
+        return start, end
+
+    def patients_column(self, name):
+        return self.backend.patients[name][self.positions]
+
+    def from_events(self, events, start, end, returning, find_first_match_in_period=None,
+                    find_last_match_in_period=None, codelist=None, column_type="bool"):
+        """
+        Shared by the event-based queries: a flag, count, date or code
+        category of the patients' events within start..end
+        """
+        if returning == "number_of_episodes":
+            # Episodes group events separated by fewer than
+            # episode_defined_as days, which is not implemented
+            raise ValueError("returning=number_of_episodes is not supported by the local backend")
+        if returning in ("binary_flag", "number_of_matches_in_period"):
+            counts = count_in_windows(events, self.patient_id, start, end)
+            return counts > 0 if returning == "binary_flag" else counts.astype(np.int64)
+
+        if find_first_match_in_period:
+            position = first_in_windows(events, self.patient_id, start, end)
+        else:
+            position = last_in_windows(events, self.patient_id, start, end)
+        found = position >= 0
+        values = empty_column(column_type, len(self))
+        if returning.startswith("date"):
+            values[found] = events.day[position[found]]
+        elif returning == "category":
+            values[found] = codelist.category_labels(events.code[position[found]])
+        elif returning == "code":
+            values[found] = events.code[position[found]].astype(str)
+        else:
+            raise ValueError(f"Unsupported returning: {returning}")
+        return values
+
+    def categorise(self, category_definitions, column_type, column=None):
+        """
+        First category whose expression is true for each patient, or the
+        DEFAULT category
+        """
+        column = column or self.expression_column
+        default = MISSING[column_type]
+        values = empty_column(column_type, len(self))
+        remaining = Bitmap.full(len(self))
+        evaluator = Evaluator(column, len(self))
+        for category, expression in category_definitions.items():
+            if str(expression).strip() == "DEFAULT":
+                default = category
+                continue
+            if self.compiled:
+                matched = evaluator.evaluate(parse(expression), remaining)
+            else:
+                matched = Bitmap.from_mask(evaluate_reference(parse(expression), column, len(self))) \
+                    & remaining
+            values[matched.mask()] = self.category_value(category, column_type)
+            remaining = remaining - matched
+        values[remaining.mask()] = self.category_value(default, column_type)
+        return values
+
+    @staticmethod
+    def category_value(category, column_type):
+        if column_type == "bool":
+            return bool(int(category))
+        if column_type == "int":
+            return int(category)
+        if column_type == "float":
+            return float(category)
+        return str(category)
+
+    def expression_column(self, name, positions):
+        """
+        Values of a variable as used in expressions (dates as datetime64,
+        so missing dates are false), evaluated only for `positions` if it
+        has not been evaluated yet
+        """
+        if name in self.columns:
+            values = self.columns[name][positions]
+        else:
+            values = self.partial(name, positions)
+        if self.definitions[name][1]["column_type"] == "date":
+            return from_day(values)
+        return values
+
+    def read_file(self, f_path):
+        return self.shared.get("files", f_path,
+                               lambda: pd.read_csv(f_path, dtype=str, keep_default_na=False))
+
+    def file_rows(self, f_path):
+        """
+        Row in `f_path` of each patient (-1 if absent)
+        """
+        ids = self.read_file(f_path)["patient_id"].astype(np.int64).to_numpy()
+        order = np.argsort(ids, kind="stable")
+        rows = np.full(len(self), -1, dtype=np.int64)
+        if not len(ids):
+            return rows
+        position = np.minimum(np.searchsorted(ids[order], self.patient_id), len(ids) - 1)
+        found = ids[order][position] == self.patient_id
+        rows[found] = order[position[found]]
+        return rows
+
+    #######################################
+    # Demographics
+    #######################################
+
+    def query_age_as_of(self, reference_date, column_type, **kwargs):
+        dob = self.patients_column("dob")
+        year, month, day = year_month_day(dob)
+        ref_year, ref_month, ref_day = year_month_day(np.atleast_1d(self.day(reference_date, 0)))
+        before_birthday = (ref_month < month) | ((ref_month == month) & (ref_day < day))
+        age = ref_year - year - before_birthday
+        return np.where(dob == NO_DAY, 0, age).astype(np.int64)
+
+    def query_date_of_birth(self, column_type, **kwargs):
+        return self.patients_column("dob").astype(np.int32)
+
+    def query_sex(self, column_type, **kwargs):
+        return self.patients_column("sex").astype(object)
+
+    #######################################
+    # Deaths
+    #######################################
+
+    def death_in_window(self, between=None, on_or_before=None, on_or_after=None):
+        start, end = self.window(between, on_or_before, on_or_after)
+        dod = self.patients_column("dod").astype(np.int64)
+        return (dod != NO_DAY) & (dod >= start) & (dod <= end) & (np.asarray(start) != NO_DAY) \
+            & (np.asarray(end) != NO_DAY)
+
+    def death_values(self, died, returning, column_type):
+        if returning == "binary_flag":
+            return died
+        values = empty_column(column_type, len(self))
+        if returning == "date_of_death":
+            values[died] = self.patients_column("dod")[died]
+        elif returning == "underlying_cause_of_death":
+            values[died] = self.patients_column("death_cause")[died].astype(str)
+        else:
+            raise ValueError(f"Unsupported returning: {returning}")
+        return values
+
+    def query_died_from_any_cause(self, column_type, returning="binary_flag", between=None,
+                                  on_or_before=None, on_or_after=None, **kwargs):
+        died = self.death_in_window(between, on_or_before, on_or_after)
+        return self.death_values(died, returning, column_type)
+
+    def query_with_these_codes_on_death_certificate(self, codelist, column_type, returning="binary_flag",
+                                                    between=None, on_or_before=None, on_or_after=None,
+                                                    match_only_underlying_cause=False, **kwargs):
+        died = self.death_in_window(between, on_or_before, on_or_after)
+        encoded = self.encoded(codelist)
+        if match_only_underlying_cause:
+            matched = encoded.isin(self.patients_column("death_cause").astype(str))
+        else:
+            causes = self.matched(("death_causes", id(codelist)),
+                                  lambda: self.backend.death_causes.matching(encoded))
+            matched = count_in_windows(causes, self.patient_id, 0, MAX_DAY) > 0
+        return self.death_values(died & matched, returning, column_type)
+
+    #######################################
+    # Registrations and addresses
+    #######################################
+
+    def query_registered_as_of(self, reference_date, column_type, **kwargs):
+        return self.backend.registrations.covering(self.patient_id, self.day(reference_date, 0))
+
+    def query_registered_with_one_practice_between(self, start_date, end_date, column_type, **kwargs):
+        return self.backend.registrations.covering_between(
+            self.patient_id, self.day(start_date, 0), self.day(end_date, MAX_DAY)
+        )
+
+    def query_registered_practice_as_of(self, date, returning, column_type, **kwargs):
+        if returning != "nuts1_region_name":
+            raise ValueError(f"Unsupported returning: {returning}")
+        region = self.backend.registrations.value_as_of("region", self.patient_id, self.day(date, 0),
+                                                        missing="")
+        return region.astype(str).astype(object)
+
+    def query_address_as_of(self, date, returning, column_type, round_to_nearest=None, **kwargs):
+        if returning != "index_of_multiple_deprivation":
+            raise ValueError(f"Unsupported returning: {returning}")
+        imd = self.backend.addresses.value_as_of("imd", self.patient_id, self.day(date, 0), missing=0)
+        imd = imd.astype(np.int64)
+        if round_to_nearest:
+            imd = (np.round(imd / round_to_nearest) * round_to_nearest).astype(np.int64)
+        return imd
+
+    def query_care_home_status_as_of(self, date, column_type, categorised_as=None, **kwargs):
+        day = self.day(date, 0)
+        addresses = self.backend.addresses
+        position = addresses.position_as_of(self.patient_id, day)
+        found = position >= 0
+
+        def flag(name):
+            values = np.zeros(len(self), dtype=bool)
+            values[found] = addresses.values[name][position[found]].astype(bool)
+            return values
+
+        care_home, nursing = flag("care_home"), flag("nursing")
+        columns = {
+            "IsPotentialCareHome": care_home,
+            "LocationRequiresNursing": care_home & nursing,
+            "LocationDoesNotRequireNursing": care_home & ~nursing,
+        }
+        categorised_as = categorised_as or {1: "IsPotentialCareHome", 0: "DEFAULT"}
+        return self.categorise(categorised_as, column_type,
+                               column=lambda name, positions: columns[name][positions])
+
+    #######################################
+    # Events
+    #######################################
+
+    def query_with_these_clinical_events(self, codelist, column_type, returning="binary_flag",
+                                         between=None, on_or_before=None, on_or_after=None,
+                                         ignore_days_where_these_codes_occur=None, **kwargs):
+        encoded = self.encoded(codelist)
+        stream = self.backend.clinical_events(encoded.system)
+        ignored = ignore_days_where_these_codes_occur
+
+        def match():
+            keep = encoded.isin(stream.code)
+            if ignored is not None:
+                days = stream.matching(self.encoded(ignored))
+                keep &= ~sorted_isin(stream.keys, np.unique(days.keys))
+            return keep, stream.take(keep)
+
+        keep, events = self.matched((clinical_table(encoded.system), id(codelist), id(ignored)), match)
+        start, end = self.window(between, on_or_before, on_or_after)
+        if returning != "numeric_value":
+            return self.from_events(events, start, end, returning, codelist=encoded,
+                                    column_type=column_type, **event_options(kwargs))
+
+        # Values are held alongside the events, so keep the event positions
+        values = self.backend.event_values[clinical_table(encoded.system)]["numeric_value"]
+        if kwargs.get("ignore_missing_values"):
+            keep = keep & (np.nan_to_num(values.astype(np.float64)) != 0)
+        kept = np.flatnonzero(keep)
+        if kwargs.get("find_first_match_in_period"):
+            position = first_in_windows(stream.take(kept), self.patient_id, start, end)
+        else:
+            position = last_in_windows(stream.take(kept), self.patient_id, start, end)
+        found = position >= 0
+        result = empty_column(column_type, len(self))
+        result[found] = values[kept[position[found]]]
+        return result
+
+    def query_with_these_medications(self, codelist, column_type, returning="binary_flag",
+                                     between=None, on_or_before=None, on_or_after=None,
+                                     ignore_days_where_these_codes_occur=None, **kwargs):
+        encoded = self.encoded(codelist)
+        ignored = ignore_days_where_these_codes_occur
+
+        def match():
+            events = self.backend.medications.matching(encoded)
+            if ignored is not None:
+                events = events.without_days_of(self.backend.medications.matching(self.encoded(ignored)))
+            return events
+
+        events = self.matched(("medications", id(codelist), id(ignored)), match)
+        start, end = self.window(between, on_or_before, on_or_after)
+        return self.from_events(events, start, end, returning, codelist=encoded,
+                                column_type=column_type, **event_options(kwargs))
+
+    def query_with_tpp_vaccination_record(self, column_type, target_disease_matches=None,
+                                          product_name_matches=None, returning="binary_flag",
+                                          between=None, on_or_before=None, on_or_after=None, **kwargs):
+        if product_name_matches is not None:
+            raise ValueError("product_name_matches is not supported by the local backend")
+        vaccinations = self.backend.vaccinations
+        targets = [target_disease_matches] if isinstance(target_disease_matches, str) \
+            else list(target_disease_matches or [])
+
+        def match():
+            if not targets:
+                return vaccinations
+            return vaccinations.take(np.isin(vaccinations.code.astype(str), targets))
+
+        events = self.matched(("vaccinations", tuple(targets)), match)
+        start, end = self.window(between, on_or_before, on_or_after)
+        return self.from_events(events, start, end, returning,
+                                column_type=column_type, **event_options(kwargs))
+
+    def query_with_healthcare_worker_flag_on_covid_vaccine_record(self, column_type, **kwargs):
+        return np.isin(self.patient_id, self.backend.hscworker)
+
+    #######################################
+    # Hospital
+    #######################################
+
+    def query_admitted_to_hospital(self, column_type, returning="binary_flag", between=None,
+                                   on_or_before=None, on_or_after=None, with_these_diagnoses=None,
+                                   with_these_primary_diagnoses=None, with_admission_method=None,
+                                   with_patient_classification=None, with_these_procedures=None,
+                                   **kwargs):
+        if with_these_procedures is not None:
+            raise ValueError("with_these_procedures is not supported by the local backend")
+        admissions = self.backend.admissions
+        methods = as_tuple(with_admission_method)
+        classifications = as_tuple(with_patient_classification)
+
+        def match():
+            keep = np.ones(len(admissions), dtype=bool)
+            if methods is not None:
+                keep &= np.isin(admissions.values["admission_method"].astype(str), methods)
+            if classifications is not None:
+                keep &= np.isin(admissions.values["patient_classification"].astype(str), classifications)
+            if with_these_primary_diagnoses is not None:
+                primary = self.encoded(with_these_primary_diagnoses)
+                keep &= primary.startswith(admissions.values["primary_diagnosis"])
+            codelist = self.encoded(with_these_diagnoses) if with_these_diagnoses is not None else None
+            return admissions.matching(codelist, keep)
+
+        key = ("admissions", methods, classifications, id(with_these_primary_diagnoses),
+               id(with_these_diagnoses))
+        events = self.matched(key, match)
+        start, end = self.window(between, on_or_before, on_or_after)
+        return self.from_events(events, start, end,
+                                "date" if returning == "date_admitted" else returning,
+                                column_type=column_type, **event_options(kwargs))
+
+    def query_attended_emergency_care(self, column_type, returning="binary_flag", between=None,
+                                      on_or_before=None, on_or_after=None, with_these_diagnoses=None,
+                                      discharged_to=None, **kwargs):
+        if discharged_to is not None:
+            raise ValueError("discharged_to is not supported by the local backend")
+        codelist = self.encoded(with_these_diagnoses) if with_these_diagnoses is not None else None
+        events = self.matched(("emergency_care", id(with_these_diagnoses)),
+                              lambda: self.backend.emergency_care.matching(codelist))
+        start, end = self.window(between, on_or_before, on_or_after)
+        return self.from_events(events, start, end,
+                                "date" if returning == "date_arrived" else returning,
+                                column_type=column_type, **event_options(kwargs))
+
+    #######################################
+    # Files and expressions
+    #######################################
+
+    def query_with_value_from_file(self, f_path, returning, returning_type, column_type, **kwargs):
+        rows = self.file_rows(f_path)
+        found = rows >= 0
+        raw = self.read_file(f_path)[returning].to_numpy()[rows[found]]
+        values = empty_column(column_type, len(self))
+        if column_type == "date":
+            raw = np.where(raw == "", "NaT", raw)
+            values[found] = to_day(pd.to_datetime(raw, errors="coerce").to_numpy())
+        elif column_type in ("int", "float"):
+            numbers = np.nan_to_num(pd.to_numeric(raw, errors="coerce").astype(np.float64))
+            values[found] = numbers.astype(values.dtype)
+        elif column_type == "bool":
+            values[found] = np.isin(raw, ["1", "True", "TRUE", "true"])
+        else:
+            values[found] = raw
+        return values
+
+    def query_which_exist_in_file(self, f_path, column_type, **kwargs):
+        return self.file_rows(f_path) >= 0
+
+    def query_categorised_as(self, category_definitions, column_type, **kwargs):
+        return self.categorise(category_definitions, column_type)
+
+
+def as_tuple(values):
+    if values is None:
+        return None
+    return (values,) if isinstance(values, str) else tuple(values)
+
+
+def event_options(kwargs):
+    return {
+        key: kwargs[key]
+        for key in ("find_first_match_in_period", "find_last_match_in_period")
+        if kwargs.get(key)
+    }
+
+
+def dependencies(definitions, name):
+    """
+    Other variables that variable `name` refers to: in its expressions or
+    in its date bounds
+    """
+    query_type, kwargs = definitions[name]
+    used = set()
+    expressions = kwargs.get("category_definitions") or {}
+    for expression in expressions.values():
+        if str(expression).strip() != "DEFAULT":
+            used |= names(parse(expression))
+    for key in ("between", "on_or_before", "on_or_after", "start_date", "end_date",
+                "reference_date", "date"):
+        values = kwargs.get(key)
+        for value in values if isinstance(values, (list, tuple)) else [values]:
+            match = DATE_REFERENCE.match(str(value)) if value is not None else None
+            if match and not ISO_DATE.match(str(value)):
+                used.add(match.group(1))
+    return sorted(used & set(definitions))
+
+
+def required(definitions, name):
+    """
+    Variable `name` and every variable it refers to, directly or not
+    """
+    needed, todo = set(), [name]
+    while todo:
+        current = todo.pop()
+        if current not in needed:
+            needed.add(current)
+            todo += dependencies(definitions, current)
+    return needed
@@ -0,0 +1,223 @@
+##############################################################################
+#
+# This script provides event streams (e.g. clinical events, medications)
+# for the local backend and the operations the study definitions use on
+# them.
+#
+# Events are held as parallel arrays sorted by (patient, day), where day
+# is the number of days since DAY_ZERO. Each (patient, day) pair is also
+# packed into one int64 key, so "same day" exclusions are a sorted-key
+# membership test and per-patient window queries against another sorted
+# stream are a merge of the two key sequences (searchsorted), all linear
+# or n log n in the number of events.
+#
+##############################################################################
+
+
+from dataclasses import dataclass
+
+import numpy as np
+
+
+DAY_ZERO = np.datetime64("1900-01-01", "D")
+
+# Days are stored in the low bits of the key (2^21 days is over 5,000 years)
+DAY_BITS = 21
+
+# Day used for missing dates
+NO_DAY = -1
+
+# Latest day that fits in a key, used for open-ended windows
+MAX_DAY = (1 << DAY_BITS) - 1
+
+
+#######################################
+# Days and keys
+#######################################
+
+def to_day(dates):
+    """
+    Dates (datetime64, strings or a pandas Series) as int32 days since
+    DAY_ZERO; missing dates become NO_DAY
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    days = (dates - DAY_ZERO).astype(np.int64)
+    return np.where(np.isnat(dates), NO_DAY, days).astype(np.int32)
+
+
+def from_day(days):
+    days = np.asarray(days)
+    dates = DAY_ZERO + days.astype("timedelta64[D]")
+    return np.where(days == NO_DAY, np.datetime64("NaT"), dates)
+
+
+def day_keys(patient_id, day):
+    """
+    (patient, day) packed into sortable int64 keys
+    """
+    patient_id = np.asarray(patient_id, dtype=np.int64)
+    day = np.asarray(day, dtype=np.int64)
+    return (patient_id << DAY_BITS) | day
+
+
+def sorted_isin(values, sorted_values):
+    """
+    Membership test against an already sorted array
+    """
+    if not len(sorted_values):
+        return np.zeros(len(values), dtype=bool)
+    position = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[position] == values
+
+
+#######################################
+# Event streams
+#######################################
+
+@dataclass
+class Events:
+    patient_id: np.ndarray
+    day: np.ndarray
+    code: np.ndarray
+
+    def __post_init__(self):
+        self.patient_id = np.asarray(self.patient_id, dtype=np.int64)
+        self.day = np.asarray(self.day, dtype=np.int32)
+        self.code = np.asarray(self.code)
+        self.keys = day_keys(self.patient_id, self.day)
+        if len(self.keys) > 1 and (self.keys[1:] < self.keys[:-1]).any():
+            order = np.argsort(self.keys, kind="stable")
+            self.patient_id = self.patient_id[order]
+            self.day = self.day[order]
+            self.code = self.code[order]
+            self.keys = self.keys[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def take(self, keep):
+        # Subsets of a sorted stream are still sorted
+        events = Events.__new__(Events)
+        events.patient_id = self.patient_id[keep]
+        events.day = self.day[keep]
+        events.code = self.code[keep]
+        events.keys = self.keys[keep]
+        return events
+
+    def matching(self, codelist):
+        """
+        Events with a code in `codelist` (an EncodedCodelist)
+        """
+        return self.take(codelist.isin(self.code))
+
+    def between(self, start=None, end=None):
+        """
+        Events on or after `start` and on or before `end` (days; scalars or
+        one value per event, e.g. from a per-patient date)
+        """
+        keep = np.ones(len(self), dtype=bool)
+        if start is not None:
+            keep &= self.day >= start
+        if end is not None:
+            keep &= self.day <= end
+        return self.take(keep)
+
+    def without_days_of(self, other):
+        """
+        Drop events on a day when the same patient has an event in `other`
+        (ignore_days_where_these_codes_occur)
+        """
+        return self.take(~sorted_isin(self.keys, np.unique(other.keys)))
+
+    def first_per_patient(self):
+        """
+        (patient_id, day, code) of each patient's first event
+        """
+        patients, first = np.unique(self.patient_id, return_index=True)
+        return patients, self.day[first], self.code[first]
+
+    def last_per_patient(self):
+        patients, first = np.unique(self.patient_id[::-1], return_index=True)
+        last = len(self) - 1 - first
+        return patients, self.day[last], self.code[last]
+
+    def count_per_patient(self):
+        return np.unique(self.patient_id, return_counts=True)
+
+
+#######################################
+# Joins
+#######################################
+
+def count_in_windows(events, patient_id, start, end):
+    """
+    Number of `events` for each query patient with start <= day <= end.
+
+    Queries are (patient, day) keys like the events, so both sides are
+    sorted key streams and each window is found by merging the query
+    bounds into the event keys. Missing bounds (NO_DAY) give zero.
+    """
+    patient_id = np.asarray(patient_id, dtype=np.int64)
+    start = np.asarray(start, dtype=np.int64) * np.ones(len(patient_id), dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) * np.ones(len(patient_id), dtype=np.int64)
+
+    lower = np.searchsorted(events.keys, day_keys(patient_id, np.maximum(start, 0)), side="left")
+    upper = np.searchsorted(events.keys, day_keys(patient_id, np.maximum(end, 0)), side="right")
+    counts = np.maximum(upper - lower, 0)
+    return np.where((start == NO_DAY) | (end == NO_DAY) | (end < start), 0, counts)
+
+
+def last_on_or_before(events, patient_id, day):
+    """
+    Day of each query patient's last event on or before `day` (NO_DAY if
+    none), e.g. the latest housebound code before the index date
+    """
+    patient_id = np.asarray(patient_id, dtype=np.int64)
+    day = np.asarray(day, dtype=np.int64) * np.ones(len(patient_id), dtype=np.int64)
+    if not len(events):
+        return np.full(len(patient_id), NO_DAY, dtype=np.int32)
+
+    position = np.searchsorted(events.keys, day_keys(patient_id, np.maximum(day, 0)), side="right") - 1
+    found = (position >= 0) & (day != NO_DAY)
+    position = np.maximum(position, 0)
+    found &= events.patient_id[position] == patient_id
+    return np.where(found, events.day[position], NO_DAY).astype(np.int32)
+
+
+def first_in_windows(events, patient_id, start, end):
+    """
+    Position of each query patient's first event with start <= day <= end
+    (-1 if none)
+    """
+    patient_id, start, end = windows(patient_id, start, end)
+    if not len(events):
+        return np.full(len(patient_id), -1, dtype=np.int64)
+    position = np.searchsorted(events.keys, day_keys(patient_id, np.maximum(start, 0)), side="left")
+    found = position < len(events)
+    position = np.minimum(position, len(events) - 1)
+    found &= (events.patient_id[position] == patient_id) & (events.day[position] <= end)
+    found &= (start != NO_DAY) & (end != NO_DAY)
+    return np.where(found, position, -1)
+
+
+def last_in_windows(events, patient_id, start, end):
+    """
+    Position of each query patient's last event with start <= day <= end
+    (-1 if none)
+    """
+    patient_id, start, end = windows(patient_id, start, end)
+    if not len(events):
+        return np.full(len(patient_id), -1, dtype=np.int64)
+    position = np.searchsorted(events.keys, day_keys(patient_id, np.maximum(end, 0)), side="right") - 1
+    found = position >= 0
+    position = np.maximum(position, 0)
+    found &= (events.patient_id[position] == patient_id) & (events.day[position] >= start)
+    found &= (start != NO_DAY) & (end != NO_DAY)
+    return np.where(found, position, -1)
+
+
+def windows(patient_id, start, end):
+    patient_id = np.asarray(patient_id, dtype=np.int64)
+    start = np.asarray(start, dtype=np.int64) * np.ones(len(patient_id), dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64) * np.ones(len(patient_id), dtype=np.int64)
+    return patient_id, start, end
@@ -0,0 +1,337 @@
+##############################################################################
+#
+# This script evaluates cohortextractor expressions (as used in
+# patients.satisfying() and patients.categorised_as()) over patient
+# bitmaps.
+#
+# Supported syntax: AND, OR, NOT, parentheses, comparisons
+# (= != < <= > >=) and arithmetic (+ - * /) between variables, numbers and
+# quoted strings. A bare variable is true when it is non-zero / non-empty.
+#
+# Boolean terms are evaluated as bitmaps (see bitmaps.py), each term only
+# for the patients still in question: the terms of an AND are evaluated on
+# the survivors of the previous terms, and stop as soon as no one is left.
+# Terms are ordered by selectivity, measured on a sample of the
+# candidates: the term true for the fewest first in an AND (e.g. the age
+# range of the baseline population), the term true for the most first in
+# an OR. Variables are requested only for the patients still in question,
+# so a term's variable that has not been evaluated yet is only evaluated
+# for them (see engine.Extraction.partial).
+#
+##############################################################################
+
+
+import re
+
+import numpy as np
+
+from .bitmaps import Bitmap
+
+
+TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<number>\d+(?:\.\d+)?)
+      | (?P<string>"[^"]*"|'[^']*')
+      | (?P<op><=|>=|!=|=|<|>|\+|-|\*|/|\(|\))
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""",
+    re.VERBOSE,
+)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+
+COMPARISONS = {
+    "=": np.equal,
+    "!=": np.not_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+}
+
+ARITHMETIC = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+}
+
+
+#######################################
+# Parser
+#######################################
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise ValueError(f"Cannot parse expression at: {text[position:]!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.upper() in KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser:
+    """
+    Recursive descent parser producing nested tuples:
+      ("and", [nodes]), ("or", [nodes]), ("not", node),
+      ("compare", op, left, right), ("arith", op, left, right),
+      ("name", name), ("value", value)
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self):
+        node = self.or_expr()
+        if self.position != len(self.tokens):
+            raise ValueError(f"Unexpected token: {self.tokens[self.position][1]}")
+        return node
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, value=None):
+        token = self.peek()
+        if value is not None and token[1] != value:
+            raise ValueError(f"Expected {value}, found {token[1]}")
+        self.position += 1
+        return token
+
+    def or_expr(self):
+        nodes = [self.and_expr()]
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            nodes.append(self.and_expr())
+        return flatten("or", nodes)
+
+    def and_expr(self):
+        nodes = [self.not_expr()]
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            nodes.append(self.not_expr())
+        return flatten("and", nodes)
+
+    def not_expr(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return ("not", self.not_expr())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.arith()
+        kind, value = self.peek()
+        if kind == "op" and value in COMPARISONS:
+            self.take()
+            return ("compare", value, left, self.arith())
+        return left
+
+    def arith(self):
+        node = self.product()
+        while self.peek()[1] in ("+", "-") and self.peek()[0] == "op":
+            op = self.take()[1]
+            node = ("arith", op, node, self.product())
+        return node
+
+    def product(self):
+        node = self.atom()
+        while self.peek()[1] in ("*", "/") and self.peek()[0] == "op":
+            op = self.take()[1]
+            node = ("arith", op, node, self.atom())
+        return node
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == "number":
+            return ("value", float(value) if "." in value else int(value))
+        if kind == "string":
+            return ("value", value[1:-1])
+        if kind == "name":
+            return ("name", value)
+        if value == "(":
+            node = self.or_expr()
+            self.take(")")
+            return node
+        raise ValueError(f"Unexpected token: {value}")
+
+
+def flatten(kind, nodes):
+    """
+    Merge parenthesised terms of the same kind, e.g. a AND (b AND c), so
+    all the terms of an AND can be ordered together
+    """
+    if len(nodes) == 1:
+        return nodes[0]
+    flat = []
+    for node in nodes:
+        flat.extend(node[1] if node[0] == kind else [node])
+    return (kind, flat)
+
+
+def parse(text):
+    return Parser(text).parse()
+
+
+def names(node):
+    """
+    Variable names used in a parsed expression
+    """
+    kind = node[0]
+    if kind == "name":
+        return {node[1]}
+    if kind == "value":
+        return set()
+    if kind in ("and", "or"):
+        return set().union(*(names(child) for child in node[1]))
+    if kind == "not":
+        return names(node[1])
+    return names(node[2]) | names(node[3])
+
+
+#######################################
+# Evaluation
+#######################################
+
+class Evaluator:
+    """
+    Evaluates parsed expressions for `size` patients.
+
+    `column(name, positions)` returns the values of a variable for the
+    patients at `positions` (only the patients still in question are
+    requested). AND and OR terms are ordered by their selectivity on a
+    sample of `sample_size` candidates (see ordered).
+    """
+
+    def __init__(self, column, size, sample_size=1024):
+        self.column = column
+        self.size = size
+        self.sample_size = sample_size
+
+    def ordered(self, children, candidates, fewest_first):
+        """
+        `children` by the number of a sample of the `candidates` for whom
+        they are true: fewest first (for AND) or most first (for OR),
+        ties in their written order. Children are left in their written
+        order when there are no more candidates than the sample.
+        """
+        if len(children) < 2 or len(candidates) <= self.sample_size:
+            return children
+        positions = candidates.positions()
+        picks = np.linspace(0, len(positions) - 1, self.sample_size).astype(np.int64)
+        sample = Bitmap.from_positions(positions[picks], self.size)
+        matched = [len(self.evaluate(child, sample)) for child in children]
+        order = sorted(range(len(children)), key=lambda i: matched[i] if fewest_first else -matched[i])
+        return [children[i] for i in order]
+
+    def evaluate(self, node, candidates=None):
+        """
+        Bitmap of the `candidates` (default everyone) for whom `node` is true
+        """
+        if candidates is None:
+            candidates = Bitmap.full(self.size)
+        kind = node[0]
+
+        if kind == "and":
+            result = candidates
+            for child in self.ordered(node[1], candidates, fewest_first=True):
+                if not result:
+                    break
+                result = self.evaluate(child, result)
+            return result
+
+        if kind == "or":
+            result = Bitmap.empty(self.size)
+            remaining = candidates
+            for child in self.ordered(node[1], candidates, fewest_first=False):
+                if not remaining:
+                    break
+                matched = self.evaluate(child, remaining)
+                result = result | matched
+                remaining = remaining - matched
+            return result
+
+        if kind == "not":
+            return candidates - self.evaluate(node[1], candidates)
+
+        # A comparison or value: evaluate for the candidates only
+        positions = candidates.positions()
+        values = self.values(node, positions)
+        return Bitmap.from_positions(positions[truthy(values)], self.size)
+
+    def values(self, node, positions):
+        kind = node[0]
+        if kind == "name":
+            return np.asarray(self.column(node[1], positions))
+        if kind == "value":
+            return np.full(len(positions), node[1], dtype=object if isinstance(node[1], str) else None)
+        if kind == "compare":
+            left = self.values(node[2], positions)
+            right = self.values(node[3], positions)
+            return compare(node[1], left, right)
+        if kind == "arith":
+            left = self.values(node[2], positions).astype("float64")
+            right = self.values(node[3], positions).astype("float64")
+            return ARITHMETIC[node[1]](left, right)
+        # Boolean sub-expression used as a value
+        candidates = Bitmap.from_positions(positions, self.size)
+        return self.evaluate(node, candidates).mask()[positions]
+
+
+def compare(op, left, right):
+    """
+    Comparison where missing values (None/NaN) are never true, as in SQL
+    """
+    if left.dtype == object or right.dtype == object:
+        result = np.array([
+            a is not None and b is not None and bool(COMPARISONS[op](a, b))
+            for a, b in zip(left, right)
+        ], dtype=bool)
+        return result
+    with np.errstate(invalid="ignore"):
+        return COMPARISONS[op](left, right)
+
+
+def truthy(values):
+    """
+    Non-zero numbers, True, non-empty strings and non-missing dates
+    """
+    values = np.asarray(values)
+    if values.dtype == bool:
+        return values
+    if values.dtype.kind == "M":
+        return ~np.isnat(values)
+    if values.dtype == object:
+        return np.array([bool(v) and v == v for v in values], dtype=bool)
+    with np.errstate(invalid="ignore"):
+        return np.nan_to_num(values.astype("float64")) != 0
+
+
+def evaluate(expression, column, size):
+    """
+    Bitmap of the patients for whom `expression` (text) is true
+    """
+    return Evaluator(column, size).evaluate(parse(expression))
+
+
+def evaluate_reference(node, column, size):
+    """
+    Boolean mask of the patients for whom `node` is true, evaluating every
+    term for everyone with no ordering or short-circuiting; the reference
+    the Evaluator's results are checked against
+    """
+    kind = node[0]
+    if kind == "and":
+        return np.logical_and.reduce([evaluate_reference(child, column, size) for child in node[1]])
+    if kind == "or":
+        return np.logical_or.reduce([evaluate_reference(child, column, size) for child in node[1]])
+    if kind == "not":
+        return ~evaluate_reference(node[1], column, size)
+    return truthy(Evaluator(column, size).values(node, np.arange(size)))
@@ -0,0 +1,141 @@
+##############################################################################
+#
+# This script provides interval histories (practice registrations,
+# addresses) for the local backend and the "as of" queries the study
+# definitions use on them:
+#
+#   registered_as_of                      -> Intervals.covering()
+#   registered_with_one_practice_between  -> Intervals.covering_between()
+#   registered_practice_as_of (region)    -> Intervals.value_as_of()
+#   address_as_of (IMD)                   -> Intervals.value_as_of()
+#
+# Intervals are held per patient, sorted by start day, with int32 start and
+# end days (see events.py for days and keys). Each patient's intervals are
+# one contiguous run (offsets[i]:offsets[i+1] for the i-th patient), with a
+# running maximum of the end day within the run, so a query for any number
+# of (patient, day) pairs is one searchsorted over the packed
+# (patient, start) keys. Patient and day arrays broadcast, so
+# covering(patient_id[:, None], days[None, :]) answers every index date of
+# a multi-date run in one pass.
+#
+# As in the TPP backend, an interval covers day d when start <= d < end,
+# and a missing end date is open (OPEN_END).
+#
+##############################################################################
+
+
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .events import NO_DAY, day_keys
+
+
+# End day for intervals with no end date
+OPEN_END = np.iinfo(np.int32).max
+
+
+@dataclass
+class Intervals:
+    patient_id: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    values: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.patient_id = np.asarray(self.patient_id, dtype=np.int64)
+        # Missing start dates cover everything before the end date
+        self.start = np.maximum(np.asarray(self.start, dtype=np.int32), 0)
+        end = np.asarray(self.end, dtype=np.int32)
+        self.end = np.where(end == NO_DAY, OPEN_END, end).astype(np.int32)
+        self.values = {name: np.asarray(value) for name, value in self.values.items()}
+
+        self.keys = day_keys(self.patient_id, self.start)
+        order = np.argsort(self.keys, kind="stable")
+        self.patient_id = self.patient_id[order]
+        self.start = self.start[order]
+        self.end = self.end[order]
+        self.keys = self.keys[order]
+        self.values = {name: value[order] for name, value in self.values.items()}
+
+        # Run of intervals for each patient
+        self.patients, self.offsets = np.unique(self.patient_id, return_index=True)
+        self.offsets = np.append(self.offsets, len(self.keys))
+
+        # Latest end day among each patient's intervals so far; the patient's
+        # run number is added above the day bits so the running maximum
+        # restarts for each patient
+        run = np.repeat(np.arange(len(self.patients), dtype=np.int64), np.diff(self.offsets))
+        running = np.maximum.accumulate((run << 32) | self.end.astype(np.int64))
+        self.max_end = (running & 0xFFFFFFFF).astype(np.int32)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def last_starting(self, patient_id, day):
+        """
+        Position of each query patient's last interval starting on or
+        before `day` (-1 if none), and the broadcast patient_id and day
+        """
+        patient_id, day = np.broadcast_arrays(
+            np.asarray(patient_id, dtype=np.int64), np.asarray(day, dtype=np.int64)
+        )
+        position = np.full(patient_id.shape, -1, dtype=np.int64)
+        if not len(self):
+            return position, patient_id, day
+        found = np.searchsorted(self.keys, day_keys(patient_id, np.maximum(day, 0)), side="right") - 1
+        valid = (found >= 0) & (day != NO_DAY)
+        found = np.maximum(found, 0)
+        valid &= self.patient_id[found] == patient_id
+        position[valid] = found[valid]
+        return position, patient_id, day
+
+    def covering(self, patient_id, day):
+        """
+        Does any of the patient's intervals cover `day` (registered_as_of)
+        """
+        return self.covering_between(patient_id, day, day)
+
+    def covering_between(self, patient_id, start, end):
+        """
+        Does one of the patient's intervals cover the whole of start..end
+        (registered_with_one_practice_between)
+        """
+        position, patient_id, start = self.last_starting(patient_id, start)
+        end = np.broadcast_to(np.asarray(end, dtype=np.int64), start.shape)
+        found = position >= 0
+        covered = np.zeros(start.shape, dtype=bool)
+        covered[found] = (self.max_end[position[found]] > end[found]) & (end[found] != NO_DAY)
+        return covered
+
+    def value_as_of(self, name, patient_id, day, missing=None):
+        """
+        `name` from the latest-starting interval covering `day`, or
+        `missing` when no interval covers it
+        """
+        position = self.position_as_of(patient_id, day)
+        value = self.values[name]
+        result = np.full(position.shape, missing, dtype=object if missing is None else value.dtype)
+        found = position >= 0
+        result[found] = value[position[found]]
+        return result
+
+    def position_as_of(self, patient_id, day):
+        """
+        Position of the latest-starting interval covering `day` (-1 if none)
+        """
+        position, patient_id, day = self.last_starting(patient_id, day)
+        position = position.copy()
+        # Only patients with some covering interval can have one
+        found = position >= 0
+        found[found] = self.max_end[position[found]] > day[found]
+        position[~found] = -1
+
+        # The last interval to start has usually not ended, otherwise step
+        # back through the (few) overlapping intervals before it
+        pending = np.flatnonzero(found)
+        pending = pending[self.end[position.flat[pending]] <= day.flat[pending]]
+        while len(pending):
+            position.flat[pending] -= 1
+            pending = pending[self.end[position.flat[pending]] <= day.flat[pending]]
+        return position
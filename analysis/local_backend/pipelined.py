@@ -0,0 +1,152 @@
+##############################################################################
+#
+# This script runs the stages of an extraction (fetch, transform, write)
+# on separate threads connected by bounded queues, so that fetching the
+# next chunk, converting the current one and writing the previous one
+# overlap. Throughput approaches that of the slowest stage rather than
+# the sum of all three; numpy and pyarrow release the GIL for most of
+# their work.
+#
+# The queues hold at most `queue_size` items, so at most that many chunks
+# wait between two stages and memory stays bounded when a later stage is
+# slower. Items keep their order. An exception in any stage stops the
+# other stages and is raised in the caller.
+#
+##############################################################################
+
+
+import queue
+import threading
+import time
+
+
+DONE = object()
+
+
+class Stopped(Exception):
+    pass
+
+
+class Pipeline:
+    """
+    Runs `source` (an iterable, consumed on its own thread), then each of
+    `stages` (functions of one item) on their own threads, and `sink` (a
+    function of one item) on the calling thread
+    """
+
+    def __init__(self, source, stages, sink, queue_size=2, names=None):
+        self.source = source
+        self.stages = list(stages)
+        self.sink = sink
+        self.queue_size = queue_size
+        self.names = names or ["fetch"] + [f"stage {i + 1}" for i in range(len(self.stages))] + ["write"]
+        # Seconds each stage spent working (not waiting on a queue)
+        self.busy = dict.fromkeys(self.names, 0.0)
+        self.stop = threading.Event()
+        self.errors = []
+
+    def put(self, target, item):
+        while not self.stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise Stopped
+
+    def get(self, source):
+        while not self.stop.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise Stopped
+
+    def fail(self, error):
+        self.errors.append(error)
+        self.stop.set()
+
+    def run_source(self, target):
+        name = self.names[0]
+        try:
+            items = iter(self.source)
+            while True:
+                started = time.perf_counter()
+                item = next(items, DONE)
+                self.busy[name] += time.perf_counter() - started
+                self.put(target, item)
+                if item is DONE:
+                    return
+        except Stopped:
+            pass
+        except BaseException as error:
+            self.fail(error)
+
+    def run_stage(self, number, function, source, target):
+        name = self.names[number + 1]
+        try:
+            while True:
+                item = self.get(source)
+                if item is not DONE:
+                    started = time.perf_counter()
+                    item = function(item)
+                    self.busy[name] += time.perf_counter() - started
+                self.put(target, item)
+                if item is DONE:
+                    return
+        except Stopped:
+            pass
+        except BaseException as error:
+            self.fail(error)
+
+    def run(self):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.run_source, args=(queues[0],), daemon=True)]
+        for number, function in enumerate(self.stages):
+            threads.append(threading.Thread(
+                target=self.run_stage, args=(number, function, queues[number], queues[number + 1]),
+                daemon=True,
+            ))
+        for thread in threads:
+            thread.start()
+
+        name = self.names[-1]
+        try:
+            while True:
+                item = self.get(queues[-1])
+                if item is DONE:
+                    break
+                started = time.perf_counter()
+                self.sink(item)
+                self.busy[name] += time.perf_counter() - started
+        except Stopped:
+            pass
+        except BaseException as error:
+            self.fail(error)
+        finally:
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.busy
+
+
+def run_sequentially(source, stages, sink, names=None):
+    """
+    The same stages one after another on the calling thread, returning the
+    seconds spent in each
+    """
+    names = names or ["fetch"] + [f"stage {i + 1}" for i in range(len(stages))] + ["write"]
+    busy = dict.fromkeys(names, 0.0)
+    items = iter(source)
+    while True:
+        started = time.perf_counter()
+        item = next(items, DONE)
+        busy[names[0]] += time.perf_counter() - started
+        if item is DONE:
+            return busy
+        for name, function in zip(names[1:], list(stages) + [sink]):
+            started = time.perf_counter()
+            item = function(item)
+            busy[name] += time.perf_counter() - started
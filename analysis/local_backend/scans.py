@@ -0,0 +1,41 @@
+##############################################################################
+#
+# This script provides shared scans: the encoded codelists, files and
+# records matching each codelist, computed once and reused by every
+# extraction holding the same SharedScans, so each table is scanned once
+# per codelist rather than once per chunk and index date.
+#
+# extract_local.py shares one SharedScans between all chunks and index
+# dates of a run (--no-shared-scan gives each chunk its own). Matches are
+# keyed by the id of the codelist objects, which stay the same between
+# index dates of one study definition (also when restored from a
+# snapshot). Items are computed under one lock each, so variables
+# evaluated concurrently (see scheduler.py) compute each item once.
+#
+##############################################################################
+
+
+import threading
+
+
+class SharedScans:
+    """
+    Items computed once per key: encoded codelists, files read by
+    with_value_from_file and which_exist_in_file, and matched records
+    """
+
+    def __init__(self):
+        self.items = {"codelists": {}, "files": {}, "matches": {}}
+        self.locks = {}
+
+    def get(self, kind, key, compute):
+        """
+        Item `key` of `kind`, computed by `compute()` if missing; other
+        threads wanting the same item wait for it
+        """
+        items = self.items[kind]
+        if key not in items:
+            with self.locks.setdefault((kind, key), threading.Lock()):
+                if key not in items:
+                    items[key] = compute()
+        return items[key]
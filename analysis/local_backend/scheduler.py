@@ -0,0 +1,83 @@
+##############################################################################
+#
+# This script evaluates the variables of an extraction (see engine.py)
+# concurrently.
+#
+# Each variable depends on the variables its expressions and date bounds
+# refer to (engine.dependencies), e.g. covid_vax_2_date on
+# covid_vax_1_date. Variables are submitted to a bounded pool of worker
+# threads as soon as everything they depend on is done, so independent
+# families (comorbidities, vaccination dates, flu sources, care home,
+# IMD and region) are evaluated at the same time. Every column is aligned
+# to the extraction's patients, so results are joined by position.
+#
+# Most of the work is in numpy (sorting, searchsorted, bincount), which
+# releases the GIL, so the workers use several cores. With one worker,
+# variables are evaluated in order on the calling thread.
+#
+##############################################################################
+
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .engine import dependencies
+
+
+def dependency_graph(definitions, names):
+    """
+    {name: {variables among `names` it depends on}}
+    """
+    names = set(names)
+    return {name: set(dependencies(definitions, name)) & names for name in names}
+
+
+class VariablePool:
+    """
+    Bounded pool of workers evaluating variables, shared by the chunks
+    (and index dates) of an extraction
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(1, workers)
+        self.executor = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def evaluate(self, extraction, names, on_done=None):
+        """
+        Evaluate `names` (in their definition order when sequential),
+        calling `on_done(name)` on the calling thread as each finishes
+        """
+        on_done = on_done or (lambda name: None)
+        if self.executor is None:
+            for name in names:
+                extraction.evaluate(name)
+                on_done(name)
+            return
+
+        waiting = dependency_graph(extraction.definitions, names)
+        order = {name: i for i, name in enumerate(names)}
+        running = {}
+        try:
+            while waiting or running:
+                ready = sorted((name for name, needs in waiting.items() if not needs),
+                               key=order.get)
+                for name in ready:
+                    del waiting[name]
+                    running[self.executor.submit(extraction.evaluate, name)] = name
+                if not running:
+                    raise ValueError(f"Circular dependencies between {sorted(waiting)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    future.result()
+                    for needs in waiting.values():
+                        needs.discard(name)
+                    on_done(name)
+        finally:
+            # Do not leave variables of a failed chunk running
+            for future in running:
+                future.cancel()
+            wait(running)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,161 @@
+##############################################################################
+#
+# This script caches constructed study definitions, so local extractions
+# start without importing cohortextractor, running analysis/codelists.py
+# and rebuilding (and validating) the StudyDefinition.
+#
+# A snapshot holds what an extraction needs: the index dates and the
+# covariate definitions evaluated at each of them, with cohortextractor's
+# Codelists replaced by SnapshotCodelists (plain lists with the same
+# attributes), so it is unpickled without importing cohortextractor. It is
+# keyed by a hash of the top-level analysis modules (the study definitions
+# and everything they import, e.g. codelists.py and population.py), the
+# codelist CSVs, the cohortextractor version, the parameters and the
+# index date range; any change to these builds a new snapshot.
+#
+# Restoring a snapshot skips cohortextractor's validation of the study
+# definition, which also checks that the files read by
+# with_value_from_file exist; the extraction still reads them.
+#
+##############################################################################
+
+
+import hashlib
+import importlib
+import importlib.metadata
+import pickle
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from .checkpoints import write_atomic
+
+
+SNAPSHOT_DIR = Path("logs", "study_snapshots")
+
+ANALYSIS_DIR = Path(__file__).resolve().parents[1]
+
+CODELIST_DIR = Path("codelists")
+
+# Bumped when the snapshot contents change
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotCodelist(list):
+    """
+    Codes of a cohortextractor Codelist, with its `system` and
+    `has_categories`
+    """
+
+    system = None
+    has_categories = False
+
+    @classmethod
+    def from_codelist(cls, codelist):
+        snapshot = cls(codelist)
+        snapshot.system = codelist.system
+        snapshot.has_categories = codelist.has_categories
+        return snapshot
+
+
+def is_codelist(value):
+    return isinstance(value, list) and hasattr(value, "system") and hasattr(value, "has_categories")
+
+
+def plain(value, memo):
+    """
+    `value` with codelists as SnapshotCodelists; `memo` keeps a codelist
+    used in several places (or index dates) a single object
+    """
+    if is_codelist(value):
+        if id(value) not in memo:
+            memo[id(value)] = (value, SnapshotCodelist.from_codelist(value))
+        return memo[id(value)][1]
+    if isinstance(value, dict):
+        return {key: plain(item, memo) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return tuple(plain(item, memo) for item in value)
+    if isinstance(value, list):
+        return [plain(item, memo) for item in value]
+    return value
+
+
+def snapshot_key(name, params, index_date_range):
+    digest = hashlib.sha256()
+    sources = sorted(ANALYSIS_DIR.glob("*.py")) + sorted(CODELIST_DIR.glob("*.csv"))
+    for path in sources:
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    version = importlib.metadata.version("opensafely-cohort-extractor")
+    for part in (SNAPSHOT_VERSION, version, name, sorted(params.items()), index_date_range):
+        digest.update(repr(part).encode())
+    return digest.hexdigest()
+
+
+class StartupTimer:
+    """
+    Seconds spent in each startup phase, and the phases skipped
+    """
+
+    def __init__(self):
+        # [(phase, seconds, or None if skipped)]
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        yield
+        self.phases.append((name, time.perf_counter() - started))
+
+    def skip(self, name):
+        self.phases.append((name, None))
+
+    def report(self):
+        total = sum(seconds for _, seconds in self.phases if seconds is not None)
+        lines = [f"Startup in {total:.2f}s:"]
+        for name, seconds in self.phases:
+            lines.append(f"  {name:26} {'skipped' if seconds is None else f'{seconds:.3f}s'}")
+        return "\n".join(lines)
+
+
+def load_definitions(name, params, index_date_range=None, snapshot_dir=SNAPSHOT_DIR,
+                     use_snapshot=True, timer=None):
+    """
+    (index dates, covariate definitions at each index date) of the study
+    definition `name`, restored from its snapshot if there is one and
+    built (and snapshotted) otherwise. Without `index_date_range` the
+    definition's own index date is used, given as None.
+    """
+    timer = timer or StartupTimer()
+    with timer.phase("hash sources"):
+        key = snapshot_key(name, params, index_date_range)
+    path = Path(snapshot_dir, f"{name}_{key[:16]}.pickle")
+
+    if use_snapshot and path.exists():
+        with timer.phase("restore snapshot"):
+            snapshot = pickle.loads(path.read_bytes())
+        for skipped in ("import cohortextractor", "run codelists.py", "build study definition",
+                        "evaluate index dates"):
+            timer.skip(skipped)
+        return snapshot["index_dates"], snapshot["definitions"]
+
+    with timer.phase("import cohortextractor"):
+        from cohortextractor.cohortextractor import _generate_date_range, load_study_definition
+    with timer.phase("run codelists.py"):
+        importlib.import_module("codelists")
+    with timer.phase("build study definition"):
+        study = load_study_definition(name, params=params)
+    with timer.phase("evaluate index dates"):
+        index_dates = _generate_date_range(index_date_range) if index_date_range else [None]
+        memo, definitions = {}, []
+        for index_date in index_dates:
+            if index_date is not None:
+                study.set_index_date(index_date)
+            definitions.append(plain(study.covariate_definitions, memo))
+
+    if use_snapshot:
+        with timer.phase("write snapshot"):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            snapshot = {"index_dates": index_dates, "definitions": definitions}
+            write_atomic(path, lambda tmp: tmp.write_bytes(pickle.dumps(snapshot)))
+    return index_dates, definitions
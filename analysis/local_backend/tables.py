@@ -0,0 +1,171 @@
+##############################################################################
+#
+# This script provides the local backend's tables and their on-disk store.
+#
+# A backend is a directory with one subdirectory per table and one .npy
+# file per column, so tables are memory-mapped when loaded and only the
+# columns a query touches are read:
+#
+#   patients/           patient_id, dob (day, first of the month), sex,
+#                       dod (day), death_cause (underlying, ICD-10)
+#   death_causes/       every cause on the death certificate (events)
+#   registrations/      practice registrations (intervals) with region
+#   addresses/          addresses (intervals) with imd, care_home, nursing
+#   clinical_snomed/    clinical events (events), SNOMED CT codes, with
+#                       numeric_value
+#   clinical_ctv3/      clinical events (events), CTV3 codes, with
+#                       numeric_value
+#   medications/        medication issues (events)
+#   vaccinations/       vaccination records (events), code = target disease
+#   hscworker/          patient_ids flagged as health/social care workers
+#   admissions/         hospital admissions (CSR diagnoses, ICD-10)
+#   emergency_care/     emergency attendances (CSR diagnoses, SNOMED CT)
+#
+# Days are as in events.py.
+#
+##############################################################################
+
+
+import hashlib
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import numpy as np
+
+from .ecds import Attendances
+from .events import Events
+from .intervals import Intervals
+
+
+EVENT_TABLES = ["death_causes", "clinical_snomed", "clinical_ctv3", "medications", "vaccinations"]
+INTERVAL_TABLES = ["registrations", "addresses"]
+ATTENDANCE_TABLES = {"admissions": "icd10", "emergency_care": "snomed"}
+
+
+#######################################
+# Column files
+#######################################
+
+def save_columns(directory, columns):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, values in columns.items():
+        values = np.asarray(values)
+        if values.dtype == object:
+            values = values.astype(str)
+        tmp = directory / f".{name}.{os.getpid()}.tmp.npy"
+        np.save(tmp, values, allow_pickle=False)
+        os.replace(tmp, directory / f"{name}.npy")
+
+
+def load_columns(directory, mmap=True):
+    return {
+        path.stem: np.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+        for path in sorted(Path(directory).glob("*.npy"))
+    }
+
+
+#######################################
+# Backend
+#######################################
+
+@dataclass
+class Backend:
+    patients: dict
+    death_causes: Events
+    registrations: Intervals
+    addresses: Intervals
+    clinical_snomed: Events
+    clinical_ctv3: Events
+    medications: Events
+    vaccinations: Events
+    hscworker: np.ndarray
+    admissions: Attendances
+    emergency_care: Attendances
+    # Other columns of event tables, {table: {column: values}}, in the
+    # events' (sorted) order
+    event_values: dict = field(default_factory=dict)
+    path: Path = field(default=None, compare=False)
+
+    def __post_init__(self):
+        order = np.argsort(self.patients["patient_id"], kind="stable")
+        self.patients = {name: np.asarray(values)[order] for name, values in self.patients.items()}
+        self.hscworker = np.unique(np.asarray(self.hscworker, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.patients["patient_id"])
+
+    @property
+    def patient_id(self):
+        return self.patients["patient_id"]
+
+    def clinical_events(self, system):
+        return getattr(self, clinical_table(system))
+
+    def save(self, path):
+        path = Path(path)
+        save_columns(path / "patients", self.patients)
+        save_columns(path / "hscworker", {"patient_id": self.hscworker})
+        for name in EVENT_TABLES:
+            events = getattr(self, name)
+            save_columns(path / name, {
+                "patient_id": events.patient_id, "day": events.day, "code": events.code,
+                **{f"value_{key}": value for key, value in self.event_values.get(name, {}).items()},
+            })
+        for name in INTERVAL_TABLES:
+            intervals = getattr(self, name)
+            save_columns(path / name, {
+                "patient_id": intervals.patient_id, "start": intervals.start, "end": intervals.end,
+                **{f"value_{key}": value for key, value in intervals.values.items()},
+            })
+        for name in ATTENDANCE_TABLES:
+            attendances = getattr(self, name)
+            save_columns(path / name, {
+                "patient_id": attendances.patient_id, "day": attendances.day,
+                "offsets": attendances.offsets, "codes": attendances.codes,
+                **{f"value_{key}": value for key, value in attendances.values.items()},
+            })
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        if not (path / "patients").is_dir():
+            raise FileNotFoundError(f"No local backend at {path}")
+        tables = {"patients": load_columns(path / "patients")}
+        tables["hscworker"] = load_columns(path / "hscworker")["patient_id"]
+        tables["event_values"] = {}
+        for name in EVENT_TABLES:
+            columns = load_columns(path / name)
+            tables[name] = Events(columns["patient_id"], columns["day"], columns["code"])
+            tables["event_values"][name] = without_prefix(columns)
+        for name in INTERVAL_TABLES:
+            columns = load_columns(path / name)
+            tables[name] = Intervals(columns.pop("patient_id"), columns.pop("start"),
+                                     columns.pop("end"), values=without_prefix(columns))
+        for name, system in ATTENDANCE_TABLES.items():
+            columns = load_columns(path / name)
+            tables[name] = Attendances(columns.pop("patient_id"), columns.pop("day"),
+                                       columns.pop("offsets"), columns.pop("codes"),
+                                       system=system, values=without_prefix(columns))
+        return cls(**tables, path=path)
+
+
+def clinical_table(system):
+    return "clinical_ctv3" if system == "ctv3" else "clinical_snomed"
+
+
+def without_prefix(columns, prefix="value_"):
+    return {name[len(prefix):]: values for name, values in columns.items() if name.startswith(prefix)}
+
+
+def fingerprint(path):
+    """
+    Hash of the names, sizes and modification times of a backend's files,
+    which changes whenever the backend is rewritten
+    """
+    digest = hashlib.sha256()
+    for file in sorted(Path(path).rglob("*.npy")):
+        stat = file.stat()
+        digest.update(f"{file.relative_to(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
@@ -0,0 +1,133 @@
+##############################################################################
+#
+# This script provides functions for the weekly measure cube.
+#
+# The cube holds every measure (numerator / denominator) by every grouping
+# at every index date, in long format. Groupings can use several columns
+# and columns derived at each index date (e.g. age bands from dob), which
+# cohortextractor's Measure cannot. Each week's rows are reduced in one
+# pass: the cell keys of all groupings are stacked and each numerator and
+# denominator column is summed with a single bincount over them.
+#
+# MEASURES is also used by study_definition_measures.py to define its
+# Measures, so generate_measures and the cube agree.
+#
+##############################################################################
+
+
+import numpy as np
+import pandas as pd
+
+from cube import as_category
+from custom_functions import age_in_months
+
+
+# id: (numerator, denominator); a "population" denominator counts everyone
+MEASURES = {
+    "anydeath": ("anydeath", "population"),
+    "anyadmitted": ("anyadmitted", "population"),
+    "covidadmitted": ("covidadmitted", "population"),
+    "covidemergency": ("covidemergency", "population"),
+    "covidcomposite": ("covidcomposite", "population"),
+    "respcomposite": ("respcomposite", "population"),
+}
+
+# Name: columns (extracted or derived) whose combinations are the groups
+GROUPINGS = {
+    "population": ["population"],
+    "age_3mos": ["age_3mos"],
+    "over50": ["over50"],
+}
+
+# Columns derived at each index date, in order (later ones can use earlier
+# ones); ages use mid-month DOB as in the R scripts
+DERIVED = {
+    "population": lambda df, date: pd.Series(1, index=df.index),
+    "age_mos": lambda df, date: age_in_months(df["dob"], date, mid_month=True).set_axis(df.index),
+    "age_3mos": lambda df, date: df["age_mos"] // 3,
+    "age_yrs": lambda df, date: df["age_mos"] // 12,
+    "over50": lambda df, date: ((df["age_yrs"] >= 50) & (df["age_yrs"] < 55))
+    .astype(int).where(df["age_yrs"].notna()),
+}
+
+CUBE_COLUMNS = ["date", "measure", "group_by", "group", "numerator", "denominator", "value"]
+
+
+def input_columns(measures=MEASURES):
+    """
+    Extracted columns the cube needs (besides derived ones)
+    """
+    columns = {"dob"}
+    for numerator, denominator in measures.values():
+        columns |= {numerator, denominator}
+    return sorted(columns - DERIVED.keys())
+
+
+def group_labels(df, columns):
+    """
+    Group label of each row: the columns' categories joined with ", ",
+    missing if any of them is
+    """
+    labels = [as_category(df[column]).reset_index(drop=True) for column in columns]
+    joined = labels[0]
+    for label in labels[1:]:
+        joined = joined + ", " + label
+    return joined.to_numpy(dtype=object)
+
+
+def week_cells(df, date, measures=MEASURES, groupings=GROUPINGS, weights=None):
+    """
+    Numerator and denominator sums of every measure by every grouping for
+    one index date. `weights` (e.g. sampling weights) default to 1.
+    """
+    df = df.copy()
+    for name, derive in DERIVED.items():
+        df[name] = derive(df, date)
+
+    # Keys of every grouping's cells, stacked
+    keys, cells = [], []
+    for name, columns in groupings.items():
+        codes, levels = pd.factorize(group_labels(df, columns), use_na_sentinel=True)
+        # Missing groups get their own code after the real levels
+        codes = np.where(codes < 0, len(levels), codes)
+        keys.append(codes + len(cells))
+        cells += [(name, level) for level in levels] + [(name, None)]
+    key = np.concatenate(keys)
+
+    weights = np.ones(len(df)) if weights is None else np.asarray(weights, dtype="float64")
+    sums = {}
+    for column in {column for pair in measures.values() for column in pair}:
+        values = df[column].astype("float64").fillna(0).to_numpy() * weights
+        sums[column] = np.bincount(key, weights=np.tile(values, len(groupings)),
+                                   minlength=len(cells))
+
+    group_by, group = zip(*cells)
+    rows = []
+    for measure, (numerator, denominator) in measures.items():
+        rows.append(pd.DataFrame({
+            "date": str(date),
+            "measure": measure,
+            "group_by": group_by,
+            "group": group,
+            "numerator": sums[numerator],
+            "denominator": sums[denominator],
+        }))
+    rows = pd.concat(rows, ignore_index=True)
+    return rows[rows["denominator"] > 0]
+
+
+def build_measure_cube(weeks, measures=MEASURES, groupings=GROUPINGS, weight_column=None):
+    """
+    Build the cube from (index date, patient-level data) pairs, read one at
+    a time, weighting rows by `weight_column` if given and present
+    """
+    cubes, weighted = [], False
+    for date, df in weeks:
+        weights = df[weight_column] if weight_column in df else None
+        weighted |= weights is not None
+        cubes.append(week_cells(df, date, measures, groupings, weights))
+    cube = pd.concat(cubes, ignore_index=True)
+    if not weighted:
+        cube[["numerator", "denominator"]] = cube[["numerator", "denominator"]].astype(int)
+    cube["value"] = cube["numerator"] / cube["denominator"]
+    return cube[CUBE_COLUMNS]
@@ -0,0 +1,172 @@
+##############################################################################
+#
+# This script provides functions for the patient-level outcome panel.
+#
+# The panel has one row per patient. Each binary outcome is stored as a
+# single unsigned integer bitmask with one bit per index date (bit i is
+# index_dates[i]), next to the patient's dob, dod, boost_date and
+# flu_vax_date. `in_population` records which index dates the patient
+# was extracted for, since the population differs between index dates.
+#
+##############################################################################
+
+
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+
+
+OUTCOMES = [
+    "anydeath",
+    "coviddeath",
+    "covidadmitted",
+    "covidemergency",
+    "covidcomposite",
+    "respdeath",
+    "respadmitted",
+    "respcomposite",
+    "anyadmitted",
+]
+
+STATIC_COLUMNS = ["dob", "dod", "boost_date", "flu_vax_date"]
+
+# Only present in development sample runs (--param sample=yes)
+WEIGHT_COLUMN = "sampling_weight"
+
+# Set-bit counts for every byte value, for counting bits in any mask width
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def mask_dtype(n_dates):
+    """
+    Smallest unsigned integer type with one bit per index date (masks are
+    built with float64 sums, so at most 32 dates)
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if n_dates <= np.iinfo(dtype).bits:
+            return dtype
+    raise ValueError(f"Cannot pack {n_dates} index dates into one integer")
+
+
+#######################################
+# Build panel
+#######################################
+
+def build_panel(dataset_dir, outcomes=OUTCOMES):
+    """
+    Build the panel from the outcomes dataset partitioned by index date
+    (see processing/build_outcomes_dataset.py). Returns a pyarrow Table
+    with the index dates stored in the schema metadata.
+    """
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+    static_columns = STATIC_COLUMNS + [
+        name for name in [WEIGHT_COLUMN] if name in dataset.schema.names
+    ]
+    columns = ["patient_id"] + static_columns + list(outcomes) + ["index_date"]
+    table = dataset.to_table(columns=columns)
+
+    index_date = table.column("index_date").to_numpy(zero_copy_only=False).astype(str)
+    index_dates = sorted(set(index_date))
+    dtype = mask_dtype(len(index_dates))
+    bit = np.searchsorted(index_dates, index_date)
+    bit_value = np.left_shift(np.ones(len(bit), dtype=np.uint64), bit.astype(np.uint64))
+
+    patient_id = table.column("patient_id").to_numpy()
+    patients, first_row, row_patient = np.unique(
+        patient_id, return_index=True, return_inverse=True
+    )
+
+    # Each (patient, index date) pair appears once, so summing bit values
+    # gives the same result as OR-ing them
+    def pack(flag):
+        return np.bincount(
+            row_patient, weights=np.where(flag, bit_value, 0), minlength=len(patients)
+        ).astype(dtype)
+
+    arrays = {"patient_id": pa.array(patients)}
+
+    # Static columns come from the cohort file, so are the same on every row
+    for name in static_columns:
+        arrays[name] = table.column(name).take(pa.array(first_row))
+
+    arrays["in_population"] = pa.array(pack(np.ones(len(bit), dtype=bool)))
+    for name in outcomes:
+        flag = table.column(name).to_numpy(zero_copy_only=False)
+        flag = np.asarray(flag == True, dtype=bool)  # missing counts as no event
+        arrays[name] = pa.array(pack(flag))
+
+    panel = pa.table(arrays)
+    return panel.replace_schema_metadata(
+        {"index_dates": json.dumps(index_dates)}
+    )
+
+
+def write_panel(panel, path):
+    feather.write_feather(panel, path, compression="zstd")
+
+
+def read_panel(path, columns=None, optional=(WEIGHT_COLUMN,)):
+    """
+    Read the panel; returns (DataFrame, list of index dates). `optional`
+    columns are added to `columns` when the panel has them.
+    """
+    if columns is not None:
+        names = feather.read_table(path, columns=[], memory_map=True).schema.names
+        columns = list(columns) + [name for name in optional if name in names]
+    table = feather.read_table(path, columns=columns)
+    index_dates = json.loads(table.schema.metadata[b"index_dates"])
+    return table.to_pandas(date_as_object=False), index_dates
+
+
+#######################################
+# Accessors
+#######################################
+
+def date_bit(index_dates, index_date):
+    """
+    Bit position for `index_date` (a date or "YYYY-MM-DD" string)
+    """
+    return list(index_dates).index(str(index_date)[:10])
+
+
+def on_date(masks, index_dates, index_date):
+    """
+    Boolean array: is the bit for `index_date` set in each mask
+    """
+    masks = np.asarray(masks)
+    bit = date_bit(index_dates, index_date)
+    return ((masks >> masks.dtype.type(bit)) & 1).astype(bool)
+
+
+def unpack(masks, n_dates):
+    """
+    Boolean array of shape (patients, n_dates), column i is bit i
+    """
+    masks = np.asarray(masks)
+    bits = np.arange(n_dates, dtype=masks.dtype)
+    return ((masks[:, None] >> bits) & 1).astype(bool)
+
+
+def count_set(masks, among=None):
+    """
+    Number of set bits in each mask, optionally only among the bits set
+    in `among` (e.g. dates_mask(index_dates, dates))
+    """
+    masks = np.ascontiguousarray(masks)
+    if among is not None:
+        masks = masks & masks.dtype.type(among)
+    counts = POPCOUNT[masks.view(np.uint8)].reshape(len(masks), -1)
+    return counts.sum(axis=1, dtype=np.int64)
+
+
+def dates_mask(index_dates, dates):
+    """
+    Mask with the bits for `dates` set, for use with count_set()
+    """
+    mask = 0
+    for index_date in dates:
+        mask |= 1 << date_bit(index_dates, index_date)
+    return mask
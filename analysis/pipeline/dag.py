@@ -0,0 +1,136 @@
+##############################################################################
+#
+# This script parses the actions in project.yaml into a dependency graph
+# (DAG) using each action's `needs:` and works out scheduling priorities.
+#
+# An action's priority is the length of the longest chain of work from the
+# start of that action to the end of the pipeline (its critical path), so
+# actions feeding long chains (e.g. the outcome extractions feeding the
+# modelling actions) are started first.
+#
+##############################################################################
+
+
+from dataclasses import dataclass, field
+
+import yaml
+
+
+# Rough relative durations by image, used when there is no better estimate
+DEFAULT_DURATIONS = {
+    "cohortextractor": 10.0,
+    "r": 3.0,
+    "python": 2.0,
+}
+
+
+@dataclass
+class Action:
+    name: str
+    run: str
+    needs: list = field(default_factory=list)
+    outputs: list = field(default_factory=list)
+
+    @property
+    def image(self):
+        """
+        Image name without version, e.g. "cohortextractor" or "r"
+        """
+        return self.run.split()[0].split(":")[0]
+
+
+def load_actions(project_path="project.yaml"):
+    """
+    Return {name: Action} for every action in project.yaml, in file order
+    """
+    with open(project_path) as f:
+        project = yaml.safe_load(f)
+
+    actions = {}
+    for name, spec in project["actions"].items():
+        run = " ".join(str(spec["run"]).split())
+        outputs = [
+            pattern
+            for level in (spec.get("outputs") or {}).values()
+            for pattern in (level or {}).values()
+        ]
+        actions[name] = Action(name=name, run=run, needs=list(spec.get("needs") or []),
+                               outputs=outputs)
+
+    for action in actions.values():
+        for need in action.needs:
+            if need not in actions:
+                raise ValueError(f"{action.name} needs unknown action {need}")
+    return actions
+
+
+def dependents(actions):
+    """
+    Return {name: [names of actions that need it]}
+    """
+    children = {name: [] for name in actions}
+    for action in actions.values():
+        for need in action.needs:
+            children[need].append(action.name)
+    return children
+
+
+def topological_order(actions):
+    """
+    Return action names so that each action comes after everything it needs
+    """
+    children = dependents(actions)
+    waiting = {name: len(action.needs) for name, action in actions.items()}
+    ready = [name for name, n in waiting.items() if n == 0]
+    order = []
+    while ready:
+        name = ready.pop(0)
+        order.append(name)
+        for child in children[name]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                ready.append(child)
+
+    if len(order) != len(actions):
+        cycle = sorted(name for name, n in waiting.items() if n > 0)
+        raise ValueError(f"Dependency cycle between actions: {', '.join(cycle)}")
+    return order
+
+
+def select(actions, targets):
+    """
+    Restrict `actions` to `targets` and everything they (indirectly) need
+    """
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in actions:
+            raise ValueError(f"Unknown action: {name}")
+        if name not in selected:
+            selected.add(name)
+            stack.extend(actions[name].needs)
+    return {name: action for name, action in actions.items() if name in selected}
+
+
+def estimated_duration(action, durations=None):
+    """
+    Duration estimate for `action`: from `durations` (e.g. previous runs)
+    if available, otherwise a default for its image
+    """
+    if durations and action.name in durations:
+        return durations[action.name]
+    return DEFAULT_DURATIONS.get(action.image, 1.0)
+
+
+def critical_path_lengths(actions, durations=None):
+    """
+    Return {name: length of the longest path from the start of the action
+    to the end of the pipeline}, in the same units as `durations`
+    """
+    children = dependents(actions)
+    lengths = {}
+    for name in reversed(topological_order(actions)):
+        downstream = max((lengths[child] for child in children[name]), default=0.0)
+        lengths[name] = estimated_duration(actions[name], durations) + downstream
+    return lengths
@@ -0,0 +1,322 @@
+##############################################################################
+#
+# This script checks that the fast paths of the local extractor
+# (extract_local.py) give the same outputs as its reference mode for the
+# baseline, outcome and measure study definitions.
+#
+# For each --scale a synthetic backend (synthetic_backend.py) is
+# generated in its own workspace under --workdir, the reference outputs
+# are extracted (one process per index date, one chunk, no pipelining,
+# shared scans, compiled expressions or concurrent variables) and the baseline is processed into
+# the cohort files the other study definitions read. Each mode then
+# extracts the same files with one fast path enabled (or all, for "fast"):
+#
+#   chunked       patients in chunks of --chunk-size
+#   pipelined     chunks fetched, transformed and written concurrently
+#   shared-scan   codelist matches shared between chunks
+#   multi-date    all index dates in one process, sharing matches
+#   compiled      expressions evaluated as ordered, short-circuit bitmaps,
+#                 and variables other than the population only for its
+#                 members
+#   concurrent    independent variables evaluated by --workers threads
+#   sampled       --param sample=yes, compared with the reference rows of
+#                 the sampled patients
+#   fast          all of the above except sampling
+#
+# Every run rebuilds the study definition (--no-snapshot), so no mode
+# gains from a snapshot written by an earlier one and the speedup and
+# memory ratio measure the fast paths alone.
+#
+# Outputs are compared column by column after sorting by patient_id:
+# dates must be within --date-tolerance days (missing only matches
+# missing), flags are compared as true/false whatever their type, numbers
+# within --float-tolerance (relative) and categories as strings. The
+# report (printed, and written to <workdir>/report.csv) gives pass/fail,
+# the differing columns, and the speedup and memory ratio of each mode
+# against the reference.
+#
+# Usage (from the repo root):
+#   python analysis/pipeline/equivalence.py --scales 2000 20000 100000
+#   python analysis/pipeline/equivalence.py --scales 5000 --modes fast sampled
+#
+##############################################################################
+
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from peak_memory import wait
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from synthetic_backend import write_backend  # noqa: E402
+
+from cohortextractor.cohortextractor import _generate_date_range  # noqa: E402
+
+
+ROOT = Path(__file__).resolve().parents[2]
+
+DEFINITIONS = ["study_definition_baseline", "study_definition_outcomes", "study_definition_measures"]
+
+# Extractor options of each mode ({chunk} is --chunk-size), and whether
+# each index date is extracted by its own process
+MODES = {
+    "reference": (["--reference"], True),
+    "chunked": (["--reference", "--chunk-size", "{chunk}"], True),
+    "pipelined": (["--no-shared-scan", "--reference-expressions", "--workers", "1",
+                   "--chunk-size", "{chunk}"], True),
+    "shared-scan": (["--no-pipeline", "--reference-expressions", "--workers", "1",
+                     "--chunk-size", "{chunk}"], True),
+    "multi-date": (["--no-pipeline", "--reference-expressions", "--workers", "1"], False),
+    "compiled": (["--no-pipeline", "--no-shared-scan", "--workers", "1"], True),
+    "concurrent": (["--no-pipeline", "--no-shared-scan", "--reference-expressions",
+                    "--workers", "{workers}"], True),
+    "sampled": (["--reference", "--param", "sample=yes"], True),
+    "fast": (["--chunk-size", "{chunk}", "--workers", "{workers}"], False),
+}
+
+
+#######################################
+# Running extractions
+#######################################
+
+def workspace(workdir, scale, seed):
+    """
+    Directory with the analysis code and a synthetic backend of `scale`
+    patients
+    """
+    path = Path(workdir, f"scale_{scale}").resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    for name in ("analysis", "codelists"):
+        if not (path / name).exists():
+            (path / name).symlink_to(ROOT / name)
+    backend = path / "output" / "local_backend"
+    if not backend.exists():
+        write_backend(backend, scale, seed=seed)
+    return path
+
+
+def run(args, cwd):
+    """
+    (seconds, peak RSS in MB) of running `args` in `cwd`
+    """
+    started = time.monotonic()
+    with open(Path(cwd, "equivalence.log"), "a") as log:
+        log.write(f"$ {' '.join(args)}\n")
+        log.flush()
+        process = subprocess.Popen(args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+        returncode, peak_rss_mb = wait(process)
+    if returncode != 0:
+        raise RuntimeError(f"Failed ({returncode}): {' '.join(args)}; see {cwd}/equivalence.log")
+    return time.monotonic() - started, peak_rss_mb
+
+
+def extract(path, mode, definition, index_date_range, chunk_size, scale, workers):
+    """
+    Extract `definition` in `mode`; returns (seconds, peak RSS in MB)
+    """
+    options, per_date = MODES[mode]
+    options = [option.format(chunk=chunk_size, workers=workers) for option in options]
+    if "--chunk-size" not in options:
+        options += ["--chunk-size", str(scale)]
+    # Every run builds its own study definition, so the snapshot written by
+    # the first mode does not count as a speedup of the later ones
+    base = [sys.executable, "analysis/pipeline/extract_local.py", "--study-definition", definition,
+            "--output-dir", mode, "--checkpoint-dir", f"checkpoints/{mode}", "--no-snapshot",
+            *options]
+
+    if definition == "study_definition_baseline":
+        runs = [base]
+    elif per_date:
+        runs = [base + ["--index-date-range", date] for date in _generate_date_range(index_date_range)]
+    else:
+        runs = [base + ["--index-date-range", index_date_range]]
+
+    seconds, peak = 0.0, 0.0
+    for args in runs:
+        duration, rss = run(args, path)
+        seconds += duration
+        peak = max(peak, rss or 0.0)
+    return seconds, peak
+
+
+def prepare_cohort(path):
+    """
+    Cohort files (and the sample) read by the outcome and measure study
+    definitions, from the reference baseline
+    """
+    run([sys.executable, "analysis/processing/data_process_baseline.py",
+         "--input", "reference/input_baseline.feather"], path)
+    run([sys.executable, "analysis/processing/sample_cohort.py", "--per-cell", "50"], path)
+
+
+def output_files(path, mode, definition):
+    suffix = definition[len("study_definition"):]
+    return sorted(Path(path, mode).glob(f"input{suffix}*.feather"))
+
+
+#######################################
+# Comparison
+#######################################
+
+def is_flag(values):
+    if values.dtype == bool:
+        return True
+    if pd.api.types.is_integer_dtype(values):
+        return values.dropna().isin([0, 1]).all()
+    return False
+
+
+def column_differences(expected, actual, date_tolerance=0, float_tolerance=1e-9):
+    """
+    Number of rows where two aligned columns differ under the tolerance
+    rules
+    """
+    if pd.api.types.is_datetime64_any_dtype(expected) or pd.api.types.is_datetime64_any_dtype(actual):
+        expected, actual = pd.to_datetime(expected), pd.to_datetime(actual)
+        both = expected.notna() & actual.notna()
+        close = (expected - actual).abs() <= pd.Timedelta(days=date_tolerance)
+        same = (expected.isna() & actual.isna()) | (both & close)
+    elif is_flag(expected) and is_flag(actual):
+        same = expected.astype(bool) == actual.astype(bool)
+    elif pd.api.types.is_numeric_dtype(expected) and pd.api.types.is_numeric_dtype(actual):
+        same = pd.Series(np.isclose(expected.astype(float), actual.astype(float), rtol=float_tolerance,
+                                    atol=0, equal_nan=True), index=expected.index)
+    else:
+        same = expected.astype(object).fillna("").astype(str) == actual.astype(object).fillna("").astype(str)
+    return int((~same).sum())
+
+
+def compare_files(expected_path, actual_path, sampled=False, date_tolerance=0, float_tolerance=1e-9):
+    """
+    [difference] between two output files; with `sampled`, the actual file
+    holds a sample of the expected rows plus their sampling_weight
+    """
+    if not actual_path.exists():
+        return [f"{actual_path.name} missing"]
+    expected = pd.read_feather(expected_path).set_index("patient_id").sort_index()
+    actual = pd.read_feather(actual_path).set_index("patient_id").sort_index()
+
+    differences = []
+    if sampled:
+        weights = actual.pop("sampling_weight") if "sampling_weight" in actual else None
+        if weights is None or (weights < 1).any():
+            differences.append("sampling_weight missing or below 1")
+        extra = actual.index.difference(expected.index)
+        if len(extra):
+            differences.append(f"{len(extra)} sampled patients not in the reference")
+        expected = expected.loc[expected.index.intersection(actual.index)]
+    elif not expected.index.equals(actual.index):
+        missing = len(expected.index.difference(actual.index))
+        extra = len(actual.index.difference(expected.index))
+        differences.append(f"patients: {missing} missing, {extra} extra")
+        common = expected.index.intersection(actual.index)
+        expected, actual = expected.loc[common], actual.loc[common]
+
+    if list(expected.columns) != list(actual.columns):
+        differences.append(f"columns differ: {sorted(set(expected.columns) ^ set(actual.columns))}")
+    for column in expected.columns.intersection(actual.columns):
+        count = column_differences(expected[column], actual[column], date_tolerance, float_tolerance)
+        if count:
+            differences.append(f"{column}: {count} rows")
+    return differences
+
+
+#######################################
+# Report
+#######################################
+
+def check_scale(scale, modes, definitions, args):
+    path = workspace(args.workdir, scale, args.seed)
+    for mode in ["reference", *modes]:
+        shutil.rmtree(path / mode, ignore_errors=True)
+
+    rows = []
+    reference = {}
+    for definition in definitions:
+        reference[definition] = extract(path, "reference", definition, args.index_date_range,
+                                        args.chunk_size, scale, args.workers)
+        if definition == "study_definition_baseline":
+            prepare_cohort(path)
+
+    for mode in modes:
+        for definition in definitions:
+            if mode == "sampled" and definition == "study_definition_baseline":
+                continue
+            seconds, peak = extract(path, mode, definition, args.index_date_range, args.chunk_size,
+                                    scale, args.workers)
+            differences = []
+            files = output_files(path, "reference", definition)
+            for expected in files:
+                differences += [
+                    f"{expected.name} {difference}"
+                    for difference in compare_files(expected, path / mode / expected.name,
+                                                    sampled=mode == "sampled",
+                                                    date_tolerance=args.date_tolerance,
+                                                    float_tolerance=args.float_tolerance)
+                ]
+            ref_seconds, ref_peak = reference[definition]
+            rows.append({
+                "scale": scale,
+                "mode": mode,
+                "definition": definition[len("study_definition_"):],
+                "files": len(files),
+                "passed": not differences,
+                "differences": "; ".join(differences),
+                "seconds": round(seconds, 2),
+                "reference_seconds": round(ref_seconds, 2),
+                "speedup": round(ref_seconds / seconds, 2) if seconds else None,
+                "peak_rss_mb": round(peak, 1),
+                "memory_ratio": round(peak / ref_peak, 2) if ref_peak else None,
+            })
+            status = "pass" if not differences else "FAIL"
+            print(f"{scale:>8}  {mode:12}  {rows[-1]['definition']:9}  {status}  "
+                  f"x{rows[-1]['speedup']} time  x{rows[-1]['memory_ratio']} memory", flush=True)
+            for difference in differences[:10]:
+                print(f"          {difference}")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=int, nargs="+", default=[2_000, 20_000])
+    parser.add_argument("--modes", nargs="+", choices=[mode for mode in MODES if mode != "reference"],
+                        default=[mode for mode in MODES if mode != "reference"])
+    parser.add_argument("--definitions", nargs="+", choices=DEFINITIONS, default=DEFINITIONS)
+    parser.add_argument("--index-date-range", default="2022-09-03 to 2022-09-17 by week")
+    parser.add_argument("--chunk-size", type=int, default=5_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="threads of the concurrent and fast modes")
+    parser.add_argument("--date-tolerance", type=int, default=0, help="days")
+    parser.add_argument("--float-tolerance", type=float, default=1e-9, help="relative")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", type=Path, default=Path("logs", "equivalence"))
+    args = parser.parse_args()
+
+    # The outcome and measure definitions read the cohort made from the baseline
+    definitions = ["study_definition_baseline"] + [d for d in args.definitions
+                                                   if d != "study_definition_baseline"]
+    rows = []
+    for scale in args.scales:
+        rows += check_scale(scale, args.modes, definitions, args)
+
+    report = pd.DataFrame(rows)
+    if "study_definition_baseline" not in args.definitions:
+        report = report[report["definition"] != "baseline"]
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    report.to_csv(args.workdir / "report.csv", index=False)
+    print()
+    print(report.drop(columns=["differences"]).to_string(index=False))
+    return 0 if report["passed"].all() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
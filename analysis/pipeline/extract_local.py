@@ -0,0 +1,401 @@
+##############################################################################
+#
+# This script runs a study definition against the local backend (see
+# local_backend/), writing the same files as `cohortextractor
+# generate_cohort`, e.g. output/input_baseline.feather or
+# output/input_outcomes_2022-09-03.feather for each index date.
+#
+# Patients are extracted in chunks of --chunk-size. Fetching (evaluating
+# the variables), transforming (to Arrow, strings as categories) and
+# writing run on separate threads with bounded queues between them (see
+# local_backend/pipelined.py), so the Feather file is written in batches
+# as chunks complete. Within a chunk, the population is evaluated first and
+# the other variables only for its members, and variables that do not
+# depend on each other are evaluated concurrently by --workers threads (see
+# local_backend/scheduler.py). The records matching each codelist are
+# shared between chunks and index dates (see local_backend/scans.py;
+# --no-shared-scan matches them for each chunk). Every completed group of
+# variables is checkpointed (see local_backend/checkpoints.py), so an
+# interrupted extraction can be continued with --resume instead of
+# starting again:
+#
+#   python analysis/pipeline/extract_local.py --study-definition study_definition_outcomes \
+#       --index-date-range "2022-09-03 to 2023-02-04 by week" --resume
+#
+# Run from the repo root; the backend is a directory written by
+# Backend.save (default output/local_backend). The constructed study
+# definition is restored from a snapshot when its sources are unchanged
+# (see local_backend/snapshots.py), and a breakdown of the startup time is
+# printed. With --population-dir, each extraction's population is also
+# saved as a bitmap and as a patient_id CSV that later study definitions
+# can read with patients.which_exist_in_file() (see
+# local_backend/bitmaps.py).
+#
+##############################################################################
+
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from local_backend.bitmaps import Bitmap, PatientIndex, save_bitmap, write_patient_ids  # noqa: E402
+from local_backend.checkpoints import Checkpoint, checkpoint_key, variable_groups  # noqa: E402
+from local_backend.engine import Extraction, required  # noqa: E402
+from local_backend.events import from_day  # noqa: E402
+from local_backend.pipelined import Pipeline, run_sequentially  # noqa: E402
+from local_backend.scans import SharedScans  # noqa: E402
+from local_backend.scheduler import VariablePool  # noqa: E402
+from local_backend.snapshots import SNAPSHOT_DIR, StartupTimer, load_definitions  # noqa: E402
+from local_backend.tables import Backend  # noqa: E402
+
+
+CHECKPOINT_DIR = Path("logs", "local_extract")
+
+
+#######################################
+# Output
+#######################################
+
+ARROW_TYPES = {
+    "date": pa.timestamp("ns"),
+    "bool": pa.bool_(),
+    "int": pa.int64(),
+    "float": pa.float64(),
+    # Written as categories (see Categories)
+    "str": pa.dictionary(pa.int32(), pa.string()),
+}
+
+
+def output_names(definitions):
+    return [name for name, (_, kwargs) in definitions.items()
+            if not kwargs.get("hidden") and name != "population"]
+
+
+def output_schema(definitions):
+    fields = [pa.field(name, ARROW_TYPES[definitions[name][1]["column_type"]])
+              for name in output_names(definitions)]
+    return pa.schema(fields + [pa.field("patient_id", pa.int64())])
+
+
+def output_table(extraction):
+    """
+    Rows of the chunk's patients in the population, as an Arrow table
+    (strings are plain here and mapped to categories when written)
+    """
+    definitions = extraction.definitions
+    keep = extraction.columns["population"].astype(bool)
+    arrays, names = [], []
+    for name in output_names(definitions):
+        values = extraction.columns[name][keep]
+        column_type = definitions[name][1]["column_type"]
+        if column_type == "date":
+            array = pa.array(from_day(values).astype("datetime64[ns]"), from_pandas=True)
+        elif column_type == "str":
+            array = pa.array(np.where(values == "", None, values), type=pa.string())
+        else:
+            array = pa.array(values)
+        arrays.append(array)
+        names.append(name)
+    arrays.append(pa.array(extraction.patient_id[keep]))
+    names.append("patient_id")
+    return pa.table(arrays, names=names)
+
+
+class Categories:
+    """
+    Running dictionary of each string column: new values are appended, so
+    each chunk's dictionary extends the previous one and is written as a
+    dictionary delta, giving one set of categories for the whole file
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def encode(self, name, array):
+        known = self.values.setdefault(name, {})
+        for value in sorted(set(pc.unique(array).drop_null().to_pylist()) - known.keys()):
+            known[value] = len(known)
+        dictionary = pa.array(list(known), type=pa.string())
+        indices = pc.index_in(array, value_set=dictionary).cast(pa.int32())
+        return pa.DictionaryArray.from_arrays(indices, dictionary)
+
+    def table(self, table, schema):
+        columns = [
+            self.encode(name, column.combine_chunks()) if pa.types.is_dictionary(field.type)
+            else column.cast(field.type)
+            for name, column, field in zip(table.column_names, table.columns, schema)
+        ]
+        return pa.table(columns, schema=schema)
+
+
+class FeatherWriter:
+    """
+    Appends chunks to a Feather (Arrow IPC) file, written under a
+    temporary name until closed
+    """
+
+    def __init__(self, path, schema):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.path.with_name(f".{self.path.name}.tmp")
+        options = pa.ipc.IpcWriteOptions(compression="zstd", emit_dictionary_deltas=True)
+        self.writer = pa.ipc.new_file(str(self.tmp), schema, options=options)
+        self.rows = 0
+
+    def write(self, table):
+        self.writer.write_table(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        self.writer.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.writer.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+class CsvWriter:
+    """
+    Appends chunks to a CSV file, as cohortextractor writes them (flags as
+    0/1)
+    """
+
+    def __init__(self, path, schema):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.path.with_name(f".{self.path.name}.tmp")
+        self.file = open(self.tmp, "w", newline="")
+        self.header = True
+        self.rows = 0
+
+    def write(self, table):
+        df = table.to_pandas()
+        for column in df.columns[df.dtypes == bool]:
+            df[column] = df[column].astype(int)
+        df.to_csv(self.file, header=self.header, index=False, date_format="%Y-%m-%d")
+        self.header = False
+        self.rows += len(df)
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        self.tmp.unlink(missing_ok=True)
+
+
+#######################################
+# Extraction
+#######################################
+
+def evaluate_chunk(backend, definitions, groups, checkpoint, chunk, shared, compiled, pool):
+    """
+    Variables of a chunk's patients, continuing from its last checkpointed
+    group; returns the extraction and the number of groups resumed. Each
+    group is checkpointed once all its variables are evaluated.
+
+    When `compiled`, the population is evaluated first, each of its terms
+    only for the patients still in question (the variables they refer to
+    are evaluated for those patients only), and the other variables only
+    for its members; they are missing for everyone else, whose rows are
+    not written.
+    """
+    start, stop = checkpoint.chunks[chunk]
+    extraction = Extraction(backend, definitions, np.arange(start, stop), shared=shared,
+                            compiled=compiled)
+    columns, done = checkpoint.completed_groups(chunk, groups)
+    extraction.columns.update(columns)
+
+    remaining = {number: set(groups[number]) for number in range(done, len(groups))}
+    group_of = {name: number for number, names in remaining.items() for name in names}
+
+    def on_done(name):
+        number = group_of[name]
+        remaining[number].discard(name)
+        if not remaining[number]:
+            checkpoint.save_group(chunk, number,
+                                  {name: extraction.columns[name] for name in groups[number]})
+
+    pending = [name for group in groups[done:] for name in group]
+    if not compiled or "population" not in definitions:
+        pool.evaluate(extraction, pending, on_done)
+        return extraction, done
+
+    if "population" in pending:
+        # Variables the population refers to are checkpointed for its
+        # members only, so are not used to evaluate it again on resuming
+        restored = {name: extraction.columns.pop(name)
+                    for name in required(definitions, "population") - {"population"}
+                    if name in extraction.columns}
+        pool.evaluate(extraction, ["population"], on_done)
+        extraction.columns.update(restored)
+    keep = extraction.columns["population"].astype(bool)
+    members = extraction.members(keep)
+
+    def on_member_done(name):
+        extraction.expand(members, keep, name)
+        on_done(name)
+
+    # Terms of the population were evaluated for all of its members
+    todo = [name for name in pending if name != "population"]
+    for name in [name for name in todo if name in members.columns]:
+        on_member_done(name)
+    pool.evaluate(members, [name for name in todo if name not in members.columns], on_member_done)
+    return extraction, done
+
+
+def extract(backend, definitions, index_date, output_path, output_format, checkpoint_dir,
+            chunk_size, resume=False, pipelined=True, queue_size=2, shared=None, compiled=True,
+            pool=None, population_dir=None):
+    """
+    Extract the study definition to `output_path`; chunks are fetched
+    (variables evaluated, concurrently on `pool` if given), transformed
+    (population rows as Arrow, strings as categories) and written on
+    separate threads unless `pipelined` is False. Chunks share the records
+    matched for each codelist through `shared` (a SharedScans, which can
+    also be passed between index dates); with None each chunk matches its
+    own. With `population_dir`, the population is saved there (see
+    save_population).
+    Returns the number of rows and the seconds spent in each stage.
+    """
+    pool = pool or VariablePool(1)
+    key = checkpoint_key(definitions, index_date, backend.path, chunk_size)
+    checkpoint = Checkpoint.open(checkpoint_dir / output_path.stem, key, backend.patient_id,
+                                 chunk_size, resume=resume)
+    groups = variable_groups(definitions)
+    schema = output_schema(definitions)
+    categories = Categories()
+    chunks = len(checkpoint.chunks)
+
+    def fetch():
+        for chunk in range(chunks):
+            if checkpoint.chunk_done(chunk):
+                yield chunk, checkpoint.load_part(chunk), "from checkpoint"
+                continue
+            extraction, resumed = evaluate_chunk(backend, definitions, groups, checkpoint, chunk,
+                                                 SharedScans() if shared is None else shared, compiled,
+                                                 pool)
+            note = f" (resumed after {resumed} of {len(groups)} groups)" if resumed else ""
+            yield chunk, extraction, f"extracted{note}"
+
+    def transform(item):
+        chunk, extraction, note = item
+        if isinstance(extraction, Extraction):
+            part = output_table(extraction)
+            checkpoint.save_part(chunk, part)
+        else:
+            part = extraction
+        return chunk, categories.table(part, schema), note
+
+    writer = (CsvWriter if output_format == "csv" else FeatherWriter)(output_path, schema)
+    population = []
+
+    def write(item):
+        chunk, table, note = item
+        writer.write(table)
+        population.append(table.column("patient_id").to_numpy())
+        print(f"  chunk {chunk + 1}/{chunks}: {note}")
+
+    names = ["fetch", "transform", "write"]
+    try:
+        if pipelined:
+            busy = Pipeline(fetch(), [transform], write, queue_size=queue_size, names=names).run()
+        else:
+            busy = run_sequentially(fetch(), [transform], write, names=names)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    if population_dir is not None:
+        save_population(population_dir, output_path.stem, backend, population)
+    checkpoint.remove()
+    return writer.rows, busy
+
+
+def save_population(population_dir, name, backend, patient_ids):
+    """
+    Save the patients written (the population) as a bitmap over the
+    backend's patients (<name>.npz, read with bitmaps.load_bitmap) and as
+    a patient_id CSV (<name>.csv) for patients.which_exist_in_file()
+    """
+    index = PatientIndex(backend.patient_id)
+    ids = np.concatenate(patient_ids) if patient_ids else np.array([], dtype=np.int64)
+    bitmap = Bitmap.from_positions(index.positions(ids), len(index))
+    save_bitmap(Path(population_dir, f"{name}.npz"), bitmap, index)
+    write_patient_ids(Path(population_dir, f"{name}.csv"), bitmap, index)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study-definition", default="study_definition")
+    parser.add_argument("--backend", default="output/local_backend")
+    parser.add_argument("--index-date-range", default=None)
+    parser.add_argument("--output-dir", default="output")
+    parser.add_argument("--output-format", choices=["feather", "csv"], default="feather")
+    parser.add_argument("--param", action="append", default=[], help="key=value study parameter")
+    parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR, type=Path)
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint of an interrupted extraction")
+    parser.add_argument("--chunk-size", type=int, default=100_000, help="patients per chunk")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="chunks held between the fetch, transform and write stages")
+    parser.add_argument("--no-pipeline", action="store_true",
+                        help="run the fetch, transform and write stages in turn")
+    parser.add_argument("--no-shared-scan", action="store_true",
+                        help="match codelists separately for each chunk and index date")
+    parser.add_argument("--reference-expressions", action="store_true",
+                        help="evaluate every expression term and every variable for everyone")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="threads evaluating independent variables concurrently")
+    parser.add_argument("--reference", action="store_true",
+                        help="all of --no-pipeline, --no-shared-scan, --reference-expressions "
+                             "and --workers 1")
+    parser.add_argument("--population-dir", default=None, type=Path,
+                        help="also save each population as a bitmap and a patient_id CSV here")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR, type=Path)
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="build the study definition without reading or writing a snapshot")
+    args = parser.parse_args()
+
+    params = dict(param.split("=", 1) for param in args.param)
+    timer = StartupTimer()
+    index_dates, definitions = load_definitions(args.study_definition, params, args.index_date_range,
+                                                args.snapshot_dir, not args.no_snapshot, timer)
+    with timer.phase("open backend"):
+        backend = Backend.load(args.backend)
+    print(timer.report())
+    suffix = args.study_definition[len("study_definition"):]
+
+    if args.reference:
+        args.no_pipeline = args.no_shared_scan = args.reference_expressions = True
+        args.workers = 1
+
+    shared = None if args.no_shared_scan else SharedScans()
+    pool = VariablePool(args.workers)
+    for index_date, covariate_definitions in zip(index_dates, definitions):
+        date_suffix = f"_{index_date}" if index_date else ""
+        output_path = Path(args.output_dir, f"input{suffix}{date_suffix}.{args.output_format}")
+        print(f"Extracting {output_path}")
+        started = time.perf_counter()
+        rows, busy = extract(backend, covariate_definitions, index_date, output_path,
+                             args.output_format, args.checkpoint_dir, args.chunk_size, args.resume,
+                             pipelined=not args.no_pipeline, queue_size=args.queue_size,
+                             shared=shared, compiled=not args.reference_expressions, pool=pool,
+                             population_dir=args.population_dir)
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in busy.items())
+        print(f"  {rows} rows in {time.perf_counter() - started:.1f}s ({stages})")
+    pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+##############################################################################
+#
+# This script keeps a history of local pipeline runs (see run_local.py) in
+# an SQLite file, one row per action run: duration, peak memory and the
+# number of rows and bytes of the action's inputs (the outputs of the
+# actions it needs) and outputs, as matched by the project.yaml output
+# patterns.
+#
+# The history gives the scheduler measured durations in place of the
+# per-image defaults (dag.py), and `compare` flags actions whose time or
+# memory regressed against their previous successful run.
+#
+# Usage (from the repo root):
+#   python analysis/pipeline/history.py runs
+#   python analysis/pipeline/history.py compare                 # latest run
+#   python analysis/pipeline/history.py compare --run 12 --baseline 10 --threshold 0.5
+#
+# Peak memory (peak_rss_mb) is measured as described in peak_memory.py:
+# wait4 for processes run directly, the container's cgroup or
+# `docker stats` for `opensafely exec`. It is NULL where it could not be
+# measured, and such runs are not compared for memory.
+#
+##############################################################################
+
+
+import argparse
+import glob
+import sqlite3
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+HISTORY_FILE = Path("logs", "local_run", "history.sqlite")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    command TEXT
+);
+CREATE TABLE IF NOT EXISTS actions (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id),
+    action TEXT NOT NULL,
+    returncode INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    peak_rss_mb REAL,
+    input_rows INTEGER,
+    input_bytes INTEGER,
+    output_rows INTEGER,
+    output_bytes INTEGER,
+    PRIMARY KEY (run_id, action)
+);
+"""
+
+
+def connect(path=HISTORY_FILE):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    # History files written before peak memory was recorded
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(actions)")]
+    if "peak_rss_mb" not in columns:
+        connection.execute("ALTER TABLE actions ADD COLUMN peak_rss_mb REAL")
+    return connection
+
+
+def start_run(connection, command):
+    cursor = connection.execute(
+        "INSERT INTO runs (started, command) VALUES (?, ?)", (time.time(), command)
+    )
+    connection.commit()
+    return cursor.lastrowid
+
+
+#######################################
+# File statistics
+#######################################
+
+def count_rows(path):
+    """
+    Number of rows in a CSV, Feather/Arrow or Parquet file (None for other
+    files)
+    """
+    suffix = path.suffix.lower()
+    try:
+        if suffix == ".csv":
+            # Lines less the header, counted in 1MB blocks
+            lines = 0
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    lines += block.count(b"\n")
+            return max(lines - 1, 0)
+        if suffix in (".feather", ".arrow"):
+            with pa.memory_map(str(path), "r") as source:
+                reader = pa.ipc.open_file(source)
+                return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+        if suffix == ".parquet":
+            return pq.ParquetFile(path).metadata.num_rows
+    except (OSError, pa.ArrowInvalid):
+        return None
+    return None
+
+
+def file_stats(patterns):
+    """
+    (rows, bytes) of all files matching the output `patterns`
+    """
+    rows = size = 0
+    for pattern in patterns:
+        for name in glob.glob(pattern):
+            path = Path(name)
+            size += path.stat().st_size
+            rows += count_rows(path) or 0
+    return rows, size
+
+
+def record_action(connection, run_id, action, actions, returncode, seconds, peak_rss_mb=None):
+    input_patterns = [pattern for need in action.needs for pattern in actions[need].outputs]
+    input_rows, input_bytes = file_stats(input_patterns)
+    output_rows, output_bytes = file_stats(action.outputs)
+    connection.execute(
+        """
+        INSERT OR REPLACE INTO actions (run_id, action, returncode, seconds, peak_rss_mb,
+                                        input_rows, input_bytes, output_rows, output_bytes)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (run_id, action.name, returncode, seconds, peak_rss_mb,
+         input_rows, input_bytes, output_rows, output_bytes),
+    )
+    connection.commit()
+
+
+#######################################
+# Queries
+#######################################
+
+def previous_durations(connection, last=5):
+    """
+    {action: median seconds of its last `last` successful runs}, for the
+    scheduler's critical-path priorities
+    """
+    rows = connection.execute(
+        "SELECT action, seconds FROM actions WHERE returncode = 0 ORDER BY run_id DESC"
+    ).fetchall()
+    seconds = {}
+    for action, duration in rows:
+        seconds.setdefault(action, [])
+        if len(seconds[action]) < last:
+            seconds[action].append(duration)
+    return {action: statistics.median(values) for action, values in seconds.items()}
+
+
+def latest_run(connection):
+    row = connection.execute("SELECT MAX(run_id) FROM actions").fetchone()
+    return row[0]
+
+
+def run_results(connection, run_id):
+    rows = connection.execute(
+        "SELECT action, returncode, seconds, peak_rss_mb, output_rows FROM actions WHERE run_id = ?",
+        (run_id,),
+    ).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+
+def baseline_results(connection, run_id, baseline=None):
+    """
+    Results to compare run `run_id` against: run `baseline` if given,
+    otherwise each action's latest successful run before `run_id`
+    """
+    if baseline is not None:
+        return run_results(connection, baseline)
+    rows = connection.execute(
+        """
+        SELECT action, returncode, seconds, peak_rss_mb, output_rows FROM actions
+        WHERE returncode = 0 AND run_id = (
+            SELECT MAX(run_id) FROM actions AS previous
+            WHERE previous.action = actions.action AND previous.returncode = 0
+              AND previous.run_id < ?
+        )
+        """,
+        (run_id,),
+    ).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+
+def regressions(current, baseline, threshold=0.2, min_seconds=5.0, min_mb=50.0):
+    """
+    [(action, measure, before, after)] for successful actions that took
+    more than `threshold` (a fraction) longer, or used that much more
+    memory, than in the baseline. Differences under `min_seconds` /
+    `min_mb` are ignored as noise, and memory is only compared where both
+    runs measured it.
+    """
+    flagged = []
+    for action, (returncode, seconds, rss, _) in sorted(current.items()):
+        if returncode != 0 or action not in baseline:
+            continue
+        _, before_seconds, before_rss, _ = baseline[action]
+        if seconds > before_seconds * (1 + threshold) and seconds - before_seconds >= min_seconds:
+            flagged.append((action, "seconds", before_seconds, seconds))
+        if rss is not None and before_rss is not None \
+                and rss > before_rss * (1 + threshold) and rss - before_rss >= min_mb:
+            flagged.append((action, "peak_rss_mb", before_rss, rss))
+    return flagged
+
+
+#######################################
+# Commands
+#######################################
+
+def show_runs(connection):
+    rows = connection.execute(
+        """
+        SELECT runs.run_id, runs.started, COUNT(actions.action),
+               SUM(actions.returncode != 0), SUM(actions.seconds)
+        FROM runs LEFT JOIN actions USING (run_id)
+        GROUP BY runs.run_id ORDER BY runs.run_id
+        """
+    ).fetchall()
+    print(f"{'run':>5}  {'started':19}  {'actions':>7}  {'failed':>6}  {'action seconds':>14}")
+    for run_id, started, n, failed, seconds in rows:
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started))
+        print(f"{run_id:>5}  {started:19}  {n:>7}  {failed or 0:>6}  {seconds or 0:>14.0f}")
+
+
+def compare(connection, run_id=None, baseline=None, threshold=0.2, min_seconds=5.0, min_mb=50.0):
+    """
+    Print the regressions of a run; returns 1 if there are any, so the
+    command can gate a script
+    """
+    run_id = run_id or latest_run(connection)
+    if run_id is None:
+        print("No runs recorded")
+        return 0
+    current = run_results(connection, run_id)
+    before = baseline_results(connection, run_id, baseline)
+    flagged = regressions(current, before, threshold, min_seconds, min_mb)
+
+    against = f"run {baseline}" if baseline is not None else "previous successful runs"
+    print(f"Run {run_id}: {len(current)} actions compared against {against}")
+    for action, (_, _, _, rows) in sorted(current.items()):
+        if action in before and rows is not None and before[action][3] is not None \
+                and rows != before[action][3]:
+            print(f"  note: {action} output rows {before[action][3]} -> {rows}")
+    for action, measure, old, new in flagged:
+        change = f"{new / old - 1:+.0%}" if old else "from zero"
+        print(f"  REGRESSION {action}: {measure} {old:.1f} -> {new:.1f} ({change})")
+    if not flagged:
+        print(f"  no regressions above {threshold:.0%}")
+    return 1 if flagged else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", default=HISTORY_FILE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("runs", help="list recorded runs")
+    compare_parser = commands.add_parser("compare", help="flag time/memory regressions")
+    compare_parser.add_argument("--run", type=int, default=None, help="default: latest run")
+    compare_parser.add_argument("--baseline", type=int, default=None,
+                                help="run to compare against (default: each action's "
+                                     "previous successful run)")
+    compare_parser.add_argument("--threshold", type=float, default=0.2,
+                                help="relative increase flagged, e.g. 0.2 for 20%%")
+    compare_parser.add_argument("--min-seconds", type=float, default=5.0)
+    compare_parser.add_argument("--min-mb", type=float, default=50.0)
+    args = parser.parse_args()
+
+    connection = connect(args.history)
+    if args.command == "runs":
+        show_runs(connection)
+        return 0
+    return compare(connection, args.run, args.baseline, args.threshold,
+                   args.min_seconds, args.min_mb)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
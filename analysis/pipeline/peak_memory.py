@@ -0,0 +1,126 @@
+##############################################################################
+#
+# This script measures the peak memory of the actions run by run_local.py
+# (recorded in the run history, see history.py) and of the extractions
+# run by equivalence.py.
+#
+# A process started directly (extract_local.py with --local-extract, or a
+# --command running scripts without a container) is measured by
+# wait4: the peak RSS of the process and the children it waited for.
+#
+# With `opensafely exec` (or `docker run`) the action runs in a container
+# and the process started is only the client, so its RSS says nothing
+# about the action. While the client runs, the container running the
+# action is found by its command (the action's run: line without the
+# image) and its memory is sampled: the peak from its cgroup
+# (memory.peak, or memory.max_usage_in_bytes with cgroup v1) where the
+# cgroup is visible, otherwise the usage from `docker stats`. The result
+# is the largest value sampled, so a peak between samples can be missed
+# when only `docker stats` is available. Where no container is found the
+# peak is None (NULL in the history).
+#
+##############################################################################
+
+
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+CGROUP_FILES = [
+    # cgroup v2, systemd and cgroupfs drivers
+    "/sys/fs/cgroup/system.slice/docker-{id}.scope/memory.peak",
+    "/sys/fs/cgroup/docker/{id}/memory.peak",
+    # cgroup v1
+    "/sys/fs/cgroup/memory/system.slice/docker-{id}.scope/memory.max_usage_in_bytes",
+    "/sys/fs/cgroup/memory/docker/{id}/memory.max_usage_in_bytes",
+]
+
+UNITS = {"B": 1, "KIB": 1024, "MIB": 1024**2, "GIB": 1024**3, "TIB": 1024**4,
+         "KB": 1000, "MB": 1000**2, "GB": 1000**3, "TB": 1000**4}
+
+
+def wait(process):
+    """
+    Wait for `process`; returns (returncode, peak RSS in MB of the process
+    and the children it waited for, or None where this is not available)
+    """
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return process.returncode, usage.ru_maxrss / scale
+
+
+def docker(*args):
+    """
+    Output of a docker command, or None if it failed
+    """
+    try:
+        result = subprocess.run(["docker", *args], capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+
+def find_container(run):
+    """
+    Id of the running container whose command is the `run:` line of an
+    action less its image (the container's entrypoint), or None
+    """
+    command = " ".join(shlex.split(run)[1:])
+    output = docker("ps", "--no-trunc", "--format", "{{.ID}}\t{{.Command}}")
+    for line in (output or "").splitlines():
+        container, _, container_command = line.partition("\t")
+        if command and command in container_command.strip('"'):
+            return container
+    return None
+
+
+def container_memory_mb(container):
+    """
+    Peak memory of `container` from its cgroup, else its current usage
+    from `docker stats`, in MB (None if neither is available)
+    """
+    for pattern in CGROUP_FILES:
+        try:
+            return int(Path(pattern.format(id=container)).read_text()) / 1024**2
+        except (OSError, ValueError):
+            continue
+    output = docker("stats", "--no-stream", "--format", "{{.MemUsage}}", container)
+    match = re.match(r"\s*([\d.]+)\s*([A-Za-z]+)", output or "")
+    if not match or match.group(2).upper() not in UNITS:
+        return None
+    return float(match.group(1)) * UNITS[match.group(2).upper()] / 1024**2
+
+
+def wait_container(process, run, interval=2.0):
+    """
+    Wait for `process`, an `opensafely exec` / `docker run` client running
+    the action `run`; returns (returncode, largest memory in MB sampled
+    from the action's container, or None if it was not found)
+    """
+    container = None
+    peak = None
+    while process.poll() is None:
+        container = container or find_container(run)
+        if container:
+            memory = container_memory_mb(container)
+            if memory is not None:
+                peak = max(peak or 0.0, memory)
+        time.sleep(interval)
+    return process.returncode, peak
+
+
+def runs_in_container(args):
+    """
+    Whether `args` start a container rather than the action itself
+    """
+    program = Path(args[0]).name if args else ""
+    return program == "opensafely" or (program == "docker" and args[1:2] == ["run"])
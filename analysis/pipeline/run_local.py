@@ -0,0 +1,269 @@
+##############################################################################
+#
+# This script runs the project.yaml pipeline locally, running actions
+# concurrently as soon as everything they need has finished.
+#
+# Ready actions are started in order of critical-path length (see dag.py)
+# while they fit in the CPU and memory budgets, so the wall-clock time of
+# a full rerun approaches the longest chain of dependent actions.
+#
+# Usage (from the repo root):
+#   python analysis/pipeline/run_local.py                 # all actions
+#   python analysis/pipeline/run_local.py sharp_analysis  # and its needs
+#   python analysis/pipeline/run_local.py --cpus 4 --memory 16 --dry-run
+#
+# Each action is run with `opensafely exec <run>` (see --command) and its
+# output is written to logs/local_run/<action>.log. Durations, peak
+# memory (see peak_memory.py) and row counts are recorded in the run
+# history (see history.py), and previous durations are used for the
+# critical-path priorities.
+#
+# With --local-extract, `cohortextractor generate_cohort` actions are run
+# by extract_local.py against a local backend instead (by default the
+# synthetic backend in output/local_backend, written first if missing; see
+# synthetic_backend.py), so every extraction reads the same patient
+# timelines.
+#
+##############################################################################
+
+
+import argparse
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import history
+from dag import critical_path_lengths, load_actions, select
+from peak_memory import runs_in_container, wait, wait_container
+
+
+# Default resources used by one action, by image (memory in GB)
+DEFAULT_RESOURCES = {
+    "cohortextractor": {"cpus": 1, "memory": 4.0},
+    "r": {"cpus": 1, "memory": 2.0},
+    "python": {"cpus": 1, "memory": 1.0},
+}
+
+LOG_DIR = Path("logs", "local_run")
+
+BACKEND_DIR = Path("output", "local_backend")
+
+
+def total_memory_gb():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+    except (ValueError, OSError, AttributeError):
+        return 8.0
+
+
+def action_resources(action, memory_overrides):
+    resources = dict(DEFAULT_RESOURCES.get(action.image, {"cpus": 1, "memory": 1.0}))
+    for key in (action.name, action.image):
+        if key in memory_overrides:
+            resources["memory"] = memory_overrides[key]
+            break
+    return resources
+
+
+def local_extraction(action, backend):
+    """
+    extract_local.py arguments for a `cohortextractor generate_cohort`
+    action (None for other actions). The output directory is that of the
+    action's declared outputs.
+    """
+    args = shlex.split(action.run)
+    if action.image != "cohortextractor" or args[1:2] != ["generate_cohort"]:
+        return None
+    options, rest = [], iter(args[2:])
+    for arg in rest:
+        if arg == "--output-dir":
+            next(rest, None)
+        elif not arg.startswith("--output-dir="):
+            options.append(arg)
+    output_dir = Path(action.outputs[0]).parent if action.outputs else Path("output")
+    return [sys.executable, "analysis/pipeline/extract_local.py", *options,
+            "--output-dir", str(output_dir), "--backend", str(backend)]
+
+
+def run_action(action, command, done, local_backend=None):
+    """
+    Run one action (in a worker thread) and report (name, returncode,
+    seconds, peak memory in MB or None) on the `done` queue
+    """
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
+    args = local_extraction(action, local_backend) if local_backend else None
+    args = args or shlex.split(command.format(run=action.run))
+    start = time.monotonic()
+    peak_mb = None
+    with open(LOG_DIR / f"{action.name}.log", "w") as log:
+        try:
+            process = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT)
+            if runs_in_container(args):
+                returncode, peak_mb = wait_container(process, action.run)
+            else:
+                returncode, peak_mb = wait(process)
+        except OSError as e:
+            log.write(f"Could not start {args[0]}: {e}\n")
+            returncode = 127
+    done.put((action.name, returncode, time.monotonic() - start, peak_mb))
+
+
+def schedule(actions, cpus, memory, memory_overrides, command, keep_going=False,
+             durations=None, dry_run=False, on_finish=None, local_backend=None):
+    """
+    Run `actions` respecting their needs and the cpu/memory budgets.
+    Returns {name: (returncode, seconds)} for the actions that were run.
+    With `local_backend`, extractions are run locally against it.
+
+    `on_finish(name, returncode, seconds, peak_mb)` is called as each
+    action ends.
+    """
+    priority = critical_path_lengths(actions, durations)
+    resources = {name: action_resources(a, memory_overrides) for name, a in actions.items()}
+
+    if dry_run:
+        # Report the start order the scheduler would use if every action
+        # took its estimated time and fitted the budget
+        for name in sorted(actions, key=lambda n: -priority[n]):
+            print(f"{priority[name]:8.1f}  {name}")
+        return {}
+
+    waiting = set(actions)
+    running = {}
+    results = {}
+    failed = False
+    done = queue.Queue()
+
+    while waiting or running:
+        ready = sorted(
+            (n for n in waiting if all(need in results and results[need][0] == 0
+                                       for need in actions[n].needs)),
+            key=lambda n: -priority[n],
+        )
+        if not failed or keep_going:
+            for name in ready:
+                used_cpus = sum(resources[n]["cpus"] for n in running)
+                used_memory = sum(resources[n]["memory"] for n in running)
+                fits = (used_cpus + resources[name]["cpus"] <= cpus
+                        and used_memory + resources[name]["memory"] <= memory)
+                # An action bigger than the whole budget runs on its own
+                if fits or not running:
+                    waiting.remove(name)
+                    running[name] = time.monotonic()
+                    print(f"[start] {name}", flush=True)
+                    threading.Thread(
+                        target=run_action, args=(actions[name], command, done, local_backend),
+                        daemon=True,
+                    ).start()
+
+        if not running:
+            # Nothing can start: remaining actions need a failed action
+            break
+
+        name, returncode, seconds, peak_mb = done.get()
+        del running[name]
+        results[name] = (returncode, seconds)
+        status = "done" if returncode == 0 else f"FAILED ({returncode})"
+        print(f"[{status}] {name} in {seconds:.0f}s", flush=True)
+        if on_finish:
+            on_finish(name, returncode, seconds, peak_mb)
+        if returncode != 0:
+            failed = True
+
+    for name in sorted(waiting):
+        print(f"[skipped] {name}")
+    return results
+
+
+def parse_memory_overrides(values):
+    overrides = {}
+    for value in values:
+        key, _, gb = value.partition("=")
+        overrides[key] = float(gb)
+    return overrides
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("actions", nargs="*",
+                        help="actions to run, with everything they need (default: all)")
+    parser.add_argument("--project", default="project.yaml")
+    parser.add_argument("--cpus", type=int, default=os.cpu_count() or 1,
+                        help="CPU budget shared by running actions")
+    parser.add_argument("--memory", type=float, default=total_memory_gb(),
+                        help="memory budget in GB shared by running actions")
+    parser.add_argument("--action-memory", action="append", default=[],
+                        metavar="NAME=GB",
+                        help="memory for an action or image, e.g. cohortextractor=8")
+    parser.add_argument("--command", default="opensafely exec {run}",
+                        help="command used to run each action; {run} is its run: line")
+    parser.add_argument("--local-extract", action="store_true",
+                        help="run generate_cohort actions with extract_local.py")
+    parser.add_argument("--backend", type=Path, default=BACKEND_DIR,
+                        help="local backend for --local-extract (synthetic if missing)")
+    parser.add_argument("--synthetic-size", type=int, default=100_000,
+                        help="patients in the synthetic backend written if --backend is missing")
+    parser.add_argument("--keep-going", action="store_true",
+                        help="keep starting independent actions after a failure")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the start order and exit")
+    parser.add_argument("--history", default=history.HISTORY_FILE,
+                        help="SQLite run history (see history.py)")
+    parser.add_argument("--no-history", action="store_true",
+                        help="do not record this run or use previous durations")
+    args = parser.parse_args()
+
+    all_actions = load_actions(args.project)
+    actions = all_actions
+    if args.actions and args.actions != ["run_all"]:
+        actions = select(actions, args.actions)
+
+    durations = None
+    on_finish = None
+    if not args.no_history:
+        connection = history.connect(args.history)
+        durations = history.previous_durations(connection)
+        if not args.dry_run:
+            run_id = history.start_run(connection, " ".join(sys.argv[1:]))
+
+            def on_finish(name, returncode, seconds, peak_mb):
+                history.record_action(connection, run_id, all_actions[name], all_actions,
+                                      returncode, seconds, peak_mb)
+
+    local_backend = None
+    if args.local_extract:
+        local_backend = args.backend
+        if not (local_backend / "patients").is_dir() and not args.dry_run:
+            # Needs cohortextractor (for the codelists), so only imported here
+            from synthetic_backend import write_backend
+            print(f"Writing a synthetic backend of {args.synthetic_size} patients to {local_backend}")
+            write_backend(local_backend, args.synthetic_size)
+
+    start = time.monotonic()
+    results = schedule(
+        actions,
+        cpus=args.cpus,
+        memory=args.memory,
+        memory_overrides=parse_memory_overrides(args.action_memory),
+        command=args.command,
+        keep_going=args.keep_going,
+        durations=durations,
+        dry_run=args.dry_run,
+        on_finish=on_finish,
+        local_backend=local_backend,
+    )
+    if args.dry_run:
+        return 0
+
+    print(f"Finished in {time.monotonic() - start:.0f}s")
+    ok = len(results) == len(actions) and all(r == 0 for r, _ in results.values())
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
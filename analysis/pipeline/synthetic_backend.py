@@ -0,0 +1,241 @@
+##############################################################################
+#
+# This script writes a synthetic local backend (see local_backend/tables.py):
+# one timeline of records per patient, saved once as columnar tables, from
+# which extract_local.py evaluates every study definition and index date.
+# With `run_local.py --local-extract` the whole pipeline is rehearsed
+# against it, with outcomes that agree between overlapping windows and
+# index dates, unlike cohortextractor's dummy data, which is drawn
+# independently for each extraction.
+#
+# Codes are drawn from the study's codelists, so every variable of the
+# study definitions has matching records. For each codelist a fraction of
+# patients (`incidence`) get a Poisson number of records with codes from
+# it, on days spread over 2019-2023: SNOMED CT and CTV3 codelists as
+# clinical events (SNOMED CT also as medications), ICD-10 codelists as
+# hospital admission diagnoses and causes of death, and codelists named
+# *emergency* as emergency care diagnoses. Records fall between each
+# patient's birth and death. Everything is drawn from one seeded
+# generator, so a (size, seed) pair always gives the same backend.
+#
+# Usage (from the repo root):
+#   python analysis/pipeline/synthetic_backend.py --size 200000
+#
+##############################################################################
+
+
+import argparse
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cohortextractor.codelistlib import Codelist
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import codelists  # noqa: E402
+from local_backend.ecds import Attendances  # noqa: E402
+from local_backend.events import NO_DAY, Events, to_day  # noqa: E402
+from local_backend.intervals import Intervals  # noqa: E402
+from local_backend.tables import Backend  # noqa: E402
+
+
+BACKEND_DIR = Path("output", "local_backend")
+
+FIRST_DAY = to_day(["2019-01-01"])[0]
+LAST_DAY = to_day(["2023-06-30"])[0]
+
+REGIONS = ["East", "East Midlands", "London", "North East", "North West", "South East",
+           "South West", "West Midlands", "Yorkshire and The Humber"]
+
+ADMISSION_METHODS = ["11", "12", "21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28", "31"]
+
+
+def module_codelists(module):
+    """
+    {system: {name: [codes]}} of every codelist defined in `module`
+    """
+    codes = {}
+    for name, value in vars(module).items():
+        if isinstance(value, Codelist):
+            items = [item[0] if isinstance(item, tuple) else item for item in value]
+            codes.setdefault(value.system, {})[name] = items
+    return codes
+
+
+def days(rng, size, first=FIRST_DAY, last=LAST_DAY):
+    return rng.integers(first, last + 1, size).astype(np.int32)
+
+
+def during_life(patient_id, day, dob, dod):
+    """
+    Mask of records between the patient's birth and death (`dob` and `dod`
+    are indexed by patient_id - 1)
+    """
+    position = patient_id - 1
+    return (day >= dob[position]) & ((dod[position] == NO_DAY) | (day <= dod[position]))
+
+
+def records(rng, patient_id, codelists, incidence, alive, mean_records=1.5):
+    """
+    (patient_id, day, code) of records from each codelist for a random
+    `incidence` of patients, dropping any drawn after their death
+    """
+    patients, codes = [], []
+    for items in codelists:
+        has = rng.random(len(patient_id)) < incidence
+        counts = rng.poisson(mean_records - 1, has.sum()) + 1
+        patients.append(np.repeat(patient_id[has], counts))
+        codes.append(np.asarray(items)[rng.integers(0, len(items), counts.sum())])
+    patients = np.concatenate(patients) if patients else np.array([], dtype=np.int64)
+    codes = np.concatenate(codes) if codes else np.array([])
+    day = days(rng, len(patients))
+    keep = alive(patients, day)
+    return patients[keep], day[keep], codes[keep]
+
+
+def attendances(rng, patient_id, codelists, incidence, system, alive, values=None):
+    """
+    Attendances of a random `incidence` of patients, each with one to three
+    diagnoses from one codelist, dropping any drawn after their death
+    """
+    count = int(len(patient_id) * incidence)
+    chosen = rng.integers(0, len(codelists), count)
+    diagnoses = [
+        np.asarray(codelists[i])[rng.integers(0, len(codelists[i]), rng.integers(1, 4))] for i in chosen
+    ]
+    values = {name: make(count) for name, make in (values or {}).items()}
+    patients, day = rng.choice(patient_id, count), days(rng, count)
+    keep = alive(patients, day)
+    return Attendances.from_lists(patients[keep], day[keep], [d for d, k in zip(diagnoses, keep) if k],
+                                  system=system,
+                                  values={name: value[keep] for name, value in values.items()})
+
+
+def generate(size, codelists_module, seed=0, incidence=0.05):
+    """
+    Backend of `size` patients
+    """
+    rng = np.random.default_rng(seed)
+    codes = {system: list(lists.values()) for system, lists in module_codelists(codelists_module).items()}
+    # Emergency care diagnoses from the emergency codelists (if any)
+    emergency = [items for name, items in module_codelists(codelists_module).get("snomed", {}).items()
+                 if "emergency" in name] or codes.get("snomed", [])
+    patient_id = np.arange(1, size + 1, dtype=np.int64)
+
+    # Born 1950-1990 (first of the month); 5% died from mid-2021
+    dob = to_day(np.datetime64("1950-01") + rng.integers(0, 480, size).astype("timedelta64[M]"))
+    died = rng.random(size) < 0.05
+    dod = np.where(died, days(rng, size, to_day(["2021-07-01"])[0]), NO_DAY).astype(np.int32)
+    icd10 = [code for items in codes.get("icd10", []) for code in items] + ["I219", "C509", "J45"]
+    def alive(patients, day):
+        return during_life(patients, day, dob, dod)
+
+    death_cause = np.where(died, np.asarray(icd10)[rng.integers(0, len(icd10), size)], "")
+    patients = {
+        "patient_id": patient_id,
+        "dob": dob,
+        "sex": rng.choice(["F", "M", "U"], size, p=[0.49, 0.49, 0.02]),
+        "dod": dod,
+        "death_cause": death_cause,
+    }
+
+    # Underlying cause plus another cause for some deaths
+    other = died & (rng.random(size) < 0.5)
+    death_causes = Events(
+        np.concatenate([patient_id[died], patient_id[other]]),
+        np.concatenate([dod[died], dod[other]]),
+        np.concatenate([death_cause[died], np.asarray(icd10)[rng.integers(0, len(icd10), other.sum())]]),
+    )
+
+    # One registration each, 10% ending before the study
+    start = days(rng, size, to_day(["2000-01-01"])[0], to_day(["2021-06-30"])[0])
+    end = np.where(rng.random(size) < 0.1, start + rng.integers(30, 1000, size), NO_DAY)
+    registrations = Intervals(patient_id, start, end,
+                              {"region": np.asarray(REGIONS)[rng.integers(0, len(REGIONS), size)]})
+    addresses = Intervals(patient_id, start, np.full(size, NO_DAY), {
+        "imd": rng.integers(1, 32845, size),
+        "care_home": rng.random(size) < 0.02,
+        "nursing": rng.random(size) < 0.5,
+    })
+
+    snomed = Events(*records(rng, patient_id, codes.get("snomed", []), incidence, alive))
+    clinical_ctv3 = Events(*records(rng, patient_id, codes.get("ctv3", []), incidence, alive))
+    medications = Events(*records(rng, patient_id, codes.get("snomed", []), incidence / 2, alive))
+
+    # Up to four COVID-19 doses and a flu vaccination
+    vax_patients = np.repeat(patient_id, 5)
+    vax_days = np.tile(to_day(["2021-01-01", "2021-06-01", "2021-12-01", "2022-09-05", "2022-09-05"]),
+                       size) + rng.integers(0, 120, 5 * size)
+    given = rng.random(5 * size) < np.tile([0.95, 0.9, 0.7, 0.4, 0.5], size)
+    given &= alive(vax_patients, vax_days)
+    targets = np.tile(["SARS-2 CORONAVIRUS"] * 4 + ["INFLUENZA"], size)
+    vaccinations = Events(vax_patients[given], vax_days[given], targets[given])
+
+    admissions = attendances(rng, patient_id, codes.get("icd10", []) + [["J189", "I219"]], 1.0,
+                             "icd10", alive, {
+                                 "admission_method": lambda n: np.asarray(ADMISSION_METHODS)[
+                                     rng.integers(0, len(ADMISSION_METHODS), n)],
+                                 "patient_classification": lambda n: rng.choice(["1", "2"], n, p=[0.8, 0.2]),
+                                 "primary_diagnosis": lambda n: np.asarray(icd10)[
+                                     rng.integers(0, len(icd10), n)],
+                             })
+    emergency_care = attendances(rng, patient_id, emergency, 0.5, "snomed", alive)
+
+    return Backend(
+        patients=patients,
+        death_causes=death_causes,
+        registrations=registrations,
+        addresses=addresses,
+        clinical_snomed=snomed,
+        clinical_ctv3=clinical_ctv3,
+        medications=medications,
+        vaccinations=vaccinations,
+        hscworker=patient_id[rng.random(size) < 0.02],
+        admissions=admissions,
+        emergency_care=emergency_care,
+        event_values={"clinical_snomed": {
+            "numeric_value": np.round(rng.normal(28, 6, len(snomed)), 1),
+        }},
+    )
+
+
+def write_backend(path, size, seed=0, incidence=0.05):
+    """
+    Generate the backend and save it to `path`, replacing any backend there
+    only once the new one is complete
+    """
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    backend = generate(size, codelists, seed=seed, incidence=incidence)
+    backend.save(tmp)
+    shutil.rmtree(path, ignore_errors=True)
+    tmp.rename(path)
+    return backend
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100_000, help="patients")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--incidence", type=float, default=0.05,
+                        help="share of patients with records from each codelist")
+    parser.add_argument("--output", type=Path, default=BACKEND_DIR)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    backend = write_backend(args.output, args.size, args.seed, args.incidence)
+    records = {name: len(getattr(backend, name)) for name in
+               ("clinical_snomed", "clinical_ctv3", "medications", "vaccinations", "admissions",
+                "emergency_care", "death_causes")}
+    print(f"{len(backend)} patients written to {args.output} in {time.perf_counter() - started:.1f}s")
+    for name, count in records.items():
+        print(f"  {name}: {count} records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+##############################################################################
+#
+# This script defines the population restriction shared by the outcome
+# and measure study definitions.
+#
+# The R scripts only analyse people aged 45-54 (age_3mos 180-219) who
+# were alive at the index date. Applying the same restriction in the
+# population means everyone else is dropped during extraction, so they
+# are never queried for outcomes or written to the output files.
+#
+##############################################################################
+
+
+# Import code building blocks from cohort extractor package
+from cohortextractor import patients
+
+
+# Age band used in the analyses, in months at the index date [start, end)
+AGE_MONTHS = (540, 660)
+
+
+def age_band_in_years(age_months):
+    """
+    Convert an age-in-months band [start, end) to the whole-year band used
+    with patients.age_as_of().
+
+    age_as_of() counts from the first of the birth month, whereas the R
+    scripts set DOB to mid-month, so the extracted age can be up to one
+    year older than the age used in the analysis. The upper bound is
+    widened to keep everyone the R filters keep; the exact band is still
+    applied downstream.
+    """
+    start, end = age_months
+    return start // 12, (end - 1) // 12 + 1
+
+
+def restricted_population(cohort, age_months=AGE_MONTHS, alive_at_index=True):
+    """
+    Population of people in `cohort` who are within `age_months` at the
+    index date and (optionally) have not died before the index date.
+
+    `age_months` is a [start, end) band of age in months; pass None to
+    skip the age restriction.
+    """
+    conditions = ["in_cohort"]
+    variables = {
+        "in_cohort": patients.which_exist_in_file(cohort),
+    }
+
+    if age_months is not None:
+        min_age, max_age = age_band_in_years(age_months)
+        conditions.append(f"(age_at_index >= {min_age} AND age_at_index <= {max_age})")
+        variables["age_at_index"] = patients.age_as_of(
+            "index_date",
+            return_expectations = {
+                "rate": "universal",
+                "int": {"distribution": "normal", "mean": 50, "stddev": 3},
+            },
+        )
+
+    if alive_at_index:
+        conditions.append("NOT died_before_index")
+        variables["died_before_index"] = patients.died_from_any_cause(
+            on_or_before = "index_date - 1 day",
+            returning = "binary_flag",
+            return_expectations = {"incidence": 0.01},
+        )
+
+    return patients.satisfying(" AND ".join(conditions), **variables)
+
+
+#######################################
+# Development sample
+#######################################
+
+def sample_run(params):
+    """
+    True when the extraction is run with --param sample=yes, to extract
+    the stratified sample written by processing/sample_cohort.py
+    """
+    return str(params.get("sample", "")).lower() in ("yes", "true", "1")
+
+
+def sample_cohort_file(cohort):
+    """
+    Path of the sampled version of a cohort file, e.g.
+    output/cohort/sample_cohort_final_sep.csv
+    """
+    directory, _, name = cohort.rpartition("/")
+    return f"{directory}/sample_{name}"
+
+
+def sample_variables(cohort, sample):
+    """
+    Extra variables for sample runs: the sampling weight of each person,
+    so estimates from the sample can be weighted back to the cohort
+    """
+    if not sample:
+        return {}
+    return {
+        "sampling_weight": patients.with_value_from_file(
+            cohort,
+            returning="sampling_weight",
+            returning_type="float",
+        ),
+    }
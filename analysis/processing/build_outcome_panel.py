@@ -0,0 +1,29 @@
+##############################################################################
+#
+# This script builds the patient-level outcome panel: one row per patient
+# with dob, dod, boost_date, flu_vax_date and, for each outcome, a bitmask
+# with one bit per index date (see analysis/outcome_panel.py).
+#
+# Dependency: outcomes_dataset
+#
+##############################################################################
+
+
+# IMPORT STATEMENTS ----
+
+import sys
+from pathlib import Path
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from outcome_panel import build_panel, write_panel
+
+
+DATASET_DIR = Path("output", "outcomes_dataset")
+PANEL_PATH = Path("output", "outcome_panel.feather")
+
+
+panel = build_panel(DATASET_DIR)
+write_panel(panel, PANEL_PATH)
+
+print(f"Outcome panel (n): {panel.num_rows}")
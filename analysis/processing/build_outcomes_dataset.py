@@ -0,0 +1,129 @@
+##############################################################################
+#
+# This script combines the per-index-date extracts written by
+# generate_cohort --index-date-range (output/input_<study>_<date>.feather)
+# into a single Parquet dataset partitioned by index date:
+#
+#   output/<study>_dataset/index_date=<date>/part-0.parquet
+#
+# Rows are sorted by DOB and written in row groups with min/max statistics,
+# so readers can scan every index date at once and only read the columns
+# and row groups they need (e.g. arrow::open_dataset() in R).
+#
+# Each index date is also written uncompressed to output/<study>_cache/
+# (see analysis/arrow_cache.py), for readers that want one index date
+# memory-mapped without decompressing it.
+#
+# Index dates whose partition (and cache file) are newer than their
+# extract are skipped, so only new or re-extracted dates are rebuilt.
+#
+# Dependency: outcomes_*
+# Output used by: read_outcomes() in analysis/custom_functions.R
+#
+##############################################################################
+
+
+# IMPORT STATEMENTS ----
+
+import argparse
+import re
+import shutil
+import sys
+from pathlib import Path
+
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from arrow_cache import cache_file, is_stale, write_cache  # noqa: E402
+
+
+FILENAME_DATE = re.compile(r"_(\d{4}-\d{2}-\d{2})\.feather$")
+
+
+def find_extracts(input_dir, study):
+    """
+    Return {index_date: path} for every per-index-date extract of `study`
+    """
+    extracts = {}
+    for path in sorted(Path(input_dir).glob(f"input_{study}_*.feather")):
+        match = FILENAME_DATE.search(path.name)
+        if match:
+            extracts[match.group(1)] = path
+    return extracts
+
+
+def prepare_table(table, sort_by="dob"):
+    """
+    Sort rows so that row-group statistics are selective. Column types are
+    kept as extracted (dates stay timestamps, read as POSIXct in R), so the
+    R scripts see the same values as when reading the Feather files.
+    """
+    if sort_by in table.column_names:
+        order = pc.sort_indices(table, sort_keys=[(sort_by, "ascending")])
+        table = table.take(order)
+    return table
+
+
+def partition_file(dataset_dir, index_date):
+    return Path(dataset_dir) / f"index_date={index_date}" / "part-0.parquet"
+
+
+def write_partition(table, dataset_dir, index_date, row_group_size):
+    partition_dir = partition_file(dataset_dir, index_date).parent
+    if partition_dir.exists():
+        shutil.rmtree(partition_dir)
+    partition_dir.mkdir(parents=True)
+    pq.write_table(
+        table,
+        partition_dir / "part-0.parquet",
+        row_group_size=row_group_size,
+        compression="zstd",
+        write_statistics=True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--study", default="outcomes",
+                        help="study definition suffix, e.g. outcomes or measures")
+    parser.add_argument("--input-dir", default="output")
+    parser.add_argument("--output-dir", default=None,
+                        help="defaults to output/<study>_dataset")
+    parser.add_argument("--row-group-size", type=int, default=100_000)
+    parser.add_argument("--cache-dir", default=None,
+                        help="defaults to output/<study>_cache")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not write the uncompressed Arrow cache")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild every index date, even if up to date")
+    args = parser.parse_args()
+
+    dataset_dir = args.output_dir or Path(args.input_dir) / f"{args.study}_dataset"
+    cache_dir = args.cache_dir or Path(args.input_dir) / f"{args.study}_cache"
+    extracts = find_extracts(args.input_dir, args.study)
+    if not extracts:
+        raise FileNotFoundError(
+            f"No input_{args.study}_<date>.feather files found in {args.input_dir}"
+        )
+
+    # One index date at a time, so memory is bounded by the largest extract
+    for index_date, path in extracts.items():
+        outputs = [partition_file(dataset_dir, index_date)]
+        if not args.no_cache:
+            outputs.append(cache_file(index_date, cache_dir, args.study))
+        if not args.force and not any(is_stale(output, path) for output in outputs):
+            print(f"{index_date}: up to date")
+            continue
+
+        table = prepare_table(feather.read_table(path))
+        write_partition(table, dataset_dir, index_date, args.row_group_size)
+        if not args.no_cache:
+            write_cache(table, cache_file(index_date, cache_dir, args.study))
+        print(f"{index_date}: {table.num_rows} rows written")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+##############################################################################
+#
+# This script defines exclusion criteria and extracts the final study
+# population
+#
+# output/input_baseline.feather is read in record batches of at most
+# --chunk-size rows (memory-mapped, so only the batch being processed is
+# held in memory). Each chunk is cleaned and flagged, appended to
+#
+#   output/cohort/baseline.csv
+#   output/cohort/cohort_final_sep.csv
+#   output/cohort/cohort_final_sep_measures.csv
+#
+# and added to the running counts for
+# output/descriptive/total_pop_before_exclusions.csv, so memory use does
+# not grow with the size of the population. Files are written in the same
+# format as R's write.csv (TRUE/FALSE, NA for missing values).
+#
+# Dependency: study_definition_baseline.py
+#
+##############################################################################
+
+
+# IMPORT STATEMENTS ----
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from custom_functions import months_between, redact, rounding  # noqa: E402
+
+
+END_DATE = "2023-02-04"
+
+# Age in years on this date is used for the age restrictions
+AGE_DATE = "2022-09-03"
+
+# Age range of the measures cohort and the exclusion counts [start, end)
+AGE_YEARS = (45, 55)
+
+CV_CONDITIONS = [
+    "immunosuppressed", "chronic_kidney_disease", "chronic_resp_disease",
+    "diabetes", "chronic_liver_disease", "chronic_neuro_disease", "asplenia",
+    "chronic_heart_disease", "sev_mental", "sev_obesity", "asthma",
+]
+
+# Columns of total_pop_before_exclusions.csv (output name: column)
+EXCLUSION_COUNTS = {
+    "carehome": "carehome",
+    "immunosuppressed": "immunosuppressed",
+    "ckd": "chronic_kidney_disease",
+    "chronic_resp_disease": "chronic_resp_disease",
+    "asthma": "asthma",
+    "diabetes": "diabetes",
+    "asplenia": "asplenia",
+    "chronic_liver_disease": "chronic_liver_disease",
+    "chronic_neuro_disease": "chronic_neuro_disease",
+    "chronic_heart_disease": "chronic_heart_disease",
+    "sev_mental": "sev_mental",
+    "sev_obesity": "sev_obesity",
+    "cv": "cv",
+    "hscworker": "hscworker",
+    "endoflife": "endoflife",
+    "housebound": "housebound",
+    "covid_vax4_early": "covid_vax4_early",
+    "covid_vax3_early": "covid_vax3_early",
+    "covid_vax3": "covid_vax3",
+    "covid_vax2": "covid_vax2",
+    "covid_vax_recent": "covid_vax_recent",
+    "any_exclusion": "any_exclusion",
+}
+
+# Columns not carried into the final cohort
+DROP_FROM_FINAL = [
+    "covid_vax_recent", "endoflife", "cv", "hscworker", "carehome",
+    "housebound", "immunosuppressed", "chronic_kidney_disease",
+    "chronic_resp_disease", "asthma", "diabetes", "chronic_liver_disease",
+    "chronic_neuro_disease", "asplenia", "chronic_heart_disease",
+    "sev_mental", "sev_obesity", "flu_vax_tpp_date", "flu_vax_med_date",
+    "flu_vax_clinical_date", "death_cause",
+]
+
+
+#######################################
+# Prepare data
+#######################################
+
+def read_chunks(path, chunk_size):
+    """
+    DataFrames of at most `chunk_size` rows from a Feather (Arrow IPC) file
+    """
+    reader = pa.ipc.open_file(pa.memory_map(str(path), "r"))
+    for i in range(reader.num_record_batches):
+        batch = reader.get_batch(i)
+        for offset in range(0, batch.num_rows, chunk_size):
+            yield batch.slice(offset, chunk_size).to_pandas()
+
+
+def between(dates, start, end):
+    return (dates >= pd.Timestamp(start)) & (dates <= pd.Timestamp(end))
+
+
+def process_chunk(baseline, resp_codes):
+    """
+    Clean dates and derive the booster, vaccination history and exclusion
+    flags
+    """
+    for column in baseline.columns:
+        if column.endswith("_date") or column in ("dob", "dod"):
+            baseline[column] = pd.to_datetime(baseline[column]).dt.normalize()
+
+    # Set DOB to mid-month
+    baseline["dob"] = baseline["dob"] + pd.Timedelta(days=14)
+    baseline["age_yrs"] = (months_between(baseline["dob"], AGE_DATE) // 12).astype("Int64").values
+
+    # Flag for clinically vulnerable people
+    baseline["cv"] = baseline[CV_CONDITIONS].astype(bool).any(axis=1)
+
+    # Determine earliest recorded date of flu vaccination
+    baseline["flu_vax_date"] = baseline[
+        ["flu_vax_med_date", "flu_vax_tpp_date", "flu_vax_clinical_date"]
+    ].min(axis=1)
+
+    # Booster date (if received) - could be third OR fourth
+    #   must be after September 5
+    vax_3, vax_4 = baseline["covid_vax_3_date"], baseline["covid_vax_4_date"]
+    campaign = pd.Timestamp("2022-09-05")
+    end_date = pd.Timestamp(END_DATE)
+    fourth = (vax_4 >= campaign) & (vax_4 < end_date)
+    third = vax_4.isna() & (vax_3 >= campaign) & (vax_3 < end_date)
+    baseline["boost_date"] = vax_4.where(fourth, vax_3.where(third))
+
+    # Death with respiratory underlying cause (any date) - used with the
+    #  death window in the outcome extractions
+    baseline["death_resp"] = baseline["death_cause"].astype(object).isin(resp_codes).astype(int)
+    # Both flags are read back with returning_type="int", so written as 0/1
+    baseline["death_covid"] = baseline["death_covid"].fillna(False).astype(bool).astype(int)
+
+    # Received booster anytime in 2022/23
+    baseline["booster"] = baseline["boost_date"].notna().astype(int)
+
+    # If received fourth dose prior to second booster campaign (September 5)
+    baseline["covid_vax4_early"] = (vax_4 < campaign).astype(int)
+
+    # If received third dose prior to first booster campaign (September 16)
+    baseline["covid_vax3_early"] = (vax_3 < pd.Timestamp("2021-09-16")).astype(int)
+
+    # Received another COVID vaccine in 3 months prior to start of campaign
+    baseline["covid_vax_recent"] = (
+        between(baseline["covid_vax_3_date"], "2022-07-15", "2022-10-15")
+        | between(baseline["covid_vax_2_date"], "2022-07-15", "2022-10-15")
+        | between(baseline["covid_vax_1_date"], "2022-07-15", "2022-10-15")
+    ).astype(int)
+
+    # Received 2nd dose at least 3 months prior to start of campaign
+    baseline["covid_vax2"] = (baseline["covid_vax_2_date"] < pd.Timestamp("2022-07-15")).astype(int)
+
+    # Received 3rd dose at least 3 months prior to start of campaign
+    baseline["covid_vax3"] = (vax_3 < pd.Timestamp("2022-07-15")).astype(int)
+
+    baseline["any_exclusion"] = (
+        baseline["carehome"].astype(bool) | baseline["cv"] | baseline["hscworker"].astype(bool)
+        | baseline["endoflife"].astype(bool) | baseline["housebound"].astype(bool)
+        | (baseline["covid_vax4_early"] == 1) | (baseline["covid_vax3_early"] == 1)
+        | (baseline["covid_vax2"] != 1) | (baseline["covid_vax_recent"] == 1)
+    )
+    return baseline
+
+
+def in_age_range(baseline):
+    return (baseline["age_yrs"] >= AGE_YEARS[0]).fillna(False) & \
+        (baseline["age_yrs"] < AGE_YEARS[1]).fillna(False)
+
+
+#######################################
+# Output
+#######################################
+
+class CsvWriter:
+    """
+    Appends chunks to a CSV file, writing the header with the first chunk
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "w", newline="")
+        self.header = True
+        self.rows = 0
+
+    def write(self, df):
+        as_r_csv(df).to_csv(self.file, header=self.header, index=False, na_rep="NA",
+                            date_format="%Y-%m-%d")
+        self.header = False
+        self.rows += len(df)
+
+    def close(self):
+        self.file.close()
+
+
+def as_r_csv(df):
+    """
+    Logical columns as TRUE/FALSE, as written by R
+    """
+    df = df.copy()
+    for column in df.columns[df.dtypes == bool]:
+        df[column] = np.where(df[column], "TRUE", "FALSE")
+    return df
+
+
+def count_exclusions(baseline):
+    """
+    Number of people with each exclusion (and in total) by age_yrs, for
+    the chunk's people in AGE_YEARS
+    """
+    ages = np.arange(*AGE_YEARS)
+    in_range = in_age_range(baseline)
+    cell = baseline.loc[in_range, "age_yrs"].to_numpy(dtype=np.int64) - AGE_YEARS[0]
+    counts = {"total": np.bincount(cell, minlength=len(ages))}
+    for name, column in EXCLUSION_COUNTS.items():
+        flag = (baseline.loc[in_range, column].astype(int) == 1).to_numpy()
+        counts[name] = np.bincount(cell, weights=flag, minlength=len(ages)).astype(np.int64)
+    return counts
+
+
+def exclusion_table(counts):
+    """
+    Counts by age and for all ages, redacted and rounded
+    """
+    by_age = pd.DataFrame(counts)
+    total = by_age.sum().to_frame().T
+    table = pd.concat([by_age, total], ignore_index=True)
+    table = table.apply(lambda values: pd.Series(rounding(redact(values))).astype("Int64"))
+    table.insert(0, "age_yrs", [str(age) for age in range(*AGE_YEARS)] + ["All"])
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="output/input_baseline.feather")
+    parser.add_argument("--chunk-size", type=int, default=100_000,
+                        help="maximum number of rows processed at a time")
+    args = parser.parse_args()
+
+    # Respiratory codes (ICD-10) for matching underlying cause of death
+    resp_codes = pd.read_csv(Path("codelists", "user-anschaf-respiratory-diagnoses-icd-10.csv"),
+                             dtype={"code": str})["code"]
+
+    baseline_file = CsvWriter(Path("output", "cohort", "baseline.csv"))
+    final_file = CsvWriter(Path("output", "cohort", "cohort_final_sep.csv"))
+    measures_file = CsvWriter(Path("output", "cohort", "cohort_final_sep_measures.csv"))
+    counts = {name: np.zeros(AGE_YEARS[1] - AGE_YEARS[0], dtype=np.int64)
+              for name in ["total", *EXCLUSION_COUNTS]}
+
+    for chunk in read_chunks(args.input, args.chunk_size):
+        baseline = process_chunk(chunk, resp_codes)
+        baseline_file.write(baseline)
+
+        for name, count in count_exclusions(baseline).items():
+            counts[name] += count
+
+        # Save final population after exclusions
+        final = baseline.loc[~baseline["any_exclusion"]].drop(columns=DROP_FROM_FINAL)
+        final_file.write(final)
+
+        # Save - restrict to age range
+        measures_file.write(final.loc[in_age_range(final)])
+
+    for writer in (baseline_file, final_file, measures_file):
+        writer.close()
+
+    # Overview of study population prior to exclusions
+    descriptive_dir = Path("output", "descriptive")
+    descriptive_dir.mkdir(parents=True, exist_ok=True)
+    exclusion_table(counts).to_csv(descriptive_dir / "total_pop_before_exclusions.csv",
+                                   index=False, na_rep="NA")
+
+    # Number of obs
+    print(f"Final population (n): {final_file.rows}")
+
+
+if __name__ == "__main__":
+    main()
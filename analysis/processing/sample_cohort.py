@@ -0,0 +1,94 @@
+##############################################################################
+#
+# This script writes a stratified sample of the final cohort for fast
+# development runs of the outcome and measure extractions
+# (--param sample=yes, see analysis/population.py).
+#
+# Within each age_3mos cell (age at Sep 3) people are ranked by a hash of
+# their patient_id and the first --per-cell are kept, so the sample is the
+# same on every run and nested as --per-cell grows. Cells within
+# --keep-near of the cutoff are kept in full. Each row records its
+# sampling_weight (people in the cell / people sampled from the cell).
+#
+# Dependency: data_process_baseline
+#
+##############################################################################
+
+
+# IMPORT STATEMENTS ----
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from custom_functions import months_between  # noqa: E402
+from population import sample_cohort_file  # noqa: E402
+
+
+COHORTS = ["output/cohort/cohort_final_sep.csv", "output/cohort/cohort_final_sep_measures.csv"]
+
+CUTOFF = 200
+
+
+def patient_hash(patient_id, seed=0):
+    """
+    Deterministic 64-bit hash of each patient_id (splitmix64)
+    """
+    with np.errstate(over="ignore"):
+        z = np.asarray(patient_id, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def stratified_sample(cohort, per_cell, keep_near=0, seed=0):
+    """
+    Rows of `cohort` kept in the sample, with a sampling_weight column
+    """
+    dob = pd.to_datetime(cohort["dob"], errors="coerce")
+    age_3mos = months_between(dob, "2022-09-03") // 3
+    strata = age_3mos.fillna(-1).astype(int).to_numpy()
+    hashed = patient_hash(cohort["patient_id"].astype("int64").to_numpy(), seed)
+
+    # Rank within each cell by hash
+    order = np.lexsort((hashed, strata))
+    sorted_strata = strata[order]
+    cell_start = np.searchsorted(sorted_strata, sorted_strata, side="left")
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - cell_start
+
+    cells, cell_size = np.unique(strata, return_counts=True)
+    size = cell_size[np.searchsorted(cells, strata)]
+    near = np.abs(strata - CUTOFF) < keep_near
+    keep = near | (rank < per_cell)
+    sampled = np.where(near, size, np.minimum(size, per_cell))
+
+    sample = cohort[keep].copy()
+    sample["sampling_weight"] = (size / sampled)[keep]
+    return sample
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--per-cell", type=int, default=2000,
+                        help="people sampled from each age_3mos cell")
+    parser.add_argument("--keep-near", type=int, default=0,
+                        help="keep everyone in cells within this many age_3mos of the cutoff")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for cohort_file in COHORTS:
+        # Read as text so the sample is written back unchanged
+        cohort = pd.read_csv(cohort_file, dtype=str, keep_default_na=False)
+        sample = stratified_sample(cohort, args.per_cell, args.keep_near, args.seed)
+        sample.to_csv(sample_cohort_file(cohort_file), index=False)
+        print(f"{cohort_file}: sampled {len(sample)} of {len(cohort)}")
+
+
+if __name__ == "__main__":
+    main()
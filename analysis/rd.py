@@ -0,0 +1,165 @@
+##############################################################################
+#
+# This script provides functions for sharp regression discontinuity
+# estimates over age cells, as in sharp_analysis.R:
+#
+#   lm(p_outcome ~ age_3mos_c * over50, weights = n)
+#
+# The interacted model is a separate weighted line on each side of the
+# cutoff, so every fit only needs the weighted sums of 1, x, x^2, y, xy and
+# y^2 on each side. These are taken from prefix sums over the (sorted)
+# cells, so a fit costs the same whatever the cutoff or bandwidth, and
+# batches of fits are solved together with stacked linear algebra.
+#
+##############################################################################
+
+
+import numpy as np
+
+
+Z_95 = 1.959964
+
+
+def prefix_sums(age, y, w):
+    """
+    Array [cells + 1, 7] of cumulative sums of w, wx, wx^2, wy, wxy, wy^2
+    (x = age) and of the number of cells with non-zero weight, along the last axis of `age`, `y` and `w` (so a batch of
+    reordered outcomes can be summed at once). Cells with zero weight
+    add nothing, even if their y is missing.
+    """
+    age, y, w = np.broadcast_arrays(*(np.asarray(a, dtype="float64") for a in (age, y, w)))
+    y = np.where(w != 0, y, 0)
+    terms = np.stack([w, w * age, w * age**2, w * y, w * age * y, w * y**2, w != 0], axis=-1)
+    zeros = np.zeros(terms.shape[:-2] + (1, 7))
+    return np.concatenate([zeros, np.cumsum(terms, axis=-2)], axis=-2)
+
+
+def side_fit(sums, cutoff):
+    """
+    Weighted line y ~ (x - cutoff) from the sums for one side. Returns
+    (intercept at the cutoff, its unscaled variance, residual sum of squares)
+    """
+    s0, s1, s2, t0, t1, u = np.moveaxis(sums[..., :6], -1, 0)
+    c = np.asarray(cutoff, dtype="float64")
+
+    # Centre on the cutoff
+    s1c = s1 - c * s0
+    s2c = s2 - 2 * c * s1 + c**2 * s0
+    t1c = t1 - c * t0
+
+    det = s0 * s2c - s1c**2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intercept = (s2c * t0 - s1c * t1c) / det
+        slope = (s0 * t1c - s1c * t0) / det
+        variance = s2c / det
+    rss = u - intercept * t0 - slope * t1c
+    return intercept, variance, rss
+
+
+def fit(sums, age, cutoffs, bandwidth):
+    """
+    Sharp RD estimates at `cutoffs` using the cells with age in
+    [cutoff - bandwidth, cutoff + bandwidth). `sums` are prefix_sums() over
+    cells sorted by `age`; a leading batch axis is allowed.
+    Returns (estimate, standard error, number of cells)
+    """
+    cutoffs = np.asarray(cutoffs, dtype="float64")
+    lower = np.searchsorted(age, cutoffs - bandwidth, side="left")
+    split = np.searchsorted(age, cutoffs, side="left")
+    upper = np.searchsorted(age, cutoffs + bandwidth, side="left")
+
+    left = sums[..., split, :] - sums[..., lower, :]
+    right = sums[..., upper, :] - sums[..., split, :]
+    b_left, v_left, rss_left = side_fit(left, cutoffs)
+    b_right, v_right, rss_right = side_fit(right, cutoffs)
+
+    # Residual variance pooled over both sides, as in lm (4 parameters and
+    # cells with zero weight not counted)
+    n_cells = (left[..., 6] + right[..., 6]).astype(int)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma2 = (rss_left + rss_right) / (n_cells - 4)
+    estimate = b_right - b_left
+    se = np.sqrt(np.clip(sigma2, 0, None) * (v_left + v_right))
+    return estimate, se, n_cells
+
+
+def sharp_rd(age, y, w, cutoff, bandwidth):
+    age = np.asarray(age, dtype="float64")
+    estimate, se, n_cells = fit(prefix_sums(age, y, w), age, [cutoff], bandwidth)
+    return {
+        "estimate": estimate[0],
+        "se": se[0],
+        "lci": estimate[0] - Z_95 * se[0],
+        "uci": estimate[0] + Z_95 * se[0],
+        "cells": int(n_cells[0]),
+    }
+
+
+def placebo_cutoffs(age, y, w, cutoffs, bandwidth, min_cells=4, true_cutoff=None):
+    """
+    Estimates at each cutoff in `cutoffs`, skipping cutoffs with fewer
+    than `min_cells` cells on either side. With `true_cutoff`, it is not
+    a placebo cutoff and each placebo is fitted only on the cells on its
+    own side of it (below, or at and above), so no window contains the
+    real discontinuity. Returns a dict of arrays.
+    """
+    age = np.asarray(age, dtype="float64")
+    cutoffs = np.asarray(cutoffs, dtype="float64")
+    if true_cutoff is not None:
+        y, w = np.asarray(y, dtype="float64"), np.asarray(w, dtype="float64")
+        below = age < true_cutoff
+        sides = [
+            placebo_cutoffs(age[below], y[below], w[below], cutoffs[cutoffs < true_cutoff],
+                            bandwidth, min_cells),
+            placebo_cutoffs(age[~below], y[~below], w[~below], cutoffs[cutoffs > true_cutoff],
+                            bandwidth, min_cells),
+        ]
+        return {key: np.concatenate([side[key] for side in sides]) for key in sides[0]}
+
+    below = np.searchsorted(age, cutoffs) - np.searchsorted(age, cutoffs - bandwidth)
+    above = np.searchsorted(age, cutoffs + bandwidth) - np.searchsorted(age, cutoffs)
+    cutoffs = cutoffs[(below >= min_cells) & (above >= min_cells)]
+
+    estimate, se, n_cells = fit(prefix_sums(age, y, w), age, cutoffs, bandwidth)
+    return {
+        "cutoff": cutoffs,
+        "estimate": estimate,
+        "se": se,
+        "lci": estimate - Z_95 * se,
+        "uci": estimate + Z_95 * se,
+        "cells": n_cells,
+    }
+
+
+def permutation_test(age, y, w, cutoff, bandwidth, n_permutations=1000,
+                     seed=0, batch_size=500):
+    """
+    Permutation p-value for the estimate at `cutoff`: the cells' (y, w)
+    are shuffled across ages within the bandwidth and the model refitted,
+    in batches of `batch_size` permutations at a time.
+    Returns (estimate, p-value, permuted estimates); the p-value is
+    missing if the estimate is.
+    """
+    age = np.asarray(age, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    w = np.asarray(w, dtype="float64")
+    window = (age >= cutoff - bandwidth) & (age < cutoff + bandwidth)
+    age, y, w = age[window], y[window], w[window]
+
+    observed, _, _ = fit(prefix_sums(age, y, w), age, [cutoff], bandwidth)
+
+    rng = np.random.default_rng(seed)
+    permuted = []
+    for start in range(0, n_permutations, batch_size):
+        size = min(batch_size, n_permutations - start)
+        order = rng.permuted(np.tile(np.arange(len(age)), (size, 1)), axis=1)
+        sums = prefix_sums(age, y[order], w[order])
+        estimate, _, _ = fit(sums, age, [cutoff], bandwidth)
+        permuted.append(estimate[:, 0])
+    permuted = np.concatenate(permuted) if permuted else np.array([])
+
+    if np.isnan(observed[0]):
+        return observed[0], np.nan, permuted
+    extreme = np.sum(np.abs(permuted) >= np.abs(observed[0]) - 1e-12)
+    p_value = (1 + extreme) / (1 + len(permuted))
+    return observed[0], p_value, permuted
@@ -0,0 +1,49 @@
+################################################################
+# This script:
+# - Selects MSE-optimal and CER-optimal bandwidths (in 3-month
+#    age groups) for the sharp RD, for each outcome and start date
+# - All outcomes for a start date are selected together, and
+#    selections are cached by a hash of the cells (analysis/bandwidth.py)
+#
+# Dependency = outcome_panel
+################################################################
+
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bandwidth import select_bandwidths  # noqa: E402
+from cells import age_cells, cell_rates  # noqa: E402
+from outcome_panel import read_panel  # noqa: E402
+
+
+OUTCOMES = ["covidcomposite", "respcomposite", "anyadmitted", "anydeath"]
+
+OUTPUT_DIR = Path("output", "modelling", "bandwidth")
+
+
+def main():
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    panel, index_dates = read_panel(
+        Path("output", "outcome_panel.feather"),
+        columns=["dob", "dod", "boost_date", "in_population"] + OUTCOMES,
+    )
+
+    rows = []
+    for start_date in index_dates:
+        x, Y, n = cell_rates(age_cells(panel, index_dates, start_date, OUTCOMES), OUTCOMES)
+        selected = select_bandwidths(x, Y, n)
+        for outcome, h_mse, h_cer in zip(OUTCOMES, selected["h_mse"], selected["h_cer"]):
+            rows.append({"start_date": start_date, "outcome": outcome,
+                         "h_mse": h_mse, "h_cer": h_cer})
+
+    pd.DataFrame(rows).to_csv(OUTPUT_DIR / "bw_selected.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+################################################################
+# This script:
+# - Checks the sharp RD estimates with placebo cutoffs (every
+#    3-month age group other than the true cutoff, age 50, with
+#    enough cells on both sides, fitted only on the cells on its own
+#    side of the true cutoff) and permutation p-values at the true
+#    cutoff
+# - Fits use the aggregated age cells (see analysis/rd.py), and
+#    each start date x outcome runs in its own process
+# - The bandwidth is fixed (--bandwidth) or the selected MSE/CER-
+#    optimal bandwidth for the true cutoff (--bandwidth mse|cer)
+#
+# Dependency = outcome_panel (bandwidth_selection for mse/cer)
+################################################################
+
+
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Load functions
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from bandwidth import select_bandwidths  # noqa: E402
+from cells import CUTOFF, age_cells, cell_rates  # noqa: E402
+from outcome_panel import read_panel  # noqa: E402
+from rd import permutation_test, placebo_cutoffs  # noqa: E402
+
+
+OUTCOMES = {
+    "covidcomposite": "COVID unplanned admission/A&E/death",
+    "respcomposite": "Respiratory composite",
+    "anyadmitted": "All cause unplanned admission",
+    "anydeath": "All cause death",
+}
+
+OUTPUT_DIR = Path("output", "modelling", "placebo")
+
+
+def run(task):
+    """
+    Placebo and permutation fits for one start date and outcome
+    """
+    start_date, outcome, cells, bandwidth, n_permutations, seed = task
+    age = cells["age_3mos"].to_numpy()
+    n = cells["n"].to_numpy()
+    # Outcome rate per 100,000, weighted by the number of people
+    y = cells[outcome].to_numpy() / n * 100000
+
+    placebo = pd.DataFrame(placebo_cutoffs(age, y, n, age, bandwidth, true_cutoff=CUTOFF))
+    placebo["cutoff"] = placebo["cutoff"].astype(int)
+    placebo.insert(0, "bandwidth", bandwidth)
+    placebo.insert(0, "outcome", OUTCOMES[outcome])
+    placebo.insert(0, "start_date", start_date)
+
+    estimate, p_value, permuted = permutation_test(
+        age, y, n, CUTOFF, bandwidth, n_permutations=n_permutations, seed=seed
+    )
+    permutation = {
+        "start_date": start_date,
+        "outcome": OUTCOMES[outcome],
+        "bandwidth": bandwidth,
+        "estimate": estimate,
+        "p_perm": p_value,
+        "permutations": len(permuted),
+    }
+    return placebo, permutation
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bandwidth", default="20",
+                        help="bandwidth in 3-month age groups either side of each "
+                             "cutoff, or mse/cer for the selected bandwidth")
+    parser.add_argument("--permutations", type=int, default=2000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=2023)
+    args = parser.parse_args()
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    panel, index_dates = read_panel(
+        Path("output", "outcome_panel.feather"),
+        columns=["dob", "dod", "boost_date", "in_population"] + list(OUTCOMES),
+    )
+
+    tasks = []
+    for start_date in index_dates:
+        cells = age_cells(panel, index_dates, start_date, OUTCOMES)
+        if args.bandwidth in ("mse", "cer"):
+            x, Y, n = cell_rates(cells, list(OUTCOMES))
+            bandwidths = select_bandwidths(x, Y, n)[f"h_{args.bandwidth}"]
+        else:
+            bandwidths = [float(args.bandwidth)] * len(OUTCOMES)
+
+        for i, (outcome, bandwidth) in enumerate(zip(OUTCOMES, bandwidths)):
+            # Independent permutations for each start date and outcome
+            seed = np.random.SeedSequence(args.seed, spawn_key=(pd.Timestamp(start_date).toordinal(), i))
+            tasks.append((start_date, outcome, cells, bandwidth, args.permutations, seed))
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(run, tasks))
+
+    pd.concat([placebo for placebo, _ in results]).to_csv(
+        OUTPUT_DIR / "placebo_cutoffs.csv", index=False)
+    pd.DataFrame([permutation for _, permutation in results]).to_csv(
+        OUTPUT_DIR / "permutation_pvalues.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
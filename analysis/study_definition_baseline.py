@@ -104,8 +104,27 @@ study = StudyDefinition(
         },
     ),
 
+    # Death certificate causes - extracted once here (deaths are not
+    # restricted to a date range) and carried in the cohort file, so the
+    # outcome extractions only need to query deaths within each window
+    # Underlying cause (matched against resp_codes in data_process_baseline.py)
+    death_cause = patients.died_from_any_cause(
+        returning="underlying_cause_of_death",
+        return_expectations={
+            "category": {"ratios": {"U071": 0.2, "J189": 0.2, "I219": 0.6}},
+            "incidence" : .1
+        },
+    ),
+
+    # COVID as any cause on death certificate
+    death_covid = patients.with_these_codes_on_death_certificate(
+        covid_codes,
+        returning="binary_flag",
+        return_expectations = {"incidence": 0.02},
+    ),
+
     ###########################################################
-    # Demographics - for confirming that population is 
+    # Demographics - for confirming that population is
     #   consistent over time (before/after discontinuity)
     ###########################################################
        
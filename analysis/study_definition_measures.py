@@ -21,12 +21,29 @@ from cohortextractor import (
     patients,
     Measure,
     codelist,
+    params,
 )
 
 # Import codelists from codelist.py (which pulls them from the codelist folder)
 from codelists import *
 
+# Measures shared with the weekly measure cube
+from measure_cube import MEASURES
+
+# Import population restriction (age band and alive at index date)
+from population import (
+    restricted_population,
+    sample_cohort_file,
+    sample_run,
+    sample_variables,
+)
+
+# Development runs (--param sample=yes) extract a stratified sample of the
+# cohort, with sampling weights (see processing/sample_cohort.py)
+SAMPLE = sample_run(params)
 COHORT = "output/cohort/cohort_final_sep_measures.csv"
+if SAMPLE:
+    COHORT = sample_cohort_file(COHORT)
 
 # Specify study definition
 study = StudyDefinition(
@@ -41,7 +58,9 @@ study = StudyDefinition(
     # Set index date
     index_date = "2022-09-03",
 
-    population=patients.which_exist_in_file(COHORT),
+    # Restrict to people alive at index date (age range is fixed at baseline
+    # in the measures cohort file)
+    population=restricted_population(COHORT, age_months=None),
 
     ## Extract DOB, DOB and flu vax date from previously generated cohort
     # Date of birth month/year
@@ -82,11 +101,16 @@ study = StudyDefinition(
         return_expectations = {"incidence": 0.4},
     ),
     
-    # COVID death
-    coviddeath=patients.with_these_codes_on_death_certificate(
-        covid_codes,
-        returning="binary_flag",
-        between=["index_date","index_date + 6 days"],        
+    # COVID death (any cause on certificate)
+    # Each person dies once, so this is a death in the window (anydeath) with
+    # COVID on the certificate (flag from the baseline death extraction)
+    coviddeath=patients.satisfying(
+        "anydeath AND death_covid",
+        death_covid=patients.with_value_from_file(
+            COHORT,
+            returning="death_covid",
+            returning_type="int",
+        ),
         return_expectations = {"incidence": 0.4},
         ),
     
@@ -121,11 +145,15 @@ study = StudyDefinition(
         ),
 
     # Respiratory death (underlying cause only)
-    respdeath=patients.with_these_codes_on_death_certificate(
-        resp_codes,
-        match_only_underlying_cause=True,
-        returning="binary_flag",
-        between=["index_date","index_date + 6 days"],        
+    # Death in the window with a respiratory underlying cause (matched against
+    # resp_codes in data_process_baseline.py)
+    respdeath=patients.satisfying(
+        "anydeath AND death_resp",
+        death_resp=patients.with_value_from_file(
+            COHORT,
+            returning="death_resp",
+            returning_type="int",
+        ),
         return_expectations = {"incidence": 0.4},
         ),
     
@@ -158,52 +186,22 @@ study = StudyDefinition(
         returning="binary_flag",
         return_expectations = {"incidence": 0.4},
     ),
+
+    # Sampling weight (sample runs only)
+    **sample_variables(COHORT, SAMPLE),
 )
 
 
 
 # --- DEFINE MEASURES ---
+# Weekly rates in the whole population; measure_cube.py computes the same
+# measures by age groups as well (build_measure_cube.py)
 measures = [
   Measure(
-    id = "anydeath",
-    numerator = "anydeath",
-    denominator = "population",
-    group_by = "population",
-  ),
-
-  Measure(
-    id = "anyadmitted",
-    numerator = "anyadmitted",
-    denominator = "population",
+    id = measure_id,
+    numerator = numerator,
+    denominator = denominator,
     group_by = "population",
-  ),
-
-  Measure(
-    id = "covidadmitted",
-    numerator = "covidadmitted",
-    denominator = "population",
-    group_by = "population",
-  ),
-
-  Measure(
-    id = "covidemergency",
-    numerator = "covidemergency",
-    denominator = "population",
-    group_by = "population",
-  ),
-
-  Measure(
-    id = "covidcomposite",
-    numerator = "covidcomposite",
-    denominator = "population",
-    group_by = "population",
-  ),
-
-  Measure(
-    id = "respcomposite",
-    numerator = "respcomposite",
-    denominator = "population",
-    group_by = "population",
-  ),
-
-]
\ No newline at end of file
+  )
+  for measure_id, (numerator, denominator) in MEASURES.items()
+]
@@ -24,12 +24,27 @@ from cohortextractor import (
     patients,
     Measure,
     codelist,
+    params,
 )
 
 # Import codelists from codelist.py (which pulls them from the codelist folder)
 from codelists import *
 
+# Import population restriction (age band and alive at index date)
+from population import (
+    AGE_MONTHS,
+    restricted_population,
+    sample_cohort_file,
+    sample_run,
+    sample_variables,
+)
+
+# Development runs (--param sample=yes) extract a stratified sample of the
+# cohort, with sampling weights (see processing/sample_cohort.py)
+SAMPLE = sample_run(params)
 COHORT = "output/cohort/cohort_final_sep.csv"
+if SAMPLE:
+    COHORT = sample_cohort_file(COHORT)
 
 # Specify study definition
 study = StudyDefinition(
@@ -44,7 +59,8 @@ study = StudyDefinition(
     # Set index date
     index_date = "2022-09-03",
 
-    population=patients.which_exist_in_file(COHORT),
+    # Restrict to people in the analysis age range and alive at index date
+    population=restricted_population(COHORT, age_months=AGE_MONTHS),
 
     # Date of birth month/year
     dob=patients.with_value_from_file(
@@ -85,11 +101,16 @@ study = StudyDefinition(
         return_expectations = {"incidence": 0.4},
     ),
     
-    # COVID death
-    coviddeath=patients.with_these_codes_on_death_certificate(
-        covid_codes,
-        returning="binary_flag",
-        between=["index_date","index_date + 41 days"],        
+    # COVID death (any cause on certificate)
+    # Each person dies once, so this is a death in the window (anydeath) with
+    # COVID on the certificate (flag from the baseline death extraction)
+    coviddeath=patients.satisfying(
+        "anydeath AND death_covid",
+        death_covid=patients.with_value_from_file(
+            COHORT,
+            returning="death_covid",
+            returning_type="int",
+        ),
         return_expectations = {"incidence": 0.4},
         ),
     
@@ -124,11 +145,15 @@ study = StudyDefinition(
         ),
 
     # Respiratory death (underlying cause only)
-    respdeath=patients.with_these_codes_on_death_certificate(
-        resp_codes,
-        match_only_underlying_cause=True,
-        returning="binary_flag",
-        between=["index_date","index_date + 41 days"],        
+    # Death in the window with a respiratory underlying cause (matched against
+    # resp_codes in data_process_baseline.py)
+    respdeath=patients.satisfying(
+        "anydeath AND death_resp",
+        death_resp=patients.with_value_from_file(
+            COHORT,
+            returning="death_resp",
+            returning_type="int",
+        ),
         return_expectations = {"incidence": 0.4},
         ),
     
@@ -161,6 +186,9 @@ study = StudyDefinition(
         returning="binary_flag",
         return_expectations = {"incidence": 0.4},
     ),
+
+    # Sampling weight (sample runs only)
+    **sample_variables(COHORT, SAMPLE),
 )
 
 
@@ -0,0 +1,79 @@
+##############################################################################
+#
+# This script provides functions for cumulative uptake (e.g. of the
+# booster dose) by age cell.
+#
+# Event dates are binned once against the (sorted) evaluation dates with
+# searchsorted, counted per (age cell x evaluation date) with one
+# bincount, and accumulated with a prefix sum along the dates. The cost is
+# the same for one evaluation date or every day of the campaign, and for
+# any age granularity.
+#
+##############################################################################
+
+
+import numpy as np
+import pandas as pd
+
+
+def to_days(dates):
+    """
+    Dates as integer days (NaT as a large sentinel so it never counts)
+    """
+    dates = pd.to_datetime(pd.Series(dates))
+    days = dates.values.astype("datetime64[D]").astype(np.int64)
+    return np.where(dates.isna().to_numpy(), np.iinfo(np.int64).max, days)
+
+
+def cumulative_counts(cell, event_dates, eval_dates, side="left"):
+    """
+    Array [cells x eval dates] of the number of events on or before each
+    evaluation date (side="left"), or strictly before it (side="right")
+    """
+    n_cells = int(cell.max()) + 1 if len(cell) else 0
+    eval_days = to_days(eval_dates)
+    event_bin = np.searchsorted(eval_days, to_days(event_dates), side=side)
+
+    # Events after the last evaluation date (or missing) are dropped
+    counted = event_bin < len(eval_days)
+    key = cell[counted] * len(eval_days) + event_bin[counted]
+    counts = np.bincount(key, minlength=n_cells * len(eval_days))
+    return counts.reshape(n_cells, len(eval_days)).cumsum(axis=1)
+
+
+def cumulative_uptake(cells, event_date, dod, eval_dates):
+    """
+    Cumulative uptake by cell and evaluation date.
+
+    `cells` labels each person (e.g. age in years at baseline); people
+    should already be restricted to those alive at baseline. Returns
+    one row per (cell, eval date) with:
+      n          events on or before the date
+      n_at_risk  people with an event on or before the date who had not
+                 died before it
+      total      people in the cell
+      at_risk    people in the cell who had not died before the date
+    """
+    eval_dates = pd.DatetimeIndex(sorted(pd.to_datetime(list(eval_dates))))
+    codes, labels = pd.factorize(pd.Series(cells), sort=True)
+    if (codes < 0).any():
+        raise ValueError("Every person needs a cell")
+
+    n = cumulative_counts(codes, event_date, eval_dates)
+    deaths = cumulative_counts(codes, dod, eval_dates, side="right")
+    # People with an event leave n_at_risk the day after their death (as
+    # they leave at_risk), or on their event date if they died before it
+    event_date = pd.to_datetime(pd.Series(event_date)).reset_index(drop=True)
+    after_death = pd.to_datetime(pd.Series(dod)).reset_index(drop=True) + pd.Timedelta(days=1)
+    leaves = event_date.where(event_date > after_death, after_death).where(event_date.notna())
+    censored = cumulative_counts(codes, leaves, eval_dates)
+    total = np.bincount(codes, minlength=len(labels))
+
+    return pd.DataFrame({
+        "cell": np.repeat(labels, len(eval_dates)),
+        "date": np.tile(eval_dates, len(labels)),
+        "n": n.ravel(),
+        "n_at_risk": (n - censored).ravel(),
+        "total": np.repeat(total, len(eval_dates)),
+        "at_risk": (total[:, None] - deaths).ravel(),
+    })
@@ -0,0 +1,35 @@
+##############################################################################
+#
+# Tests of data-driven bandwidth selection (analysis/bandwidth.py).
+#
+# Run from the repo root: python -m pytest tests
+#
+##############################################################################
+
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis"))
+from bandwidth import mse_bandwidth, select_bandwidths  # noqa: E402
+
+
+def test_too_few_cells_on_one_side():
+    x = np.arange(-2, 20)
+    Y = np.random.default_rng(0).random((len(x), 2))
+    with pytest.raises(ValueError, match="2 below"):
+        mse_bandwidth(x, Y)
+
+
+def test_selections_are_cached(tmp_path):
+    rng = np.random.default_rng(0)
+    x = np.arange(-40, 40)
+    Y = np.column_stack([0.1 * x + (x >= 0) + rng.normal(0, 0.5, len(x)), rng.random(len(x))])
+    n = rng.integers(50, 100, len(x))
+    selected = select_bandwidths(x, Y, n, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob("*.json"))) == 1
+    assert select_bandwidths(x, Y, n, cache_dir=tmp_path) == selected
+    assert all(0 < h <= 40 for h in selected["h_mse"])
@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Tests of checkpointed local extractions (analysis/local_backend/
+# checkpoints.py and extract() in analysis/pipeline/extract_local.py):
+# starting again when the checkpoint is for another extraction, restoring
+# completed groups, and resuming an extraction that failed partway
+# through a chunk.
+#
+# Run from the repo root: python -m pytest tests
+#
+##############################################################################
+
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cohortextractor import StudyDefinition, codelist, patients
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis"))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis" / "pipeline"))
+from extract_local import extract  # noqa: E402
+from local_backend.checkpoints import Checkpoint, checkpoint_key, variable_groups  # noqa: E402
+from local_backend.ecds import Attendances  # noqa: E402
+from local_backend.events import NO_DAY, Events, to_day  # noqa: E402
+from local_backend.intervals import Intervals  # noqa: E402
+from local_backend.tables import Backend  # noqa: E402
+
+
+INDEX_DATE = "2022-09-03"
+
+SIZE = 12
+
+CHUNK_SIZE = 5
+
+
+def events(patient_id, dates, codes):
+    return Events(patient_id, to_day(dates) if dates else [], np.asarray(codes))
+
+
+def intervals(patient_id, start, end, **values):
+    return Intervals(patient_id, to_day(start) if start else [],
+                     [NO_DAY if day is None else int(to_day([day])[0]) for day in end],
+                     {name: np.asarray(value) for name, value in values.items()})
+
+
+def attendances(system, **values):
+    return Attendances.from_lists([], [], [], system=system,
+                                  values={name: np.array([], dtype=str) for name in values})
+
+
+@pytest.fixture
+def backend(tmp_path):
+    """
+    SIZE patients aged 30 to 63, all but two registered, some with a code
+    and some who died, saved and loaded as extract_local.py would
+    """
+    patient_id = np.arange(1, SIZE + 1)
+    dob = [f"{1959 + 3 * i}-06-01" for i in range(SIZE)]
+    registered = [i for i in patient_id if i not in (3, 8)]
+    Backend(
+        patients={
+            "patient_id": patient_id,
+            "dob": to_day(dob),
+            "sex": np.array(["F", "M"] * (SIZE // 2)),
+            "dod": np.array([int(to_day(["2022-10-01"])[0]) if i in (2, 6) else NO_DAY
+                             for i in patient_id], dtype=np.int32),
+            "death_cause": np.array([""] * SIZE),
+        },
+        death_causes=events([], [], np.array([], dtype=str)),
+        registrations=intervals(registered, ["2010-01-01"] * len(registered), [None] * len(registered),
+                                region=np.array(["London"] * len(registered))),
+        addresses=intervals([], [], [], imd=np.array([], dtype=np.int64),
+                            care_home=np.array([], dtype=bool), nursing=np.array([], dtype=bool)),
+        clinical_snomed=events([1, 4, 5, 9, 11], ["2022-01-01"] * 5, np.array([100] * 5, dtype=np.int64)),
+        clinical_ctv3=events([], [], np.array([], dtype=str)),
+        medications=events([], [], np.array([], dtype=np.int64)),
+        vaccinations=events([], [], np.array([], dtype=str)),
+        hscworker=np.array([], dtype=np.int64),
+        admissions=attendances("icd10", admission_method=1, patient_classification=1,
+                               primary_diagnosis=1),
+        emergency_care=attendances("snomed"),
+    ).save(tmp_path / "backend")
+    return Backend.load(tmp_path / "backend")
+
+
+def definitions():
+    study = StudyDefinition(
+        index_date=INDEX_DATE,
+        population=patients.satisfying(
+            "registered AND age >= 35 AND age <= 60",
+            registered=patients.registered_as_of("index_date"),
+        ),
+        age=patients.age_as_of("index_date"),
+        sex=patients.sex(),
+        has_code=patients.with_these_clinical_events(
+            codelist(["100"], system="snomed"), on_or_before="index_date",
+        ),
+        dod=patients.died_from_any_cause(
+            on_or_after="index_date", returning="date_of_death", date_format="YYYY-MM-DD",
+        ),
+    )
+    return study.covariate_definitions
+
+
+def run(backend, tmp_path, name, **options):
+    output_path = tmp_path / f"{name}.feather"
+    extract(backend, definitions(), INDEX_DATE, output_path, "feather", tmp_path / "checkpoints",
+            CHUNK_SIZE, **options)
+    return pd.read_feather(output_path)
+
+
+def test_checkpoint_for_another_extraction_starts_again(backend, tmp_path):
+    key = checkpoint_key(definitions(), INDEX_DATE, backend.path, CHUNK_SIZE)
+    checkpoint = Checkpoint.open(tmp_path / "checkpoint", key, backend.patient_id, CHUNK_SIZE)
+    checkpoint.save_group(0, 0, {"population": np.ones(CHUNK_SIZE, dtype=bool)})
+
+    resumed = Checkpoint.open(tmp_path / "checkpoint", key, backend.patient_id, CHUNK_SIZE,
+                              resume=True)
+    assert resumed.completed_groups(0, [["population"]])[1] == 1
+
+    other = checkpoint_key(definitions(), "2022-10-15", backend.path, CHUNK_SIZE)
+    restarted = Checkpoint.open(tmp_path / "checkpoint", other, backend.patient_id, CHUNK_SIZE,
+                                resume=True)
+    assert restarted.completed_groups(0, [["population"]]) == ({}, 0)
+    assert restarted.chunks == [(0, 5), (5, 10), (10, 12)]
+
+
+def test_completed_groups_stop_at_the_first_missing_group(backend, tmp_path):
+    groups = variable_groups(definitions())
+    key = checkpoint_key(definitions(), INDEX_DATE, backend.path, CHUNK_SIZE)
+    checkpoint = Checkpoint.open(tmp_path / "checkpoint", key, backend.patient_id, CHUNK_SIZE)
+    saved = {
+        "age": np.array([48, 45, 42, 39, 36]),
+        "sex": np.array(["M", "F", "M", "F", "M"], dtype=object),
+        "has_code": np.array([0, 0, 0, 1, 0]),
+        "dod": np.array([NO_DAY] * 5),
+        "registered": np.array([1, 1, 0, 1, 1]),
+        "population": np.array([1, 1, 0, 1, 1]),
+    }
+    # Every group but the third (has_code)
+    for number, group in enumerate(groups):
+        if "has_code" not in group:
+            checkpoint.save_group(1, number, {name: saved[name] for name in group})
+
+    columns, done = checkpoint.completed_groups(1, groups)
+    assert groups[done] == ["has_code"]
+    assert set(columns) == {name for group in groups[:done] for name in group}
+    assert columns["age"].tolist() == saved["age"].tolist()
+    # Strings come back as object arrays, as the engine holds them
+    assert columns["sex"].dtype == object and columns["sex"].tolist() == saved["sex"].tolist()
+    assert checkpoint.completed_groups(0, groups) == ({}, 0)
+
+
+def test_resuming_after_a_failure_gives_the_same_output(backend, tmp_path, monkeypatch, capsys):
+    expected = run(backend, tmp_path, "complete")
+    assert 0 < len(expected) < SIZE
+
+    save_group = Checkpoint.save_group
+
+    def failing_save_group(self, chunk, number, columns):
+        save_group(self, chunk, number, columns)
+        if (chunk, number) == (1, 2):
+            raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(Checkpoint, "save_group", failing_save_group)
+    with pytest.raises(RuntimeError, match="interrupted"):
+        run(backend, tmp_path, "resumed", pipelined=False)
+    monkeypatch.setattr(Checkpoint, "save_group", save_group)
+    capsys.readouterr()
+
+    resumed = run(backend, tmp_path, "resumed", resume=True)
+    output = capsys.readouterr().out
+    assert "chunk 1/3: from checkpoint" in output
+    assert f"chunk 2/3: extracted (resumed after 3 of {len(variable_groups(definitions()))} groups)" in output
+    pd.testing.assert_frame_equal(resumed, expected)
+    assert not (tmp_path / "checkpoints" / "resumed").exists()
@@ -0,0 +1,58 @@
+##############################################################################
+#
+# Tests of compiled expression evaluation (analysis/local_backend/
+# expressions.py) against the reference evaluation.
+#
+# Run from the repo root: python -m pytest tests
+#
+##############################################################################
+
+
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis"))
+from local_backend.expressions import Evaluator, evaluate_reference, parse  # noqa: E402
+
+
+SIZE = 1000
+
+rng = np.random.default_rng(0)
+
+COLUMNS = {
+    "registered": rng.random(SIZE) < 0.95,
+    "age": rng.integers(0, 100, SIZE),
+    "sex": rng.choice(np.array(["F", "M", "U"], dtype=object), SIZE),
+    "has_died": rng.random(SIZE) < 0.02,
+}
+
+POPULATION = """
+    registered AND (age >= 44 AND age <= 55) AND (sex = 'M' OR sex = 'F') AND NOT has_died
+"""
+
+
+def recording_column(requests):
+    def column(name, positions):
+        requests.append((name, len(positions)))
+        return COLUMNS[name][positions]
+    return column
+
+
+def test_compiled_matches_the_reference():
+    for expression in (POPULATION, "age < 10 OR (registered AND NOT sex = 'U')", "NOT (age > 50 OR has_died)"):
+        node = parse(expression)
+        compiled = Evaluator(lambda name, positions: COLUMNS[name][positions], SIZE, sample_size=50).evaluate(node)
+        reference = evaluate_reference(node, lambda name, positions: COLUMNS[name][positions], SIZE)
+        assert np.array_equal(compiled.mask(), reference)
+
+
+def test_the_most_selective_term_is_evaluated_first_for_everyone():
+    requests = []
+    Evaluator(recording_column(requests), SIZE, sample_size=50).evaluate(parse(POPULATION))
+    # After the sample, the age range is evaluated first and the other
+    # terms only for the patients still in question
+    full = [(name, size) for name, size in requests if size > 50]
+    assert full[0] == ("age", SIZE)
+    assert all(size < SIZE / 2 for name, size in full[2:])
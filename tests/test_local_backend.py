@@ -0,0 +1,448 @@
+##############################################################################
+#
+# Tests of the local backend's engine (analysis/local_backend/engine.py)
+# against cohortextractor's semantics for every patients.* function the
+# study definitions use.
+#
+# Variables are defined with cohortextractor's own patients.* functions and
+# StudyDefinition (so date expressions, hidden variables and column types
+# are processed as in a real extraction) and evaluated against a small
+# hand-built backend. Expected values follow the TPP backend's SQL, e.g.
+# registrations cover StartDate <= date < EndDate, `between` bounds are
+# inclusive and ICD-10 diagnoses match by prefix.
+#
+# Run from the repo root: python -m pytest tests
+#
+##############################################################################
+
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cohortextractor import StudyDefinition, codelist, patients
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis"))
+from local_backend.ecds import Attendances  # noqa: E402
+from local_backend.engine import Extraction  # noqa: E402
+from local_backend.events import NO_DAY, Events, to_day  # noqa: E402
+from local_backend.intervals import Intervals  # noqa: E402
+from local_backend.tables import Backend  # noqa: E402
+
+
+INDEX_DATE = "2022-09-03"
+
+PATIENT_IDS = [1, 2, 3, 4]
+
+
+def day(date):
+    return int(to_day([date])[0])
+
+
+def events(records, code_dtype=str):
+    """
+    Events from (patient_id, date, code) records
+    """
+    if not records:
+        return Events([], [], np.array([], dtype=code_dtype))
+    patient_id, dates, codes = zip(*records)
+    return Events(patient_id, to_day(list(dates)), np.array(codes, dtype=code_dtype))
+
+
+def intervals(records, **values):
+    """
+    Intervals from (patient_id, start, end or None) records
+    """
+    patient_id = [record[0] for record in records]
+    start = [day(record[1]) for record in records]
+    end = [NO_DAY if record[2] is None else day(record[2]) for record in records]
+    return Intervals(patient_id, start, end, {name: np.asarray(value) for name, value in values.items()})
+
+
+def attendances(records, system, **values):
+    """
+    Attendances from (patient_id, date, [diagnoses]) records
+    """
+    patient_id = [record[0] for record in records]
+    days = to_day([record[1] for record in records]) if records else []
+    return Attendances.from_lists(patient_id, days, [record[2] for record in records], system=system,
+                                  values={name: np.asarray(value) for name, value in values.items()})
+
+
+def make_backend(**tables):
+    """
+    Backend of PATIENT_IDS with empty tables other than `tables`
+    """
+    n = len(PATIENT_IDS)
+    defaults = {
+        "patients": {
+            "patient_id": np.array(PATIENT_IDS),
+            "dob": to_day(["1972-09-01"] * n),
+            "sex": np.array(["F"] * n),
+            "dod": np.full(n, NO_DAY, dtype=np.int32),
+            "death_cause": np.array([""] * n),
+        },
+        "death_causes": events([]),
+        "registrations": intervals([], region=np.array([], dtype=str)),
+        "addresses": intervals([], imd=np.array([], dtype=np.int64), care_home=np.array([], dtype=bool),
+                               nursing=np.array([], dtype=bool)),
+        "clinical_snomed": events([], np.int64),
+        "clinical_ctv3": events([]),
+        "medications": events([], np.int64),
+        "vaccinations": events([]),
+        "hscworker": np.array([], dtype=np.int64),
+        "admissions": attendances([], "icd10", admission_method=np.array([], dtype=str),
+                                  patient_classification=np.array([], dtype=str),
+                                  primary_diagnosis=np.array([], dtype=str)),
+        "emergency_care": attendances([], "snomed"),
+    }
+    if "patients" in tables:
+        tables["patients"] = {**defaults["patients"], **tables["patients"]}
+    return Backend(**{**defaults, **tables})
+
+
+def extract(backend, **variables):
+    """
+    {name: values in PATIENT_IDS order} of `variables` (patients.* calls)
+    evaluated against `backend`
+    """
+    study = StudyDefinition(index_date=INDEX_DATE, population=patients.all(), **variables)
+    definitions = study.covariate_definitions
+    extraction = Extraction(backend, definitions)
+    extraction.evaluate_all([name for name in definitions if name != "population"])
+    return {name: extraction.columns[name].tolist() for name in variables}
+
+
+def days(*dates):
+    return [NO_DAY if date is None else day(date) for date in dates]
+
+
+#######################################
+# Demographics
+#######################################
+
+def test_age_as_of_counts_whole_years_to_the_reference_date():
+    backend = make_backend(patients={"dob": to_day(["1972-09-01", "1972-10-01", "1977-09-01", "1972-09-01"])})
+    columns = extract(backend, age=patients.age_as_of("index_date"),
+                      age_before=patients.age_as_of("2022-08-31"))
+    assert columns["age"] == [50, 49, 45, 50]
+    assert columns["age_before"] == [49, 49, 44, 49]
+
+
+def test_date_of_birth_and_sex():
+    backend = make_backend(patients={"dob": to_day(["1972-09-01", "1980-02-01", "1972-09-01", "1972-09-01"]),
+                                     "sex": np.array(["F", "M", "M", "F"])})
+    columns = extract(backend, dob=patients.date_of_birth(date_format="YYYY-MM"), sex=patients.sex())
+    assert columns["dob"] == days("1972-09-01", "1980-02-01", "1972-09-01", "1972-09-01")
+    assert columns["sex"] == ["F", "M", "M", "F"]
+
+
+#######################################
+# Registrations and addresses
+#######################################
+
+def test_registered_as_of_covers_start_date_to_before_end_date():
+    backend = make_backend(registrations=intervals(
+        [(1, "2020-01-01", None), (2, "2020-01-01", "2022-09-03"), (3, "2022-09-03", None),
+         (4, "2022-09-04", None)],
+        region=["London"] * 4,
+    ))
+    columns = extract(backend, registered=patients.registered_as_of("index_date"))
+    assert columns["registered"] == [True, False, True, False]
+
+
+def test_registered_with_one_practice_between_needs_one_registration_for_the_period():
+    backend = make_backend(registrations=intervals(
+        [(1, "2020-01-01", None),
+         # Changed practice during the period
+         (2, "2020-01-01", "2022-07-01"), (2, "2022-07-01", None),
+         (3, "2022-07-01", None),
+         (4, "2020-01-01", "2022-09-03")],
+        region=["London"] * 5,
+    ))
+    columns = extract(backend, one_practice=patients.registered_with_one_practice_between(
+        "index_date - 3 months", "index_date"))
+    assert columns["one_practice"] == [True, False, False, False]
+
+
+def test_registered_practice_as_of_returns_the_region():
+    backend = make_backend(registrations=intervals(
+        [(1, "2020-01-01", None), (2, "2020-01-01", "2021-01-01"), (2, "2021-01-01", None),
+         (3, "2023-01-01", None)],
+        region=["London", "North East", "South West", "East"],
+    ))
+    columns = extract(backend, region=patients.registered_practice_as_of(
+        "index_date", returning="nuts1_region_name"))
+    assert columns["region"] == ["London", "South West", "", ""]
+
+
+def test_address_as_of_uses_the_latest_starting_address_and_rounds_imd():
+    backend = make_backend(addresses=intervals(
+        [(1, "2020-01-01", None), (1, "2021-06-01", None), (2, "2020-01-01", "2022-01-01"),
+         (3, "2020-01-01", None)],
+        imd=[1240, 31870, 5000, 15020],
+        care_home=[False] * 4,
+        nursing=[False] * 4,
+    ))
+    columns = extract(backend, imd=patients.address_as_of(
+        "index_date", returning="index_of_multiple_deprivation", round_to_nearest=100))
+    assert columns["imd"] == [31900, 0, 15000, 0]
+
+
+def test_care_home_status_as_of_categorises_the_current_address():
+    backend = make_backend(addresses=intervals(
+        [(1, "2020-01-01", None), (2, "2020-01-01", None), (3, "2020-01-01", "2021-01-01")],
+        imd=[100, 100, 100],
+        care_home=[True, False, True],
+        nursing=[True, False, False],
+    ))
+    columns = extract(backend, care_home=patients.care_home_status_as_of(
+        "index_date", categorised_as={1: "IsPotentialCareHome", 0: "DEFAULT"}))
+    assert columns["care_home"] == [1, 0, 0, 0]
+
+
+#######################################
+# Deaths
+#######################################
+
+def test_died_from_any_cause_between_is_inclusive():
+    backend = make_backend(patients={"dod": np.array(days("2022-09-03", "2022-10-14", "2022-10-15", None),
+                                                     dtype=np.int32)})
+    columns = extract(
+        backend,
+        died=patients.died_from_any_cause(between=["index_date", "index_date + 41 days"],
+                                          returning="binary_flag"),
+        dod=patients.died_from_any_cause(returning="date_of_death", date_format="YYYY-MM-DD"),
+    )
+    assert columns["died"] == [True, True, False, False]
+    assert columns["dod"] == days("2022-09-03", "2022-10-14", "2022-10-15", None)
+
+
+def test_codes_on_death_certificate_match_any_cause():
+    covid = codelist(["U071", "U072"], system="icd10")
+    backend = make_backend(
+        patients={"dod": np.array(days("2022-01-01", "2022-01-01", "2022-01-01", None), dtype=np.int32),
+                  "death_cause": np.array(["I219", "U071", "C509", ""])},
+        death_causes=events([(1, "2022-01-01", "I219"), (1, "2022-01-01", "U072"),
+                             (2, "2022-01-01", "U071"), (3, "2022-01-01", "C509")]),
+    )
+    columns = extract(backend, death_covid=patients.with_these_codes_on_death_certificate(
+        covid, returning="binary_flag"))
+    assert columns["death_covid"] == [True, True, False, False]
+
+
+#######################################
+# Events
+#######################################
+
+def test_clinical_events_returning_flags_counts_and_dates():
+    asthma = codelist(["A1", "A2"], system="ctv3")
+    backend = make_backend(clinical_ctv3=events([
+        (1, "2022-01-01", "A1"), (1, "2022-03-01", "A2"), (1, "2022-09-04", "A1"),
+        (2, "2021-01-01", "A2"), (3, "2022-02-01", "B9"),
+    ]))
+    window = ["2022-01-01", "index_date"]
+    columns = extract(
+        backend,
+        flag=patients.with_these_clinical_events(asthma, between=window, returning="binary_flag"),
+        count=patients.with_these_clinical_events(asthma, between=window,
+                                                  returning="number_of_matches_in_period"),
+        first=patients.with_these_clinical_events(asthma, between=window, returning="date",
+                                                  find_first_match_in_period=True,
+                                                  date_format="YYYY-MM-DD"),
+        last=patients.with_these_clinical_events(asthma, on_or_before="index_date", returning="date",
+                                                 find_last_match_in_period=True, date_format="YYYY-MM"),
+    )
+    assert columns["flag"] == [True, False, False, False]
+    assert columns["count"] == [2, 0, 0, 0]
+    assert columns["first"] == days("2022-01-01", None, None, None)
+    assert columns["last"] == days("2022-03-01", "2021-01-01", None, None)
+
+
+def test_number_of_episodes_is_not_counted_as_matches():
+    asthma = codelist(["195967001"], system="snomed")
+    with pytest.raises(ValueError, match="number_of_episodes"):
+        extract(make_backend(), episodes=patients.with_these_clinical_events(
+            asthma, returning="number_of_episodes", episode_defined_as="series of events each <= 14 days apart"))
+
+
+def test_clinical_events_categories_and_ignored_days():
+    ethnicity = codelist([("E1", "1"), ("E2", "2")], system="ctv3")
+    resolved = codelist(["R1"], system="ctv3")
+    backend = make_backend(clinical_ctv3=events([
+        (1, "2010-01-01", "E1"), (1, "2015-01-01", "E2"),
+        (2, "2010-01-01", "E2"), (2, "2012-01-01", "E1"), (2, "2012-01-01", "R1"),
+    ]))
+    columns = extract(backend, ethnicity=patients.with_these_clinical_events(
+        ethnicity, returning="category", find_last_match_in_period=True,
+        ignore_days_where_these_codes_occur=resolved))
+    assert columns["ethnicity"] == ["2", "2", "", ""]
+
+
+def test_clinical_events_numeric_value_of_the_latest_event():
+    bmi = codelist(["60621009"], system="snomed")
+    backend = make_backend(
+        clinical_snomed=events([(1, "2020-01-01", 60621009), (1, "2021-01-01", 60621009),
+                                (2, "2023-01-01", 60621009)], np.int64),
+        event_values={"clinical_snomed": {"numeric_value": np.array([31.5, 28.0, 40.0])}},
+    )
+    columns = extract(backend, bmi=patients.with_these_clinical_events(
+        bmi, returning="numeric_value", find_last_match_in_period=True, on_or_before="index_date"))
+    assert columns["bmi"] == [28.0, 0.0, 0.0, 0.0]
+
+
+def test_medications_in_window():
+    drugs = codelist(["1001", "1002"], system="snomed")
+    backend = make_backend(medications=events([
+        (1, "2022-08-01", 1001), (2, "2021-01-01", 1002), (3, "2022-08-01", 9999),
+    ], np.int64))
+    columns = extract(backend, drug=patients.with_these_medications(
+        drugs, between=["index_date - 1 year", "index_date"], returning="binary_flag"))
+    assert columns["drug"] == [True, False, False, False]
+
+
+def test_vaccination_doses_chained_from_the_previous_dose():
+    backend = make_backend(vaccinations=events([
+        (1, "2021-01-05", "SARS-2 CORONAVIRUS"), (1, "2021-01-05", "SARS-2 CORONAVIRUS"),
+        (1, "2021-04-01", "SARS-2 CORONAVIRUS"), (1, "2022-10-01", "INFLUENZA"),
+        (2, "2020-11-01", "SARS-2 CORONAVIRUS"), (2, "2021-03-01", "SARS-2 CORONAVIRUS"),
+    ]))
+    dose = dict(target_disease_matches="SARS-2 CORONAVIRUS", find_first_match_in_period=True,
+                returning="date", date_format="YYYY-MM-DD")
+    columns = extract(
+        backend,
+        covid_vax_1_date=patients.with_tpp_vaccination_record(on_or_after="2020-12-08", **dose),
+        covid_vax_2_date=patients.with_tpp_vaccination_record(on_or_after="covid_vax_1_date + 1 days",
+                                                              **dose),
+        flu=patients.with_tpp_vaccination_record(target_disease_matches="INFLUENZA",
+                                                 on_or_after="2022-07-01", returning="binary_flag"),
+    )
+    assert columns["covid_vax_1_date"] == days("2021-01-05", "2021-03-01", None, None)
+    assert columns["covid_vax_2_date"] == days("2021-04-01", None, None, None)
+    assert columns["flu"] == [True, False, False, False]
+
+
+def test_healthcare_worker_flag():
+    backend = make_backend(hscworker=np.array([3]))
+    columns = extract(backend, hscworker=patients.with_healthcare_worker_flag_on_covid_vaccine_record(
+        returning="binary_flag"))
+    assert columns["hscworker"] == [False, False, True, False]
+
+
+#######################################
+# Hospital
+#######################################
+
+EMERGENCY = ["21", "22", "23", "24", "25", "2A", "2B", "2C", "2D", "28"]
+
+
+def admissions_backend():
+    return make_backend(admissions=attendances(
+        [(1, "2022-09-10", ["I219", "U0712"]), (2, "2022-09-10", ["U071"]),
+         (3, "2022-09-10", ["J189"]), (4, "2022-12-01", ["U071"])],
+        "icd10",
+        admission_method=["21", "11", "2A", "21"],
+        patient_classification=["1", "1", "2", "1"],
+        primary_diagnosis=["I219", "U071", "J189", "U071"],
+    ))
+
+
+def test_admitted_to_hospital_with_any_diagnosis_by_prefix():
+    covid = codelist(["U071"], system="icd10")
+    columns = extract(admissions_backend(), covidadmitted=patients.admitted_to_hospital(
+        with_admission_method=EMERGENCY, with_these_diagnoses=covid,
+        between=["index_date", "index_date + 41 days"], returning="binary_flag"))
+    # Patient 2 was an elective admission; patient 4 after the window
+    assert columns["covidadmitted"] == [True, False, False, False]
+
+
+def test_admitted_to_hospital_with_primary_diagnosis_and_classification():
+    resp = codelist(["J18"], system="icd10")
+    columns = extract(
+        admissions_backend(),
+        respadmitted=patients.admitted_to_hospital(
+            with_admission_method=EMERGENCY, with_these_primary_diagnoses=resp,
+            between=["index_date", "index_date + 41 days"], returning="binary_flag"),
+        anyadmitted=patients.admitted_to_hospital(
+            with_admission_method=EMERGENCY, with_patient_classification=["1"],
+            between=["index_date", "index_date + 41 days"], returning="binary_flag"),
+    )
+    assert columns["respadmitted"] == [False, False, True, False]
+    assert columns["anyadmitted"] == [True, False, False, False]
+
+
+def test_attended_emergency_care_with_exact_diagnosis_codes():
+    covid = codelist(["1240751000000100"], system="snomed")
+    backend = make_backend(emergency_care=attendances(
+        [(1, "2022-09-03", [1240751000000100]), (2, "2022-09-10", [12407510000001]),
+         (3, "2022-10-14", [55, 1240751000000100]), (4, "2022-10-15", [1240751000000100])],
+        "snomed",
+    ))
+    columns = extract(backend, covidemergency=patients.attended_emergency_care(
+        between=["index_date", "index_date + 41 days"], with_these_diagnoses=covid,
+        returning="binary_flag"))
+    assert columns["covidemergency"] == [True, False, True, False]
+
+
+#######################################
+# Files and expressions
+#######################################
+
+@pytest.fixture
+def cohort_file(tmp_path):
+    path = tmp_path / "cohort.csv"
+    pd.DataFrame({
+        "patient_id": [3, 1, 2],
+        "dob": ["1972-09-15", "1977-03-15", ""],
+        "death_covid": ["1", "0", "1"],
+        "region": ["London", "East", ""],
+    }).to_csv(path, index=False)
+    return str(path)
+
+
+def test_with_value_from_file_and_which_exist_in_file(cohort_file):
+    columns = extract(
+        make_backend(),
+        dob=patients.with_value_from_file(cohort_file, returning="dob", returning_type="date"),
+        death_covid=patients.with_value_from_file(cohort_file, returning="death_covid",
+                                                  returning_type="int"),
+        region=patients.with_value_from_file(cohort_file, returning="region", returning_type="str"),
+        in_cohort=patients.which_exist_in_file(cohort_file),
+    )
+    assert columns["dob"] == days("1977-03-15", None, "1972-09-15", None)
+    assert columns["death_covid"] == [0, 1, 1, 0]
+    assert columns["region"] == ["East", "", "London", ""]
+    assert columns["in_cohort"] == [True, True, True, False]
+
+
+def test_satisfying_and_categorised_as_expressions():
+    backend = make_backend(
+        patients={"dob": to_day(["1972-09-01", "1990-01-01", "1972-09-01", "1972-09-01"]),
+                  "sex": np.array(["F", "M", "U", "M"]),
+                  "dod": np.array(days(None, None, None, "2022-01-01"), dtype=np.int32)},
+        registrations=intervals([(pid, "2020-01-01", None) for pid in PATIENT_IDS], region=["London"] * 4),
+    )
+    columns = extract(
+        backend,
+        included=patients.satisfying(
+            """
+            registered
+            AND (age >= 44 AND age <= 55)
+            AND (sex = 'M' OR sex = 'F')
+            AND NOT has_died
+            """,
+            registered=patients.registered_as_of("index_date"),
+            age=patients.age_as_of("index_date"),
+            sex=patients.sex(),
+            has_died=patients.died_from_any_cause(on_or_before="index_date", returning="binary_flag"),
+        ),
+        band=patients.categorised_as(
+            {"0": "DEFAULT", "1": "age_band < 50", "2": "age_band >= 50 AND age_band < 55"},
+            age_band=patients.age_as_of("index_date"),
+        ),
+    )
+    assert columns["included"] == [True, False, False, False]
+    assert columns["band"] == ["2", "1", "2", "2"]
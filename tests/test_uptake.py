@@ -0,0 +1,44 @@
+##############################################################################
+#
+# Tests of cumulative uptake by age cell (analysis/uptake.py).
+#
+# Run from the repo root: python -m pytest tests
+#
+##############################################################################
+
+
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "analysis"))
+from uptake import cumulative_uptake  # noqa: E402
+
+
+def test_people_who_died_leave_the_numerator_and_the_denominator():
+    # A is boosted on Sep 10 and dies on Oct 1; B is alive and never boosted
+    uptake = cumulative_uptake(
+        cells=[0, 0],
+        event_date=pd.to_datetime(["2022-09-10", None]),
+        dod=pd.to_datetime(["2022-10-01", None]),
+        eval_dates=["2022-09-05", "2022-09-10", "2022-10-01", "2022-10-02", "2022-10-15"],
+    )
+    assert uptake["n"].tolist() == [0, 1, 1, 1, 1]
+    assert uptake["n_at_risk"].tolist() == [0, 1, 1, 0, 0]
+    assert uptake["at_risk"].tolist() == [2, 2, 2, 1, 1]
+    assert uptake["total"].tolist() == [2, 2, 2, 2, 2]
+
+
+def test_uptake_by_cell():
+    uptake = cumulative_uptake(
+        cells=[600, 601, 601, 600],
+        event_date=pd.to_datetime(["2022-09-10", "2022-09-20", None, "2022-10-20"]),
+        dod=pd.to_datetime([None, "2022-09-30", "2022-09-15", "2022-10-10"]),
+        eval_dates=["2022-10-15", "2022-09-25"],
+    )
+    by_cell = uptake.set_index(["cell", "date"])
+    assert by_cell.loc[(600, pd.Timestamp("2022-09-25")), ["n", "n_at_risk", "at_risk"]].tolist() == [1, 1, 2]
+    assert by_cell.loc[(600, pd.Timestamp("2022-10-15")), ["n", "n_at_risk", "at_risk"]].tolist() == [1, 1, 1]
+    assert by_cell.loc[(601, pd.Timestamp("2022-09-25")), ["n", "n_at_risk", "at_risk"]].tolist() == [1, 1, 1]
+    assert by_cell.loc[(601, pd.Timestamp("2022-10-15")), ["n", "n_at_risk", "at_risk"]].tolist() == [1, 0, 0]